@@ -1,9 +1,13 @@
+from collections import OrderedDict
 import copy
+from datetime import datetime
 import dateutil.parser
-import json
+from dateutil.tz import tzoffset, tzutc
 import random
 import re
 
+import json_codec
+
 
 def load_flattener(key):
     '''
@@ -20,58 +24,289 @@ def load_flattener(key):
     return flattener
 
 
+class FlattenPlan(object):
+    '''
+    Compiled renaming rules of a DataFlattener.
+
+    Maps each flattened raw key to its final column name, applying the prefix
+    renames, field renames and int casts in the same order as the original
+    per-record passes. The mapping is cached per observed schema shape (the
+    ordered tuple of flattened keys), so a record whose shape has been seen
+    before is renamed in a single pass.
+
+    Once set_columns is called, flatten_dict asks the plan to prune the fields
+    and subtrees of a raw record that cannot be renamed to any of the columns.
+    '''
+    max_shapes = 1024
+
+    def __init__(self, rename_prefix_fields=[], rename_fields=[], int_fields=[]):
+        self.rename_prefix_fields = list(rename_prefix_fields)
+        self.rename_fields = list(rename_fields)
+        self.int_fields = set(int_fields)
+        self.shapes = {}
+        self.columns = None
+        self.pruned = {}
+
+    def rename_key(self, key):
+        for old_prefix, new_prefix in self.rename_prefix_fields:
+            if old_prefix in key:
+                key = key.replace(old_prefix, new_prefix)
+        return key
+
+    def set_columns(self, columns):
+        '''
+        Parameters:
+            columns: set of final column names that are needed, or None to keep
+            every field
+        '''
+        self.columns = columns
+        self.pruned = {}
+
+    def rename_prefix(self, prefix):
+        '''
+        Replay the prefix renames on the part of a key that is known.
+
+        Returns:
+            what prefix becomes at the start of every key beginning with it,
+            or None if a rename may match across the end of prefix, so that
+            the renamed key depends on the rest of the key
+        '''
+        for old_prefix, new_prefix in self.rename_prefix_fields:
+            for i in range(max(len(prefix) - len(old_prefix) + 1, 0), len(prefix)):
+                if old_prefix.startswith(prefix[i:]):
+                    return None
+            prefix = prefix.replace(old_prefix, new_prefix)
+        return prefix
+
+    def can_prune(self, key):
+        '''
+        Check whether no field whose flattened raw key begins with key (a single
+        field, an enum or json string field, or a whole subtree) can be renamed
+        to one of the columns. Cached per key.
+        '''
+        pruned = self.pruned.get(key)
+        if pruned is None:
+            renamed = self.rename_prefix(key)
+            if renamed is None:
+                pruned = False
+            else:
+                # exact renames of fields from this subtree, in order of application
+                reachable = set()
+                for old_f, new_f in self.rename_fields:
+                    if old_f.startswith(renamed) or old_f in reachable:
+                        reachable.add(new_f)
+                pruned = not (reachable & self.columns or
+                              any(k.startswith(renamed) for k in self.columns))
+            self.pruned[key] = pruned
+        return pruned
+
+    def compile_shape(self, keys):
+        '''
+        Replay the renaming rules on the key names of one schema shape.
+
+        Returns:
+            tuple of (columns, copied, ints), where columns is the ordered list
+            of (final key, raw key) pairs, copied lists the renamed fields whose
+            values are deep copied and ints lists the fields cast to int
+        '''
+        # later keys renamed onto an existing key keep its position but win the value
+        out = {}
+        for k in keys:
+            out[self.rename_key(k)] = k
+
+        renamed = set()
+        for old_f, new_f in self.rename_fields:
+            if old_f in out:
+                out[new_f] = out[old_f]
+                del out[old_f]
+                renamed.add(new_f)
+
+        columns = list(out.items())
+        ints = [k for k in out if k in self.int_fields]
+        copied = [(k, v) for k, v in columns if k in renamed and k not in self.int_fields]
+        return columns, copied, ints
+
+    def apply(self, flat_rec):
+        shape = tuple(flat_rec)
+        compiled = self.shapes.get(shape)
+        if compiled is None:
+            if len(self.shapes) >= self.max_shapes:
+                self.shapes.clear()
+            compiled = self.compile_shape(shape)
+            self.shapes[shape] = compiled
+        columns, copied, ints = compiled
+
+        out = {k: flat_rec[raw_k] for k, raw_k in columns}
+        for k, raw_k in copied:
+            out[k] = copy.deepcopy(flat_rec[raw_k])
+        for k in ints:
+            out[k] = int(out[k])
+        return out
+
+
 class DataFlattener(object):
+    # fields read by process or add_enhancements, which set_columns never prunes
+    required_fields = []
+
     def __init__(self):
         self.rename_prefix_fields = []
         self.rename_fields = []
         self.int_fields = []
         self.json_string_fields = []
+        self.flatten_plans = {}
+        self.columns = None
 
-    def flatten_dict(self, d, json_string_fields=[]):
-        def expand(key, value):
-            if isinstance(value, dict):
-                # get key as value
-                if len(value.items()) == 1 and list(value.values())[0] == None:
-                    return [ (key, list(value.keys())[0])]
-                # dump as json string instead of expanding further
-                elif key in json_string_fields:
-                    return [(key, json.dumps(value))]
-                # expand dict
-                else:
-                    return [ (key + '_' + k, v) for k, v in self.flatten_dict(value, json_string_fields).items() ]
+    def set_columns(self, columns):
+        '''
+        Only flatten the parts of raw records that can end up in one of the
+        given columns (e.g. the columns of the target Socrata data set). Fields
+        outside of them may still be in the output records.
+
+        Parameters:
+            columns: iterable of output column names, or None to flatten
+            every field again
+        '''
+        self.columns = None if columns is None else set(columns) | set(self.required_fields)
+        for plan in self.flatten_plans.values():
+            plan.set_columns(self.columns)
+
+    def flatten_dict(self, d, json_string_fields=[], prefix='', out=None, plan=None):
+        '''
+        Flatten a nested dictionary into a single level dictionary, joining
+        nested keys with '_'. A dictionary with a single None-valued key (enum)
+        is collapsed to that key, and dictionaries stored under a key in
+        json_string_fields are dumped as json strings instead of being expanded.
+
+        Walks the record with an explicit stack of item iterators and writes
+        every field straight into the output dictionary. Supply prefix and out
+        to flatten a fragment of a record into an existing output dictionary.
+        Supply the FlattenPlan the output is renamed with to skip the fields
+        and subtrees it prunes.
+        '''
+        json_string_fields = set(json_string_fields)
+        if out is None:
+            out = {}
+        can_prune = plan.can_prune if plan is not None and plan.columns is not None else None
+        stack = [(iter(d.items()), prefix)]
+        while stack:
+            items, prefix = stack[-1]
+            for key, value in items:
+                if can_prune and can_prune(prefix + key):
+                    continue
+                if isinstance(value, dict):
+                    # get key as value
+                    if len(value) == 1:
+                        enum_key, enum_value = next(iter(value.items()))
+                        if enum_value is None:
+                            out[prefix + key] = enum_key
+                            continue
+                    # dump as json string instead of expanding further
+                    if key in json_string_fields:
+                        out[prefix + key] = json_codec.dumps(value)
+                        continue
+                    # expand dict
+                    stack.append((iter(value.items()), prefix + key + '_'))
+                    break
+                out[prefix + key] = value
             else:
-                return [ (key, value) ]
+                stack.pop()
+        return out
 
-        items = [ item for k, v in d.items() for item in expand(k, v) ]
-        return dict(items)
+    def flatten_around(self, d, path, json_string_fields=[], prefix='', plan=None):
+        '''
+        Flatten every field of a nested dictionary except the subtree at path.
 
-    def transform(self, raw_rec, rename_prefix_fields=[], rename_fields=[],
-                int_fields=[], json_string_fields=[]):
-        # order of operation: rename prefix, rename fields, stringify json fields
-        out = self.flatten_dict(raw_rec, json_string_fields)
+        Parameters:
+            d: dictionary object to flatten
+            path: list of keys leading to the excluded subtree
+            json_string_fields: list of fields to dump as json strings
+            prefix: key prefix of d within the full record
+            plan: FlattenPlan passed on to flatten_dict
 
-        for old_prefix, new_prefix in rename_prefix_fields:
-            out = {k.replace(old_prefix, new_prefix) if old_prefix in k else k: v
-                   for k,v in out.items()}
+        Returns:
+            tuple of (before, after, prefix), where before and after are the
+            flattened fields that precede and follow the subtree, and prefix is
+            the key prefix of the subtree's parent
+        '''
+        before = {}
+        afters = []
+        node = d
+        for idx, step in enumerate(path):
+            after = {}
+            out = before
+            for key, value in node.items():
+                if key == step:
+                    out = after
+                else:
+                    self.flatten_dict({key: value}, json_string_fields, prefix, out, plan)
+            afters.append(after)
+            if idx < len(path) - 1:
+                prefix += step + '_'
+                node = node[step]
 
-        for old_f, new_f in rename_fields:
-            if old_f in out:
-                out[new_f] = copy.deepcopy(out[old_f])
-                del out[old_f]
+        after = {}
+        for fields in reversed(afters):
+            after.update(fields)
+        return before, after, prefix
 
-        out = {k: int(v) if k in int_fields else v for k,v in out.items()}
-        # out = {k: json.dumps(v) if k in json_string_fields else v for k,v in out.items()}
-        return out
+    def flatten_split(self, d, path, values, json_string_fields=[], prefix='', plan=None):
+        '''
+        Flatten one record per value, each being d with the subtree at path
+        replaced by that value. Fields shared by all records are flattened once.
+
+        Returns:
+            list of flattened dictionary objects, one per value
+        '''
+        before, after, parent_prefix = self.flatten_around(d, path, json_string_fields, prefix, plan)
+        out_recs = []
+        for value in values:
+            out = dict(before)
+            self.flatten_dict({path[-1]: value}, json_string_fields, parent_prefix, out, plan)
+            out.update(after)
+            out_recs.append(out)
+        return out_recs
+
+    def get_flatten_plan(self, rename_prefix_fields=[], rename_fields=[], int_fields=[]):
+        '''
+        Return the compiled FlattenPlan for a set of renaming rules, compiling
+        it on first use.
+        '''
+        plan_key = (tuple(rename_prefix_fields), tuple(rename_fields), tuple(int_fields))
+        plan = self.flatten_plans.get(plan_key)
+        if plan is None:
+            plan = FlattenPlan(rename_prefix_fields, rename_fields, int_fields)
+            plan.set_columns(self.columns)
+            self.flatten_plans[plan_key] = plan
+        return plan
+
+    def get_record_plan(self):
+        '''
+        Return the FlattenPlan of the renaming rules for whole records.
+        '''
+        return self.get_flatten_plan(self.rename_prefix_fields,
+                                     self.rename_fields,
+                                     self.int_fields)
+
+    def transform(self, raw_rec, rename_prefix_fields=[], rename_fields=[],
+                int_fields=[], json_string_fields=[]):
+        # order of operation: rename prefix, rename fields, stringify json fields
+        plan = self.get_flatten_plan(rename_prefix_fields, rename_fields, int_fields)
+        out = self.flatten_dict(raw_rec, json_string_fields, plan=plan)
+        return plan.apply(out)
 
     def add_enhancements(self, rec):
         return rec
 
     def process(self, raw_rec, **kwargs):
-        rec = self.transform(raw_rec,
-                             self.rename_prefix_fields,
-                             self.rename_fields,
-                             self.int_fields,
-                             self.json_string_fields)
+        flat_rec = self.flatten_dict(raw_rec, self.json_string_fields, plan=self.get_record_plan())
+        return self.process_flat(flat_rec)
+
+    def process_flat(self, flat_rec):
+        '''
+        Rename and enhance a record that has already been flattened with
+        flatten_dict (or flatten_split).
+        '''
+        rec = self.get_record_plan().apply(flat_rec)
         rec = self.add_enhancements(rec)
         return rec
 
@@ -79,11 +314,83 @@ class DataFlattener(object):
         return [self.process(raw_rec, **kwargs)]
 
 
+class TimestampParser(object):
+    '''
+    Fast parser for the ISO-8601 timestamps found in ODE records, e.g.
+    2019-09-16T00:00:00.123Z[UTC], 2019-09-16T00:00:00.12+00:00 or
+    2019-09-16T00:00:00.123456. Any other format falls back to dateutil.
+
+    Recently seen second-resolution prefixes are kept in a small LRU cache, and
+    the number of fast path hits and dateutil fallbacks is counted.
+    '''
+    timestamp_regex = re.compile(r'(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})?(?:\[[a-zA-Z]*\])?$')
+
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self.prefix_cache = OrderedDict()
+        self.tz_cache = {}
+        self.hits = 0
+        self.fallbacks = 0
+
+    def get_stats(self):
+        return {'hits': self.hits, 'fallbacks': self.fallbacks}
+
+    def parse_prefix(self, prefix):
+        dt = self.prefix_cache.pop(prefix, None)
+        if dt is None:
+            dt = datetime(int(prefix[:4]), int(prefix[5:7]), int(prefix[8:10]),
+                          int(prefix[11:13]), int(prefix[14:16]), int(prefix[17:19]))
+            if len(self.prefix_cache) >= self.cache_size:
+                self.prefix_cache.popitem(last=False)
+        self.prefix_cache[prefix] = dt
+        return dt
+
+    def parse_tz(self, tz_str):
+        tz = self.tz_cache.get(tz_str)
+        if tz is None:
+            offset = 0
+            if tz_str != 'Z':
+                offset = int(tz_str[1:3])*3600 + int(tz_str[-2:])*60
+                if tz_str[0] == '-':
+                    offset = -offset
+            tz = tzoffset(None, offset) if offset else tzutc()
+            self.tz_cache[tz_str] = tz
+        return tz
+
+    def parse_fast(self, date_str):
+        match = self.timestamp_regex.match(date_str)
+        if not match:
+            return None
+        prefix, fraction, tz_str = match.groups()
+        dt = self.parse_prefix(prefix)
+        if fraction:
+            # digits beyond microseconds are truncated, as dateutil does
+            dt = dt.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+        if tz_str:
+            dt = dt.replace(tzinfo=self.parse_tz(tz_str))
+        return dt
+
+    def parse(self, date_str):
+        try:
+            dt = self.parse_fast(date_str)
+        except ValueError:
+            dt = None
+        if dt is None:
+            self.fallbacks += 1
+            return dateutil.parser.parse(re.sub(r'\[[a-zA-Z]*\]', '', date_str))
+        self.hits += 1
+        return dt
+
+
+timestamp_parser = TimestampParser()
+
+
 def parse_date(date_str):
-    clean_date_str = lambda x: re.sub(r'\[[a-zA-Z]*\]', '', x)
-    return dateutil.parser.parse(clean_date_str(date_str))
+    return timestamp_parser.parse(date_str)
 
 class CvDataFlattener(DataFlattener):
+    required_fields = ['metadata_generatedAt']
+
     def __init__(self, *args, **kwargs):
         super(CvDataFlattener, self).__init__(*args, **kwargs)
         self.rename_prefix_fields = [
@@ -107,3 +414,92 @@ class CvDataFlattener(DataFlattener):
         rec['randomNum'] = random.random()
         rec['metadata_generatedAt_timeOfDay'] = metadata_generatedAt.hour + metadata_generatedAt.minute/60 + metadata_generatedAt.second/3600
         return rec
+
+
+if __name__ == '__main__':
+    """
+    Benchmark of FlattenPlan against renaming each flattened record in one pass
+    per rule, as transform used to, over synthetic WYDOT BSM and TIM records:
+    python flattener.py
+    """
+    import timeit
+
+    from flattener_wydot import WydotBSMFlattener, WydotTIMFlattener
+
+    rnd = random.Random(0)
+
+    def raw_bsm(i):
+        ts = '2019-09-16T12:{:02d}:{:02d}.{:03d}Z'.format(rnd.randint(0, 59), rnd.randint(0, 59), rnd.randint(0, 999))
+        rec = {
+            'metadata': {'logFileName': 'rxMsg_1568592011_2605:e000:1d06:2d00.csv', 'recordType': 'rxMsg',
+                         'securityResultCode': 'success',
+                         'receivedMessageDetails': {'locationData': {'latitude': '41.1', 'longitude': '-104.8', 'elevation': '1800',
+                                                                     'speed': '20', 'heading': '90'}, 'rxSource': 'RV'},
+                         'payloadType': 'us.dot.its.jpo.ode.model.OdeBsmPayload',
+                         'serialId': {'streamId': 'abc', 'bundleSize': 1, 'bundleId': i, 'recordId': 2, 'serialNumber': 0},
+                         'odeReceivedAt': ts, 'schemaVersion': 6, 'recordGeneratedAt': ts + '[UTC]',
+                         'recordGeneratedBy': 'OBU', 'sanitized': False},
+            'payload': {'dataType': 'us.dot.its.jpo.ode.plugin.j2735.J2735Bsm',
+                        'data': {'coreData': {'msgCnt': i % 128, 'id': 'ABCD', 'secMark': rnd.randint(0, 59999),
+                                              'position': {'latitude': 41+rnd.random(), 'longitude': -105+rnd.random(), 'elevation': 1800.1},
+                                              'accelSet': {'accelLat': 0, 'accelLong': 0.1, 'accelVert': 0, 'accelYaw': 0},
+                                              'accuracy': {'semiMajor': 2, 'semiMinor': 2, 'orientation': 0},
+                                              'transmission': 'NEUTRAL', 'speed': rnd.random()*30, 'heading': rnd.randint(0, 359),
+                                              'brakes': {'wheelBrakes': {'leftFront': False, 'rightFront': False, 'unavailable': True,
+                                                                         'leftRear': False, 'rightRear': False},
+                                                         'traction': 'unavailable', 'abs': 'unavailable', 'scs': 'unavailable',
+                                                         'brakeBoost': 'unavailable', 'auxBrakes': 'unavailable'},
+                                              'size': {'width': 200, 'length': 500}}}}}
+        if i % 3:
+            rec['payload']['data']['partII'] = [
+                {'id': 'VEHICLESAFETYEXT', 'value': {
+                    'pathHistory': {'crumbData': [{'elevationOffset': 1, 'latOffset': 2, 'lonOffset': 3, 'timeOffset': 4}]*3},
+                    'pathPrediction': {'confidence': 0, 'radiusOfCurve': 0},
+                    'events': {'eventAirBagDeployment': False, 'eventHazardLights': True}}}]
+        return rec
+
+    def raw_tim(i):
+        frame = {
+            'sspTimRights': 1, 'frameType': {'advisory': None},
+            'msgId': {'roadSignID': {'position': {'lat': 411234567, 'long': -1048765432, 'elevation': 1800},
+                                     'viewAngle': '1111111111111111', 'mutcdCode': {'warning': None}}},
+            'startYear': 2019, 'startTime': 370000 + i, 'duratonTime': 1440, 'priority': 5, 'sspLocationRights': 1,
+            'regions': {'GeographicalPath': {
+                'anchor': {'lat': 411234567, 'long': -1048765432, 'elevation': 1800}, 'name': 'Path',
+                'laneWidth': 700, 'directionality': {'both': None}, 'closedPath': False, 'direction': '0000000000011111',
+                'description': {'path': {'scale': 0, 'offset': {'xy': {'nodes': {'NodeXY': [
+                    {'delta': {'node-LatLon': {'lon': -1048765432 + k, 'lat': 411234567 + k}}} for k in range(6)]}}}}}}},
+            'sspMsgRights1': 1, 'sspMsgRights2': 1,
+            'content': {'advisory': {'SEQUENCE': [{'item': {'itis': 777}}, {'item': {'itis': 13579}}]}}, 'url': 'null'}
+        return {
+            'metadata': {'recordGeneratedBy': 'TMC', 'schemaVersion': 6, 'recordGeneratedAt': '2019-09-16T12:00:00.000Z',
+                         'odeReceivedAt': '2019-09-16T12:00:01.000Z', 'recordType': 'timMsg', 'payloadType': 'us.dot.its.jpo.ode.model.OdeTimPayload',
+                         'serialId': {'streamId': 'abc', 'bundleSize': 1, 'bundleId': i, 'recordId': 0, 'serialNumber': 0},
+                         'sanitized': False},
+            'payload': {'dataType': 'TravelerInformation',
+                        'data': {'MessageFrame': {'messageId': 31, 'value': {'TravelerInformation': {
+                            'msgCnt': i % 128, 'timeStamp': 370000, 'packetID': '0000000000000A', 'urlB': 'null',
+                            'dataFrames': {'TravelerDataFrame': frame}}}}}}}
+
+    def transform_per_pass(flattener, raw_rec, rename_prefix_fields, rename_fields, int_fields, json_string_fields):
+        out = flattener.flatten_dict(raw_rec, json_string_fields)
+        for old_prefix, new_prefix in rename_prefix_fields:
+            out = {k.replace(old_prefix, new_prefix) if old_prefix in k else k: v
+                   for k,v in out.items()}
+        for old_f, new_f in rename_fields:
+            if old_f in out:
+                out[new_f] = copy.deepcopy(out[old_f])
+                del out[old_f]
+        return {k: int(v) if k in int_fields else v for k,v in out.items()}
+
+    for name, flattener, recs in [('WYDOT BSM', WydotBSMFlattener(), [raw_bsm(i) for i in range(20000)]),
+                                  ('WYDOT TIM', WydotTIMFlattener(), [raw_tim(i) for i in range(20000)])]:
+        rules = (flattener.rename_prefix_fields, flattener.rename_fields, flattener.int_fields, flattener.json_string_fields)
+        expected = [transform_per_pass(flattener, rec, *rules) for rec in recs]
+        result = [flattener.transform(rec, *rules) for rec in recs]
+        assert all(list(a.items()) == list(b.items()) for a, b in zip(result, expected))
+        print('Transforming {} {} records ({} fields per record on average):'.format(
+            len(recs), name, sum(len(rec) for rec in result)//len(result)))
+        for func_name, func in [('one pass per rule (previous transform)', lambda: [transform_per_pass(flattener, rec, *rules) for rec in recs]),
+                                ('FlattenPlan', lambda: [flattener.transform(rec, *rules) for rec in recs])]:
+            print('  {:<40} {:.2f} s'.format(func_name, min(timeit.repeat(func, number=1, repeat=3))))
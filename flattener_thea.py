@@ -1,9 +1,8 @@
-import copy
 import dateutil.parser
-import json
 import random
 
 from flattener import CvDataFlattener
+import json_codec
 
 
 class TheaBSMFlattener(CvDataFlattener):
@@ -16,6 +15,11 @@ class TheaBSMFlattener(CvDataFlattener):
     (e.g. randomNum, coreData_position)
 
     '''
+    required_fields = CvDataFlattener.required_fields + [
+        'payload_data_partII_SEQUENCE', 'coreData_position_long', 'coreData_position_lat',
+        'coreData_size_width', 'coreData_size_length', 'coreData_brakes_wheelBrakes'
+    ]
+
     def __init__(self, **kwargs):
         super(TheaBSMFlattener, self).__init__(**kwargs)
         self.rename_fields += [
@@ -76,7 +80,7 @@ class TheaBSMFlattener(CvDataFlattener):
             out['coreData_position'] = "POINT ({} {})".format(coreData_position_long, coreData_position_lat)
 
         if 'coreData_size_width' in out:
-            out['coreData_size'] = json.dumps({'width': int(out['coreData_size_width']),
+            out['coreData_size'] = json_codec.dumps({'width': int(out['coreData_size_width']),
                                                'length': int(out['coreData_size_length'])})
             del out['coreData_size_width']
             del out['coreData_size_length']
@@ -101,6 +105,10 @@ class TheaTIMFlattener(CvDataFlattener):
     (e.g. randomNum, coreData_position)
 
     '''
+    required_fields = CvDataFlattener.required_fields + [
+        'travelerdataframe_msgId_lat', 'travelerdataframe_msgId_long'
+    ]
+
     def __init__(self, **kwargs):
         super(TheaTIMFlattener, self).__init__(**kwargs)
         self.rename_prefix_fields += [
@@ -119,16 +127,17 @@ class TheaTIMFlattener(CvDataFlattener):
         self.json_string_fields += [
         'SEQUENCE', 'travelerdataframe_desc_nodes', 'itis'
         ]
+        self.dataFrames_path = ['payload', 'data', 'TravelerInformation', 'dataFrames', 'TravelerDataFrame']
 
-    def process(self, raw_rec):
+    def process_flat(self, flat_rec):
         '''
         	Parameters:
-        		raw_rec: dictionary object of a single TIM record
+        		flat_rec: flattened dictionary object of a single TIM record
 
         	Returns:
         		transformed dictionary object of the TIM record
         '''
-        out = super(TheaTIMFlattener, self).process(raw_rec)
+        out = super(TheaTIMFlattener, self).process_flat(flat_rec)
 
         if 'travelerdataframe_msgId_lat' in out:
             travelerdataframe_msgId_lat = float(out['travelerdataframe_msgId_lat'])/10e6
@@ -138,19 +147,20 @@ class TheaTIMFlattener(CvDataFlattener):
         return out
 
     def process_and_split(self, raw_rec):
-        out_recs = []
+        '''
+        Produce one record per Traveler DataFrame. The fields shared by all of them are flattened
+        only once and merged with each flattened DataFrame.
+        '''
         try:
-            tdfs = copy.deepcopy(raw_rec['payload']['data']['TravelerInformation']['dataFrames']['TravelerDataFrame'])
-            if type(tdfs) == list:
-                for tdf in tdfs:
-                    temp_rec = copy.deepcopy(raw_rec)
-                    temp_rec['payload']['data']['TravelerInformation']['dataFrames']['TravelerDataFrame'] = tdf
-                    out_recs.append(temp_rec)
-            else:
-                out_recs.append(raw_rec)
+            tdfs = raw_rec['payload']['data']['TravelerInformation']['dataFrames']['TravelerDataFrame']
         except:
-            out_recs.append(raw_rec)
-        return [self.process(out_rec) for out_rec in out_recs if out_rec]
+            tdfs = None
+
+        if type(tdfs) != list:
+            return [self.process(raw_rec)] if raw_rec else []
+
+        flat_recs = self.flatten_split(raw_rec, self.dataFrames_path, tdfs, self.json_string_fields, plan=self.get_record_plan())
+        return [self.process_flat(flat_rec) for flat_rec in flat_recs]
 
 class TheaSPATFlattener(CvDataFlattener):
     '''
@@ -1,9 +1,7 @@
-import copy
-import dateutil.parser
 import json
 import random
 
-from flattener import CvDataFlattener
+from flattener import CvDataFlattener, parse_date
 
 
 class WydotBSMFlattener(CvDataFlattener):
@@ -16,6 +14,10 @@ class WydotBSMFlattener(CvDataFlattener):
     (e.g. randomNum, coreData_position)
 
     '''
+    required_fields = CvDataFlattener.required_fields + [
+        'payload_data_partII', 'coreData_position_long', 'coreData_position_lat', 'metadata_receivedAt'
+    ]
+
     def __init__(self, **kwargs):
         super(WydotBSMFlattener, self).__init__(**kwargs)
         self.rename_prefix_fields += [
@@ -77,7 +79,7 @@ class WydotBSMFlattener(CvDataFlattener):
         if 'coreData_position_long' in out:
             out['coreData_position'] = "POINT ({} {})".format(out['coreData_position_long'], out['coreData_position_lat'])
 
-        metadata_receivedAt = dateutil.parser.parse(out['metadata_receivedAt'][:23])
+        metadata_receivedAt = parse_date(out['metadata_receivedAt'][:23])
         out['metadata_receivedAt'] = metadata_receivedAt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
 
         return out
@@ -93,6 +95,10 @@ class WydotTIMFlattener(CvDataFlattener):
     (e.g. randomNum, coreData_position)
 
     '''
+    required_fields = CvDataFlattener.required_fields + [
+        'travelerdataframe_msgId_lat', 'travelerdataframe_msgId_long'
+    ]
+
     def __init__(self, **kwargs):
         super(WydotTIMFlattener, self).__init__(**kwargs)
 
@@ -118,16 +124,17 @@ class WydotTIMFlattener(CvDataFlattener):
         ]
         self.json_string_fields += [
         ]
+        self.dataFrames_path = ['payload', 'data', 'MessageFrame', 'value', 'TravelerInformation', 'dataFrames']
 
-    def process(self, raw_rec):
+    def process_flat(self, flat_rec):
         '''
         	Parameters:
-        		raw_rec: dictionary object of a single BSM record
+        		flat_rec: flattened dictionary object of a single TIM record
 
         	Returns:
-        		transformed dictionary object of the BSM record
+        		transformed dictionary object of the TIM record
         '''
-        out = super(WydotTIMFlattener, self).process(raw_rec)
+        out = super(WydotTIMFlattener, self).process_flat(flat_rec)
 
         if 'travelerdataframe_msgId_lat' in out:
             travelerdataframe_msgId_lat = float(out['travelerdataframe_msgId_lat'])/10e6
@@ -141,46 +148,49 @@ class WydotTIMFlattener(CvDataFlattener):
         Turn various Traveler Information DataFrame schemas to one where the Traverler DataFrame is stored at:
         rec['payload']['data']['MessageFrame']['value']['TravelerInformation']['dataFrames']['TravelerDataFrame']
 
+        One record is produced per Traveler DataFrame and GeographicalPath. The fields shared by all of them
+        (metadata and payload header) are flattened only once and merged with each flattened DataFrame/path.
         '''
-        out_recs = []
-        travelerInformation = copy.deepcopy(raw_rec.get('payload', {}).get('data', {}).get('MessageFrame', {}).get('value', {}).get('TravelerInformation'))
+        travelerInformation = raw_rec.get('payload', {}).get('data', {}).get('MessageFrame', {}).get('value', {}).get('TravelerInformation')
 
         if not travelerInformation:
             return [self.process(raw_rec)]
 
         if raw_rec['metadata']['schemaVersion'] == 5:
-            out_recs.append(raw_rec)
+            return [self.process(raw_rec)]
+
+        # elif raw_rec['metadata']['schemaVersion'] == 6:
+        travelerDataFrames = travelerInformation.get('dataFrames')
+        if type(travelerDataFrames) == list:
+            tdfs = [i.get('TravelerDataFrame') for i in travelerDataFrames if i.get('TravelerDataFrame')]
+            if len(tdfs) != len(travelerDataFrames):
+                print('travelerDataFrames discrepancy: {} -> {}'.format(len(travelerDataFrames), len(tdfs)))
+        elif type(travelerDataFrames) == dict:
+            travelerDataFramesOpt1 = travelerDataFrames.get('TravelerDataFrame')
+            travelerDataFramesOpt2 = travelerDataFrames.get('dataFrames', {}).get('TravelerDataFrame')
+            tdfs = travelerDataFramesOpt1 or travelerDataFramesOpt2
+            if type(tdfs) != list:
+                tdfs = [tdfs]
         else:
-            # elif raw_rec['metadata']['schemaVersion'] == 6:
-            travelerDataFrames = travelerInformation.get('dataFrames')
-            if type(travelerDataFrames) == list:
-                tdfs = [i.get('TravelerDataFrame') for i in travelerDataFrames if i.get('TravelerDataFrame')]
-                if len(tdfs) != len(travelerDataFrames):
-                    print('travelerDataFrames discrepancy: {} -> {}'.format(len(travelerDataFrames), len(tdfs)))
-            elif type(travelerDataFrames) == dict:
-                travelerDataFramesOpt1 = travelerDataFrames.get('TravelerDataFrame')
-                travelerDataFramesOpt2 = travelerDataFrames.get('dataFrames', {}).get('TravelerDataFrame')
-                tdfs = travelerDataFramesOpt1 or travelerDataFramesOpt2
-                if type(tdfs) != list:
-                    tdfs = [tdfs]
+            print('No Traveler DataFrame found in this: {}'.format(travelerDataFrames))
+            return [self.process(raw_rec)]
+
+        plan = self.get_record_plan()
+        before, after, prefix = self.flatten_around(raw_rec, self.dataFrames_path, self.json_string_fields, plan=plan)
+        tdf_prefix = prefix + 'dataFrames_TravelerDataFrame_'
+        out_recs = []
+        for tdf in tdfs:
+            GeographicalPath = tdf.get('regions', {}).get('GeographicalPath')
+            if type(GeographicalPath) == list:
+                tdf_recs = self.flatten_split(tdf, ['regions', 'GeographicalPath'], GeographicalPath,
+                                              self.json_string_fields, tdf_prefix, plan)
             else:
-                print('No Traveler DataFrame found in this: {}'.format(travelerDataFrames))
-                return [self.process(raw_rec)]
-
-            for tdf in tdfs:
-                GeographicalPath = copy.deepcopy(tdf.get('regions', {}).get('GeographicalPath'))
-                if type(GeographicalPath) == list:
-                    for path in GeographicalPath:
-                        tdf['regions']['GeographicalPath'] = path
-
-                        temp_rec = copy.deepcopy(raw_rec)
-                        temp_rec['payload']['data']['MessageFrame']['value']['TravelerInformation']['dataFrames'] = {}
-                        temp_rec['payload']['data']['MessageFrame']['value']['TravelerInformation']['dataFrames']['TravelerDataFrame'] = tdf
-                        out_recs.append(temp_rec)
-                else:
-                    temp_rec = copy.deepcopy(raw_rec)
-                    temp_rec['payload']['data']['MessageFrame']['value']['TravelerInformation']['dataFrames'] = {}
-                    temp_rec['payload']['data']['MessageFrame']['value']['TravelerInformation']['dataFrames']['TravelerDataFrame'] = tdf
-                    out_recs.append(temp_rec)
-
-        return [self.process(out_rec) for out_rec in out_recs if out_rec]
+                tdf_recs = [self.flatten_dict({'dataFrames': {'TravelerDataFrame': tdf}}, self.json_string_fields, prefix, plan=plan)]
+
+            for tdf_rec in tdf_recs:
+                out = dict(before)
+                out.update(tdf_rec)
+                out.update(after)
+                out_recs.append(self.process_flat(out))
+
+        return out_recs
@@ -0,0 +1,112 @@
+'''
+JSON encoding and decoding shared by the mover, exporter, flatteners and
+Socrata helpers. Uses orjson when it is installed and the standard library
+json module otherwise.
+
+- loads: decodes to the same objects with either backend
+- dumps: output identical to json.dumps, for files and fields where the exact
+format is kept (S3 data lake records, exported json, json string fields)
+- dumps_compact: compact utf-8 bytes, for payloads only read by a json parser
+(e.g. Socrata upserts)
+
+Run `python json_codec.py` for a micro-benchmark of each call site under
+each available backend.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+backend = 'orjson' if orjson else 'json'
+
+# orjson decodes integers above 64 bits as floats. Documents with a run of 20+
+# digits are found by mapping digits to b'0' and other bytes to b' '.
+digit_table = bytes(48 if 48 <= i <= 57 else 32 for i in range(256))
+long_digit_run = b'0'*20
+
+
+def loads(s):
+    '''
+    Decode a json document from str or bytes, with the same result as
+    json.loads. Documents orjson does not accept or decodes differently
+    (NaN, infinity, lone surrogates, integers above 64 bits) are decoded by
+    json.loads.
+    '''
+    if orjson:
+        s_bytes = s.encode('utf-8', 'surrogatepass') if type(s) == str else s
+        if long_digit_run not in s_bytes.translate(digit_table):
+            try:
+                return orjson.loads(s_bytes)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(s)
+
+
+def dumps(obj):
+    '''
+    Encode obj exactly as json.dumps(obj) does. orjson cannot produce this
+    format (separators, ascii escapes, float repr), so this is always json.dumps.
+    '''
+    return json.dumps(obj)
+
+
+def dumps_compact(obj):
+    '''
+    Encode obj as compact utf-8 json bytes, without whitespace or ascii escapes.
+    '''
+    if orjson:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+if __name__ == '__main__':
+    """
+    Micro-benchmark of the json call sites:
+    python json_codec.py
+    """
+    import timeit
+
+    rec = {
+        'metadata': {'recordGeneratedAt': '2019-09-16T12:34:56.789Z', 'recordGeneratedBy': 'OBU',
+                     'schemaVersion': 6, 'serialId': {'streamId': 'abc', 'bundleSize': 1, 'recordId': 2},
+                     'receivedMessageDetails': {'locationData': {'latitude': '41.1', 'longitude': '-104.8'}}},
+        'payload': {'data': {'coreData': {'msgCnt': 12, 'id': 'ABCD', 'secMark': 34567, 'speed': 20.1,
+                                          'position': {'latitude': 41.123456, 'longitude': -104.876543},
+                                          'accelSet': {'accelLat': 0, 'accelLong': 0.1, 'accelYaw': 0}},
+                             'partII': [{'id': 'VEHICLESAFETYEXT', 'value': {'pathHistory': {'crumbData': [
+                                 {'elevationOffset': 1, 'latOffset': 2, 'lonOffset': 3, 'timeOffset': 4}]*3}}}]}}}
+    line = json.dumps(rec)
+    socrata_recs = [{'metadata_recordGeneratedAt': '2019-09-16T12:34:56.789', 'coreData_speed': 20.1,
+                     'coreData_id': 'ABCD', 'coreData_position': 'POINT (-104.876543 41.123456)'}]*1000
+
+    call_sites = [
+        ('read newline json record (S3FileMover.newline_json_rec_generator)', [
+            ('json', lambda: json.loads(line)),
+            ('orjson', orjson and (lambda: loads(line)))]),
+        ('write lake record / exported json (write_recs, JsonNewlineWriter)', [
+            ('json', lambda: json.dumps(rec)),
+            ('orjson', None)]),
+        ('json string field (DataFlattener.flatten_dict)', [
+            ('json', lambda: json.dumps(rec['payload']['data']['partII'])),
+            ('orjson', None)]),
+        ('Socrata upsert payload of 1000 records (SocrataDataset.clean_and_upsert)', [
+            ('json', lambda: json.dumps(socrata_recs, separators=(',', ':'), ensure_ascii=False).encode('utf-8')),
+            ('orjson', orjson and (lambda: orjson.dumps(socrata_recs)))]),
+    ]
+    print('Backend in use: {}'.format(backend))
+    for call_site, funcs in call_sites:
+        print(call_site)
+        for name, func in funcs:
+            if func is None:
+                print('  {:<8} n/a (not installed or output format differs)'.format(name))
+                continue
+            number, total = 1, 0
+            while total < 0.2:
+                number *= 10
+                total = timeit.timeit(func, number=number)
+            print('  {:<8} {:.1f} us'.format(name, total/number*1e6))
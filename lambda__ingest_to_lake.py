@@ -23,6 +23,11 @@ SOURCE_KEY_PREFIX = os.environ['SOURCE_KEY_PREFIX'] or ""
 VALIDATION_QUEUE_NAME = os.environ['VALIDATION_QUEUE_NAME'] or None
 if VALIDATION_QUEUE_NAME:
     VALIDATION_QUEUE_NAME = [i.strip() for i in VALIDATION_QUEUE_NAME.split(',')]
+SPOOL_MEMORY_MB = float(os.environ.get('SPOOL_MEMORY_MB', 64))
+MULTIPART_CHUNK_MB = float(os.environ.get('MULTIPART_CHUNK_MB', 16))
+UPLOAD_THREADS = int(os.environ.get('UPLOAD_THREADS', 8))
+# write the original bytes of each record instead of re-encoding them
+PASSTHROUGH = os.environ.get('PASSTHROUGH', '').lower() in ['true', '1', 'yes']
 
 
 def lambda_handler(event, context):
@@ -31,7 +36,12 @@ def lambda_handler(event, context):
     mover = CvPilotFileMover(target_bucket=TARGET_BUCKET,
                              source_bucket_prefix=SOURCE_BUCKET_PREFIX,
                              source_key_prefix=SOURCE_KEY_PREFIX,
-                             validation_queue_names=VALIDATION_QUEUE_NAME)
+                             validation_queue_names=VALIDATION_QUEUE_NAME,
+                             spool_memory_mb=SPOOL_MEMORY_MB,
+                             multipart_chunk_mb=MULTIPART_CHUNK_MB,
+                             spool_dir='/tmp',
+                             upload_threads=UPLOAD_THREADS,
+                             passthrough=PASSTHROUGH)
 
     for bucket, key in mover.get_fps_from_event(event):
         try:
@@ -1,18 +1,34 @@
 """
 Flatten records from ITS Sandbox S3 bucket and upsert to Socrata.
 
+Files are scheduled within the time limit of each invocation. Files that are
+left over, including one paused at the exact line it reached, are handed to a
+continuation of the same work (same Socrata draft), sent to this function or
+to an SQS queue triggering it.
+
+With FANOUT_WORKERS above 1, the scheduled rebuild is fanned out: the
+invocation triggered by the schedule (coordinator) creates the draft, splits
+the files into shards of about equal size and sends each shard to a worker
+invocation. Workers upsert to the draft in parallel and leave a done marker
+under CONTINUATION_S3_URI, and the coordinator publishes the draft once every
+shard is done.
+
 """
 
 from __future__ import print_function
 
+import boto3
 from datetime import datetime, timedelta
+import json
 import logging
 import os
+import time
 import traceback
 
 from s3_file_mover import CvPilotFileMover
 from socrata_util import SocrataDataset
-from flattener import load_flattener
+from flattener import load_flattener, timestamp_parser
+from time_budget import TimeBudgetScheduler
 
 
 logger = logging.getLogger()
@@ -29,6 +45,19 @@ SOCRATA_DATASET_ID = os.environ.get('SOCRATA_DATASET_ID')
 S3_SOURCE_BUCKET = os.environ.get('S3_SOURCE_BUCKET', '')
 S3_SOURCE_PREFIX = os.environ.get('S3_SOURCE_PREFIX', '')
 NUM_HOURS_BACKTRACK = int(os.environ.get('NUM_HOURS_BACKTRACK', 48))
+# number of concurrent upsert requests to Socrata
+UPSERT_THREADS = int(os.environ.get('UPSERT_THREADS', 4))
+# records of small files are upserted together once at least this many are flattened
+UPSERT_BATCH_RECS = int(os.environ.get('UPSERT_BATCH_RECS', 10000))
+# continuations are sent to this SQS queue if set, or else invoke this function asynchronously
+CONTINUATION_QUEUE_URL = os.environ.get('CONTINUATION_QUEUE_URL', '')
+# s3://bucket/prefix/ under which continuation states too large for an event
+# and the done markers of fanned out shards are stored
+CONTINUATION_S3_URI = os.environ.get('CONTINUATION_S3_URI', '')
+# number of worker invocations the scheduled rebuild is split into (1: no fan-out)
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 1))
+# the coordinator gives up waiting for shards after this many minutes, leaving the draft unpublished
+FANOUT_TIMEOUT_MINUTES = float(os.environ.get('FANOUT_TIMEOUT_MINUTES', 120))
 
 
 socrata_params = dict(
@@ -39,19 +68,146 @@ domain = SOCRATA_DOMAIN
 )
 
 skip_time_ms = 60*1000
+continuation_source = 'lake_to_socrata.continuation'
+# SQS messages and asynchronous invocation payloads are limited to 256 KB
+max_inline_state_bytes = 200*1024
+# seconds between checks of the coordinator for done shards
+fanout_poll_seconds = 10
 
 
-def lambda_handler(event, context):
+def split_s3_uri(s3_uri):
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def send_continuation(state, mover, context):
     '''
-    AWS Lambda handler.
+    Hand the state of unfinished work to a new invocation, through
+    CONTINUATION_QUEUE_URL or by invoking this function asynchronously. States
+    too large for an event are stored under CONTINUATION_S3_URI.
 
+    Returns:
+        True if the continuation was sent
+    '''
+    state_str = json.dumps(state)
+    if len(state_str) <= max_inline_state_bytes:
+        message = {'source': continuation_source, 'state': state}
+    elif CONTINUATION_S3_URI:
+        bucket, prefix = split_s3_uri(CONTINUATION_S3_URI)
+        key = '{}{}-{}-{}.json'.format(prefix, state['workingId'], state.get('shard', 'main'), state['invocation'])
+        mover.s3_client.put_object(Bucket=bucket, Key=key, Body=state_str.encode('utf-8'))
+        message = {'source': continuation_source, 'state_s3_uri': 's3://{}/{}'.format(bucket, key)}
+    else:
+        logger.error('Continuation state of {} files is {} bytes. Set CONTINUATION_S3_URI to hand over more than {} bytes.'.format(
+            len(state['tasks']), len(state_str), max_inline_state_bytes))
+        return False
 
+    if CONTINUATION_QUEUE_URL:
+        boto3.client('sqs').send_message(QueueUrl=CONTINUATION_QUEUE_URL, MessageBody=json.dumps(message))
+    else:
+        boto3.client('lambda').invoke(FunctionName=context.function_name, InvocationType='Event',
+                                      Payload=json.dumps(message))
+    logger.info('Handed {} files over to continuation {} of {}'.format(len(state['tasks']), state['invocation'], state['workingId']))
+    return True
+
+
+def load_continuation(message, mover):
+    if 'state_s3_uri' in message:
+        bucket, key = split_s3_uri(message['state_s3_uri'])
+        state = json.loads(mover.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        mover.s3_client.delete_object(Bucket=bucket, Key=key)
+        return state
+    return message['state']
+
+
+def split_shards(tasks, num_shards):
     '''
-    mover = CvPilotFileMover()
-    so_ingestor = SocrataDataset(
-        dataset_id=SOCRATA_DATASET_ID,
-        socrata_params=socrata_params,
-        float_fields=['randomNum', 'metadata_generatedAt_timeOfDay'])
+    Split tasks into at most num_shards shards of about equal cost, counting
+    the size of each file plus the bytes it takes as long to process as the
+    fixed cost of a file. Tasks keep their order within each shard.
+
+    Returns:
+        list of lists of tasks
+    '''
+    file_overhead_bytes = TimeBudgetScheduler.file_overhead_seconds*TimeBudgetScheduler.default_bytes_per_second
+    shard_idxs = [[] for _ in range(min(num_shards, len(tasks)))]
+    shard_bytes = [0]*len(shard_idxs)
+    # largest files first, each to the shard with the fewest bytes so far
+    for idx in sorted(range(len(tasks)), key=lambda i: -tasks[i]['size']):
+        shard = shard_bytes.index(min(shard_bytes))
+        shard_idxs[shard].append(idx)
+        shard_bytes[shard] += tasks[idx]['size'] + file_overhead_bytes
+    return [[tasks[idx] for idx in sorted(idxs)] for idxs in shard_idxs]
+
+
+def fan_out(workingId, tasks, mover, context):
+    '''
+    Send each shard of tasks to a worker invocation that upserts to workingId.
+
+    Returns:
+        state of the coordinator, which waits for the shards to be done
+    '''
+    shards = split_shards(tasks, FANOUT_WORKERS)
+    for idx, shard in enumerate(shards):
+        send_continuation({'workingId': workingId, 'overwrite': False, 'count': 0, 'tasks': shard,
+                           'invocation': 0, 'shard': idx}, mover, context)
+    logger.info('Fanned {} files out to {} workers'.format(len(tasks), len(shards)))
+    return {'workingId': workingId, 'overwrite': True, 'count': 0, 'tasks': [], 'invocation': 0,
+            'num_shards': len(shards), 'started_at': time.time()}
+
+
+def get_shard_prefix(workingId):
+    bucket, prefix = split_s3_uri(CONTINUATION_S3_URI)
+    return bucket, '{}{}/shards/'.format(prefix, workingId)
+
+
+def report_shard_done(state, mover):
+    bucket, prefix = get_shard_prefix(state['workingId'])
+    mover.s3_client.put_object(Bucket=bucket, Key='{}{}.json'.format(prefix, state['shard']),
+                               Body=json.dumps({'count': state['count']}).encode('utf-8'))
+    logger.info('Shard {} of {} done: {} records'.format(state['shard'], state['workingId'], state['count']))
+
+
+def wait_for_shards(state, mover, context):
+    '''
+    Wait for the done markers of all shards of the coordinator state. If the
+    invocation runs out of time first, waiting is handed over to a
+    continuation.
+
+    Returns:
+        number of records upserted by all shards, or None if they are not all
+        done in this invocation
+    '''
+    bucket, prefix = get_shard_prefix(state['workingId'])
+    while True:
+        objects = mover.get_objects_from_prefix(bucket, prefix)
+        if len(objects) >= state['num_shards']:
+            count = 0
+            for obj in objects:
+                count += json.loads(mover.s3_client.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read())['count']
+                mover.s3_client.delete_object(Bucket=bucket, Key=obj['Key'])
+            return count
+        if time.time() - state['started_at'] > FANOUT_TIMEOUT_MINUTES*60:
+            logger.error('Only {} of {} shards of {} were done after {} minutes. The draft is not published.'.format(
+                len(objects), state['num_shards'], state['workingId'], FANOUT_TIMEOUT_MINUTES))
+            return None
+        if context.get_remaining_time_in_millis() < skip_time_ms + fanout_poll_seconds*1000:
+            send_continuation(state, mover, context)
+            return None
+        time.sleep(fanout_poll_seconds)
+
+
+def get_states(event, mover, so_ingestor, context):
+    '''
+    Returns:
+        list of states of work to do: Socrata data set or draft to upsert to,
+        whether to publish it when done, number of records upserted so far and
+        tasks of the files to process (see TimeBudgetScheduler)
+    '''
+    if event.get('source') == continuation_source:
+        return [load_continuation(event, mover)]
+    if event.get('Records') and event['Records'][0].get('eventSource') == 'aws:sqs':
+        return [load_continuation(json.loads(r['body']), mover) for r in event['Records']]
 
     if event.get('source') == 'aws.events':
         overwrite = True
@@ -60,46 +216,123 @@ def lambda_handler(event, context):
         source_ymdh = datetime.today() - timedelta(hours=NUM_HOURS_BACKTRACK)
         y,m,d = source_ymdh.strftime('%Y-%m-%d').split('-')
         formatted_source_prefix = S3_SOURCE_PREFIX.format(y,m,d)
-        bucket_key_tuples = mover.get_fps_from_prefix(bucket=S3_SOURCE_BUCKET, prefix=formatted_source_prefix, limit=10000)
-        logger.info('Lambda triggered by scheduled event. Retrieved {} file paths from s3://{}/{}'.format(len(bucket_key_tuples), S3_SOURCE_BUCKET, formatted_source_prefix))
+        tasks = [TimeBudgetScheduler.make_task(S3_SOURCE_BUCKET, obj['Key'], obj['Size'])
+                 for obj in mover.iter_objects_from_prefix(bucket=S3_SOURCE_BUCKET, prefix=formatted_source_prefix, limit=10000)]
+        logger.info('Lambda triggered by scheduled event. Retrieved {} file paths from s3://{}/{}'.format(len(tasks), S3_SOURCE_BUCKET, formatted_source_prefix))
+        if FANOUT_WORKERS > 1 and len(tasks) > 1:
+            if CONTINUATION_S3_URI:
+                return [fan_out(workingId, tasks, mover, context)]
+            logger.warning('FANOUT_WORKERS is {} but CONTINUATION_S3_URI is not set. Processing files in this invocation.'.format(FANOUT_WORKERS))
     else:
         # s3 triggered
         overwrite = False
         workingId = SOCRATA_DATASET_ID
-        bucket_key_tuples = mover.get_fps_from_event(event)
-        logger.info('Lambda triggered by uploaded s3 object. Retrieved {} file paths from event'.format(len(bucket_key_tuples)))
-
-    count = 0
-    for bucket, key in bucket_key_tuples:
-        flattenerMod = load_flattener(key)
-        flattener = flattenerMod()
-
-        recs = []
-        err_recs = []
-        stream = mover.get_data_stream(bucket, key)
-        for r in mover.newline_json_rec_generator(stream):
+        sizes = {(e['s3']['bucket']['name'], e['s3']['object']['key']): e['s3']['object'].get('size', 0) for e in event['Records']}
+        tasks = [TimeBudgetScheduler.make_task(bucket, key, sizes.get((bucket, key), 0))
+                 for bucket, key in mover.get_fps_from_event(event)]
+        logger.info('Lambda triggered by uploaded s3 object. Retrieved {} file paths from event'.format(len(tasks)))
+    return [{'workingId': workingId, 'overwrite': overwrite, 'count': 0, 'tasks': tasks, 'invocation': 0}]
+
+
+def lambda_handler(event, context):
+    '''
+    AWS Lambda handler.
+
+
+    '''
+    mover = CvPilotFileMover()
+    so_ingestor = SocrataDataset(
+        dataset_id=SOCRATA_DATASET_ID,
+        socrata_params=socrata_params,
+        float_fields=['randomNum', 'metadata_generatedAt_timeOfDay'],
+        upsert_threads=UPSERT_THREADS)
+
+    # one flattener per message type, only flattening the columns of the data set
+    flatteners = {}
+    for state in get_states(event, mover, so_ingestor, context):
+        process_state(state, mover, so_ingestor, flatteners, context)
+
+    logger.info('Timestamps parsed: {hits} by fast parser, {fallbacks} by dateutil fallback'.format(**timestamp_parser.get_stats()))
+    logger.info('Processed events')
+
+
+def process_state(state, mover, so_ingestor, flatteners, context):
+    '''
+    Process the files of a state that fit in the remaining time, then either
+    hand the rest over to a continuation or, when all files are done, publish
+    the draft of an overwrite. A worker reports its shard done instead, and
+    the coordinator (a state without files) waits for all shards first.
+    '''
+    workingId = state['workingId']
+    scheduler = TimeBudgetScheduler(state['tasks'], state.get('bytes_per_second'))
+    count = state['count']
+    recs = []
+    while True:
+        task = scheduler.next_task((context.get_remaining_time_in_millis() - skip_time_ms)/1000.0)
+        if task is None:
+            break
+        t0 = time.time()
+        flattenerMod = load_flattener(task['key'])
+        flattener = flatteners.get(flattenerMod)
+        if flattener is None:
+            flattener = flattenerMod()
+            flattener.set_columns(so_ingestor.col_dtype_dict)
+            flatteners[flattenerMod] = flattener
+
+        # lines before offset were processed and upserted by a previous invocation
+        offset = task['offset']
+        finished = True
+        stream = mover.get_data_stream(task['bucket'], task['key'])
+        for line_offset, r in mover.iter_json_recs_from_offset(stream, offset):
+            if context.get_remaining_time_in_millis() < skip_time_ms:
+                finished = False
+                break
             try:
-                recs += flattener.process_and_split(r)
+                # records are coerced as soon as they are flattened, so only
+                # the columns of the data set are buffered
+                recs += so_ingestor.mod_dtypes(flattener.process_and_split(r))
             except:
-                logger.error("Error while transforming record: {}".format(event))
+                logger.error("Error while transforming record at line {} of s3://{}/{}".format(line_offset, task['bucket'], task['key']))
                 logger.error(traceback.format_exc())
-                err_recs.append(r)
+            offset = line_offset
 
-            if context.get_remaining_time_in_millis() < skip_time_ms:
-                break
+        # records are upserted before the offset is handed over
+        if recs and (len(recs) >= UPSERT_BATCH_RECS or not finished):
+            response = so_ingestor.upsert(recs, workingId)
+            count += len(recs)
+            logger.info(response)
+            recs = []
+        scheduler.record(stream.bytes_read - task['bytes_done'], time.time() - t0)
+        if not finished:
+            scheduler.pause(task, offset, stream.bytes_read)
+            logger.info('Paused s3://{}/{} after line {}'.format(task['bucket'], task['key'], offset))
+            break
+        scheduler.finish(task)
 
-        response = so_ingestor.clean_and_upsert(recs, workingId)
+    if recs:
+        response = so_ingestor.upsert(recs, workingId)
         count += len(recs)
         logger.info(response)
-        if context.get_remaining_time_in_millis() < skip_time_ms:
-            logger.info('Not able to finish ingesting all files within lambda time limit. Skipping to publishing.')
-            break
+    logger.info('Scheduler: {}'.format(scheduler.get_stats()))
+
+    next_state = dict(state, count=count, invocation=state['invocation']+1, **scheduler.get_state())
+    if next_state['tasks']:
+        if not send_continuation(next_state, mover, context):
+            logger.error('Could not hand {} files of {} over to a continuation. The draft is not published.'.format(
+                len(next_state['tasks']), workingId))
+        return
+
+    if 'shard' in state:
+        report_shard_done(next_state, mover)
+        return
+    if 'num_shards' in state:
+        count = wait_for_shards(next_state, mover, context)
+        if count is None:
+            return
 
     # publish draft if this is an overwrite
-    if overwrite is True:
+    if state['overwrite'] is True:
         if count > 0:
             so_ingestor.publish_draft(workingId)
         else:
             so_ingestor.delete_draft(workingId)
-
-    logger.info('Processed events')
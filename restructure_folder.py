@@ -3,9 +3,17 @@ Folder Restructure utility script
 """
 from argparse import ArgumentParser
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import math
+from queue import Queue
+import random
+import threading
 import traceback
 import time
 
+import json_codec
 from s3_file_mover import CvPilotFileMover
 
 
@@ -23,21 +31,52 @@ s3_credentials = {}
 
 
 class FolderRestructurer(object):
+    # seconds to wait before the first retry of a key, doubled for each further retry
+    retry_delay = 1
 
-    def __init__(self, bucket, folder='wydot/BSM', startKey='', source_bucket_prefix="usdot-its-datahub-", outfp=None, infp=None):
+    def __init__(self, bucket, folder='wydot/BSM', startKey='', source_bucket_prefix="usdot-its-datahub-", outfp=None, infp=None,
+                 workers=1, max_retries=3, ledger_fp='restructure_failures.csv', progress_interval=60,
+                 dry_run=False, sample=0):
         # set up
-        s3botoclient = boto3.client('s3', **s3_credentials)
-        self.mover = CvPilotFileMover(target_bucket=bucket,
-                                 source_bucket_prefix="",
-                                 source_key_prefix="",
-                                 validation_queue_name=None,
-                                 log=False,
-                                 s3_client=s3botoclient)
         self.bucket = bucket
         self.folder = folder
         self.startKey = startKey
         self.infp = infp
         self.outfp = outfp
+        self.workers = workers
+        self.max_retries = max_retries
+        self.ledger_fp = ledger_fp
+        self.progress_interval = progress_interval
+        self.dry_run = dry_run
+        self.sample = sample
+        # each worker thread moves files and uploads their partitions concurrently
+        self.s3botoclient = boto3.client('s3', config=Config(max_pool_connections=max(10, 4*workers)), **s3_credentials)
+        self.mover = self.create_mover()
+        self.local = threading.local()
+        self.ledger_lock = threading.Lock()
+        self.stats = {'moved': 0, 'skipped': 0, 'missing': 0, 'failed': 0}
+        # keys listed so far by iter_keys_from_s3, and whether the listing is complete
+        self.numkeys_listed = None
+        self.listing_done = False
+
+    def create_mover(self):
+        mover = CvPilotFileMover(target_bucket=self.bucket,
+                                 source_bucket_prefix="",
+                                 source_key_prefix="",
+                                 validation_queue_names=None,
+                                 deterministic_names=True,
+                                 log=False,
+                                 s3_client=self.s3botoclient)
+        if self.dry_run:
+            # the plan reports totals instead of the mover's message for each file
+            mover.print_func = lambda *args: None
+        return mover
+
+    def get_mover(self):
+        # the mover counts the invalid lines of the file it moves, so each thread has its own
+        if not hasattr(self.local, 'mover'):
+            self.local.mover = self.create_mover()
+        return self.local.mover
 
     def filter_by_startKey(self, keys):
         if self.startKey:
@@ -45,6 +84,40 @@ class FolderRestructurer(object):
             print('Processing {} keys after start key of {}'.format(len(keys), self.startKey))
         return keys
 
+    def list_keys_to_queue(self, key_queue):
+        numkeys = 0
+        try:
+            for k in self.mover.iter_fps_from_prefix(self.bucket, self.folder):
+                numkeys += 1
+                if not self.startKey or k[1] >= self.startKey:
+                    key_queue.put(k)
+                    self.numkeys_listed += 1
+            print('{} keys retrieved from s3://{}/{}'.format(numkeys, self.bucket, self.folder))
+        except Exception as e:
+            key_queue.put(e)
+        self.listing_done = True
+        key_queue.put(None)
+
+    def iter_keys_from_s3(self):
+        '''
+        Yield keys from s3 as they are listed, so that processing can start
+        before the listing of the folder finishes. The folder is listed ahead
+        on a background thread, which counts the keys listed so far, so that
+        progress reports can estimate the keys left.
+        '''
+        if self.startKey:
+            print('Processing keys after start key of {}'.format(self.startKey))
+        self.numkeys_listed = 0
+        key_queue = Queue()
+        threading.Thread(target=self.list_keys_to_queue, args=(key_queue,), daemon=True).start()
+        while True:
+            k = key_queue.get()
+            if k is None:
+                return
+            if isinstance(k, Exception):
+                raise k
+            yield k
+
     def get_keys_from_s3(self):
         keys = self.mover.get_fps_from_prefix(self.bucket, self.folder)
         print('{} keys retrieved from s3://{}/{}'.format(len(keys), self.bucket, self.folder))
@@ -65,42 +138,234 @@ class FolderRestructurer(object):
         with open(fp, 'r') as infile:
             data = infile.read()
         data = data.splitlines()
-        keys = [i.strip('\n').split(',') for i in data]
+        # a failure ledger holds an error after the bucket and key of each line
+        keys = [tuple(i.strip('\n').split(',')[:2]) for i in data]
         print('{} keys retrieved from {}'.format(len(keys), fp))
         keysFiltered = self.filter_by_startKey(keys)
         return keysFiltered
 
+    def restructure_key(self, sb, sk):
+        '''
+        Move a file, retrying up to max_retries times with exponential backoff.
+        Output file names are derived from the source key, so a retry overwrites
+        the files written by a failed attempt.
+
+        Returns:
+            'moved', 'skipped' if the file is already restructured, or 'missing'
+            if it no longer exists (e.g. moved by an earlier run)
+        '''
+        mover = self.get_mover()
+        if sb == self.bucket and mover.is_restructured_key(sk):
+            return 'skipped'
+        for attempt in range(self.max_retries+1):
+            try:
+                target_keys = mover.move_file(sb, sk)
+                return 'moved' if target_keys is not None else 'skipped'
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                    return 'missing'
+                if attempt == self.max_retries:
+                    raise
+                print('Retrying s3://{}/{} after error: {}'.format(sb, sk, e))
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                print('Retrying s3://{}/{} after error: {}'.format(sb, sk, e))
+            time.sleep(self.retry_delay*2**attempt)
+
+    def add_to_ledger(self, sb, sk, error):
+        error_str = '{}: {}'.format(type(error).__name__, error).replace(',', ';').replace('\n', ' ')
+        with self.ledger_lock:
+            with open(self.ledger_fp, 'a') as outfile:
+                outfile.write('{},{},{}\n'.format(sb, sk, error_str))
+
+    def report_progress(self, t0, numkeys=None):
+        '''
+        Print the keys processed so far, and the keys left with an ETA. Without
+        numkeys, the keys left are counted from the keys listed so far, as lower
+        bounds while the folder is still being listed.
+        '''
+        done = sum(self.stats.values())
+        elapsed = time.time() - t0
+        rate = done/max(elapsed, 1e-6)
+        msg = '{} keys processed ({moved} moved, {skipped} skipped, {missing} missing, {failed} failed) in {:.1f} min, {:.2f} keys/s'.format(
+            done, elapsed/60, rate, **self.stats)
+        listing = numkeys is None and not self.listing_done
+        if numkeys is None:
+            numkeys = self.numkeys_listed
+        if numkeys is not None:
+            msg += ', {}{} left'.format('at least ' if listing else '', numkeys-done)
+            if rate > 0:
+                msg += ', ETA {}{:.1f} min'.format('over ' if listing else '', (numkeys-done)/rate/60)
+            if listing:
+                msg += ' (folder still being listed)'
+        print(msg)
+
+    def plan_key(self, sb, sk):
+        '''
+        Read and decode a file the way move_file does, getting the generatedAt
+        hour of each record, without writing or deleting anything. The bytes of
+        each record are counted as move_file writes them: re-encoded with
+        json_codec, or the original line if the mover passes lines through.
+
+        Returns:
+            action move_file would take ('correct', 'empty', 'move' or 'split'),
+            dictionary of bytes written to each hour, and number of invalid lines
+        '''
+        mover = self.get_mover()
+        num_err_lines = mover.num_err_lines
+        hour_bytes = {}
+
+        def add(ymdh, numbytes):
+            # records of an hour are written one per line
+            hour_bytes[ymdh] = hour_bytes.get(ymdh, 0) + numbytes + (1 if ymdh in hour_bytes else 0)
+
+        if mover.passthrough:
+            for line in mover.newline_raw_rec_generator(mover.get_raw_data_stream(sb, sk)):
+                ymdh = mover.get_ymdh_from_line(line)
+                if ymdh:
+                    add(ymdh, len(line))
+        else:
+            for rec in mover.newline_json_rec_generator(mover.get_data_stream(sb, sk)):
+                add(mover.get_ymdh(rec), len(json_codec.dumps(rec).encode('utf-8')))
+        invalid_lines = mover.num_err_lines - num_err_lines
+        if mover.generate_outfp(hour_bytes, sb, sk) is None:
+            action = 'empty' if not hour_bytes else 'correct'
+        else:
+            action = 'split' if len(hour_bytes) > 1 else 'move'
+        return action, hour_bytes, invalid_lines
+
+    def try_plan_key(self, obj):
+        try:
+            return self.plan_key(self.bucket, obj['Key'])
+        except:
+            print(traceback.format_exc())
+            print('Failed to scan s3://{}/{}'.format(self.bucket, obj['Key']))
+            return 'error', {}, 0
+
+    def plan(self):
+        '''
+        Dry run: list the folder, scan all files or a random sample of sample
+        files, and report what a run would do with an estimate of the bytes and
+        S3 requests it takes. Estimates are extrapolated from the sample.
+        '''
+        t0 = time.time()
+        objects = [obj for obj in self.mover.iter_objects_from_prefix(self.bucket, self.folder)
+                   if not self.startKey or obj['Key'] >= self.startKey]
+        to_scan = [obj for obj in objects if not self.mover.is_restructured_key(obj['Key'])]
+        sample = to_scan
+        if self.sample and self.sample < len(to_scan):
+            sample = sorted(random.Random(0).sample(to_scan, self.sample), key=lambda obj: obj['Key'])
+        print('{} keys retrieved from s3://{}/{}. Scanning {} of {} files not restructured yet with {} workers'.format(
+            len(objects), self.bucket, self.folder, len(sample), len(to_scan), self.workers))
+
+        t1 = time.time()
+        counts = {'correct': 0, 'empty': 0, 'move': 0, 'split': 0, 'error': 0}
+        split_hours = 0
+        invalid_files = 0
+        write_bytes = 0
+        puts = 0
+        deletes = 0
+        chunk_size = self.mover.multipart_chunk_size
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for idx in range(0, len(sample), 1000):
+                for action, hour_bytes, invalid_lines in executor.map(self.try_plan_key, sample[idx:idx+1000]):
+                    counts[action] += 1
+                    if action == 'split':
+                        split_hours += len(hour_bytes)
+                    if action in ('move', 'split'):
+                        write_bytes += sum(hour_bytes.values())
+                        # one put per file, or create, parts and complete of a multipart upload
+                        puts += sum(1 if b <= chunk_size else 2+int(math.ceil(b/float(chunk_size))) for b in hour_bytes.values())
+                        if invalid_lines:
+                            invalid_files += 1
+                        else:
+                            deletes += 1
+        t2 = time.time()
+
+        sample_bytes = sum(obj['Size'] for obj in sample)
+        scan_bytes = sum(obj['Size'] for obj in to_scan)
+        scale = len(to_scan)/float(len(sample)) if sample else 0
+        bytes_scale = scan_bytes/float(sample_bytes) if sample_bytes else 0
+        print('===========PLAN===========')
+        print('{} files, {:.1f} MB under s3://{}/{}'.format(len(objects), sum(obj['Size'] for obj in objects)/1e6, self.bucket, self.folder))
+        print('{} files already restructured, recognized by name without reading them'.format(len(objects)-len(to_scan)))
+        if len(sample) < len(to_scan):
+            print('{} of {} other files scanned. Numbers below are extrapolated from the sample.'.format(len(sample), len(to_scan)))
+        print('{:.0f} files already in the folder of their hour'.format(counts['correct']*scale))
+        print('{:.0f} files empty'.format(counts['empty']*scale))
+        print('{:.0f} files to move to another hour folder'.format(counts['move']*scale))
+        print('{:.0f} files to split into several hour folders, {:.1f} hours per file on average'.format(
+            counts['split']*scale, split_hours/float(counts['split']) if counts['split'] else 0))
+        print('{:.0f} files with invalid lines, kept after being moved'.format(invalid_files*scale))
+        if counts['error']:
+            print('{:.0f} files failed to be scanned'.format(counts['error']*scale))
+        print('Estimated bytes read: {:.1f} MB, written: {:.1f} MB'.format(scan_bytes/1e6, write_bytes*bytes_scale/1e6))
+        print('Estimated requests: {} LIST, {} GET, {:.0f} PUT, {:.0f} DELETE'.format(
+            max(1, int(math.ceil(len(objects)/1000.0))), len(to_scan), puts*scale, deletes*scale))
+        print('Listed in {:.1f} s. Scanned {:.1f} MB in {:.1f} s with {} workers ({:.1f} MB/s)'.format(
+            t1-t0, sample_bytes/1e6, t2-t1, self.workers, sample_bytes/1e6/max(t2-t1, 1e-6)))
+        print('==========================')
+
     def run(self):
+        if self.dry_run:
+            self.plan()
+            return
+
         # get fp
         if self.infp:
             keysFiltered = self.get_keys_from_fp(self.infp)
-        else:
+        elif self.outfp:
+            # list the whole folder first, to write all keys to outfp
             keysFiltered = self.get_keys_from_s3()
+        else:
+            keysFiltered = self.iter_keys_from_s3()
+        numkeys = len(keysFiltered) if isinstance(keysFiltered, list) else None
 
-        # move files
+        # move files on the worker threads, keeping at most 2 keys per worker in flight
         t0 = time.time()
-        count = 0
-        for idx, tup in enumerate(keysFiltered):
-            try:
-                sb,sk = tup
-                self.mover.move_file(sb, sk)
-                count += 1
-            except:
-                print(traceback.format_exc())
-                print('Process stopped at idx: {}'.format(idx))
-                print('======================================')
-                print('To continue running this script on the rest of the folder, specifiy the followng --startKey for your next run:\n{}\n'.format(sk))
-                print('======================================')
-                break
+        last_report = t0
+        keys = iter(keysFiltered)
+        inflight = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                while len(inflight) < 2*self.workers:
+                    tup = next(keys, None)
+                    if tup is None:
+                        break
+                    inflight[executor.submit(self.restructure_key, *tup)] = tup
+                if not inflight:
+                    break
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sb, sk = inflight.pop(future)
+                    error = future.exception()
+                    if error:
+                        print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                        print('Failed to restructure s3://{}/{}. Added to {}'.format(sb, sk, self.ledger_fp))
+                        self.add_to_ledger(sb, sk, error)
+                        self.stats['failed'] += 1
+                    else:
+                        self.stats[future.result()] += 1
+                if time.time() - last_report >= self.progress_interval:
+                    self.report_progress(t0, numkeys)
+                    last_report = time.time()
 
         t1 = time.time()
-        print('{} fps re-orged in {} hr'.format(count, (t1-t0)/3600))
+        self.report_progress(t0, numkeys)
+        print('{} fps re-orged in {} hr'.format(self.stats['moved'], (t1-t0)/3600))
+        if self.stats['failed']:
+            print('======================================')
+            print('{} keys failed after {} retries and were written to {}. To retry them, run this script with:\n--infp {}\n'.format(self.stats['failed'], self.max_retries, self.ledger_fp, self.ledger_fp))
+            print('======================================')
 
 
 if __name__ == '__main__':
     """
     Sample Usage
     python -u restructure_folder.py --bucket usdot-its-cvpilot-public-data --bucket_prefix usdot-its-datahub- --folder wydot/BSM/2019/
+    python -u restructure_folder.py --bucket usdot-its-cvpilot-public-data --bucket_prefix usdot-its-datahub- --folder wydot/BSM/2019/ --workers 16
+    python -u restructure_folder.py --bucket usdot-its-cvpilot-public-data --folder wydot/BSM/2019/ --plan --sample 1000 --workers 16
     """
 
     parser = ArgumentParser(description="Script for reorganizing a folder based on generatedAt timestamp field")
@@ -110,9 +375,17 @@ if __name__ == '__main__':
     parser.add_argument('--startKey', default=None, help="Start Key - provide this only if you'd like to organize only keys after the specified key.")
     parser.add_argument('--infp', default=None, help="Supply fp if you'd like to read keys to process from the file path.")
     parser.add_argument('--outfp', default=None, help="Supply fp if you'd like to write the keys to process to a file.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of files restructured concurrently. Default: 1")
+    parser.add_argument('--max_retries', type=int, default=3, help="Number of retries of a file that fails to be restructured, with exponential backoff. Default: 3")
+    parser.add_argument('--ledger', default='restructure_failures.csv', help="File that keys failing after all retries are appended to. Supply it as --infp to retry them. Default: restructure_failures.csv")
+    parser.add_argument('--progress_interval', type=float, default=60, help="Seconds between progress reports. Default: 60")
+    parser.add_argument('--plan', default=False, action='store_true', help="Supply flag to only report what would be restructured in the folder, with estimated bytes and S3 requests, without writing or deleting anything. Default: False")
+    parser.add_argument('--sample', type=int, default=0, help="Number of randomly chosen files scanned by --plan, with the results extrapolated to the folder. Default: 0 (scan all files)")
     args = parser.parse_args()
     
-    folderRestructurer = FolderRestructurer(args.bucket, folder=args.folder, startKey=args.startKey, source_bucket_prefix=args.bucket_prefix, infp=args.infp, outfp=args.outfp)
+    folderRestructurer = FolderRestructurer(args.bucket, folder=args.folder, startKey=args.startKey, source_bucket_prefix=args.bucket_prefix, infp=args.infp, outfp=args.outfp,
+                                            workers=args.workers, max_retries=args.max_retries, ledger_fp=args.ledger, progress_interval=args.progress_interval,
+                                            dry_run=args.plan, sample=args.sample)
     folderRestructurer.run()
 
 
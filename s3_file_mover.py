@@ -7,30 +7,199 @@ from __future__ import print_function
 
 import logging
 import boto3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from gzip import GzipFile
-from io import TextIOWrapper
+from io import BytesIO
 import json
 import os
 import re
 import requests
+from tempfile import SpooledTemporaryFile
+import time
 import traceback
 import uuid
+import zlib
+
+import json_codec
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)  # necessary to make sure aws is logging
 
 
-class S3FileMover(object):
+def gunzip_blocks(blocks, max_block_size=1024*1024):
+    '''
+    Decompress an iterable of gzip data blocks, which may hold several
+    concatenated gzip members, with zlib.
+
+    Yields:
+        blocks of at most max_block_size decompressed bytes
+    '''
+    decompressor = zlib.decompressobj(31)
+    new_member = True
+    for block in blocks:
+        while block:
+            if new_member:
+                # skip null padding between members, as GzipFile does
+                block = block.lstrip(b'\x00')
+                if not block:
+                    break
+                new_member = False
+            data = decompressor.decompress(block, max_block_size)
+            if data:
+                yield data
+            # output may still be pending after a full block with all input consumed
+            while len(data) == max_block_size and not decompressor.unconsumed_tail and not decompressor.eof:
+                data = decompressor.decompress(b'', max_block_size)
+                if data:
+                    yield data
+            if decompressor.eof:
+                block = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+                new_member = True
+            else:
+                block = decompressor.unconsumed_tail
+    if not new_member:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+class BlockLineReader(object):
+    '''
+    Reads newline separated lines of bytes from a file object in large blocks,
+    decompressing gzip data in bulk with zlib as it is read. bytes_read counts
+    the (compressed) bytes read from the file object so far.
+    '''
+
+    def __init__(self, fileobj, gzipped=False, block_size=1024*1024):
+        self.fileobj = fileobj
+        self.gzipped = gzipped
+        self.block_size = block_size
+        self.lines = None
+        self.bytes_read = 0
+
+    def iter_blocks(self):
+        block = self.fileobj.read(self.block_size)
+        while block:
+            self.bytes_read += len(block)
+            yield block
+            block = self.fileobj.read(self.block_size)
+
+    def iter_lines(self):
+        '''
+        Yield each line, without its trailing newline.
+        '''
+        blocks = self.iter_blocks()
+        if self.gzipped:
+            blocks = gunzip_blocks(blocks, self.block_size)
+        partial = None
+        for block in blocks:
+            if partial is None:
+                # str or bytes, depending on the file object
+                partial = block[:0]
+            lines = (partial + block).split(b'\n' if type(block) == bytes else '\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line
+        if partial:
+            yield partial
+
+    def readline(self):
+        if self.lines is None:
+            self.lines = self.iter_lines()
+        line = next(self.lines, None)
+        if line is None:
+            return b''
+        return line + (b'\n' if type(line) == bytes else '\n')
+
+
+class PartitionSpool(object):
+    '''
+    Buffers records as newline json by partition (e.g. by hour), as they are
+    read. Once the buffers held in memory exceed max_memory bytes, the largest
+    ones are spilled to temporary files, so memory use is bounded by
+    max_memory instead of the size of the data.
+    '''
+
+    def __init__(self, max_memory=64*1024*1024, spool_dir=None):
+        self.max_memory = max_memory
+        self.spool_dir = spool_dir
+        self.buffers = {}
+        self.numrecs = {}
+        self.numbytes = {}
+        self.spilled = set()
+        self.memory = 0
+
+    def write(self, partition, rec):
+        self.write_raw(partition, json_codec.dumps(rec).encode('utf-8'))
+
+    def write_raw(self, partition, line):
+        '''
+        Buffer a record already serialized as a line of json bytes.
+        '''
+        if partition not in self.buffers:
+            # max_size=0: only spill when spill() says so
+            self.buffers[partition] = SpooledTemporaryFile(max_size=0, dir=self.spool_dir)
+            self.numrecs[partition] = 0
+            self.numbytes[partition] = 0
+        elif self.numbytes[partition]:
+            line = b'\n' + line
+        self.buffers[partition].write(line)
+        self.numrecs[partition] += 1
+        self.numbytes[partition] += len(line)
+        if partition not in self.spilled:
+            self.memory += len(line)
+            if self.memory > self.max_memory:
+                self.spill()
+
+    def spill(self):
+        while self.memory > self.max_memory:
+            partition = max((p for p in self.buffers if p not in self.spilled), key=lambda p: self.numbytes[p])
+            self.buffers[partition].rollover()
+            self.spilled.add(partition)
+            self.memory -= self.numbytes[partition]
+
+    def partitions(self):
+        return list(self.buffers.keys())
+
+    def open(self, partition):
+        buf = self.buffers[partition]
+        buf.seek(0)
+        return buf
+
+    def close(self):
+        for buf in self.buffers.values():
+            buf.close()
+        self.buffers = {}
+        self.spilled = set()
+        self.memory = 0
 
-    def __init__(self, target_bucket=None, log=True, s3_client=None):
+
+class S3FileMover(object):
+    max_err_lines = 1000
+
+    def __init__(self, target_bucket=None, log=True, s3_client=None, spool_memory_mb=64,
+                 multipart_chunk_mb=16, spool_dir=None, upload_threads=8):
+        '''
+        Parameters:
+            spool_memory_mb: MB of records buffered in memory by move_file before
+                spilling to temporary files in spool_dir (default: system temp dir)
+            multipart_chunk_mb: part size of multipart uploads, used for output
+                files larger than one part. S3 requires at least 5 MB.
+            upload_threads: number of output files uploaded concurrently
+        '''
         self.target_bucket = target_bucket
         self.s3_client = s3_client or boto3.client('s3')
+        self.spool_memory = int(spool_memory_mb*1024*1024)
+        self.multipart_chunk_size = int(max(multipart_chunk_mb, 5)*1024*1024)
+        self.spool_dir = spool_dir
+        self.upload_threads = upload_threads
         self.print_func = print
         if log:
             self.print_func = logger.info
+        # invalid lines found, keeping at most max_err_lines of them
         self.err_lines = []
+        self.num_err_lines = 0
 
     def get_fps_from_event(self, event):
         bucket_key_tuples = [(e['s3']['bucket']['name'], e['s3']['object']['key']) for e in event['Records']]
@@ -38,52 +207,261 @@ class S3FileMover(object):
         bucket_key_tuples_deduped = list(bucket_key_dict.values())
         return bucket_key_tuples_deduped
 
-    def get_fps_from_prefix(self, bucket, prefix, limit=0):
-        s3_source_kwargs = dict(Bucket=bucket, Prefix=prefix)
+    def get_fps_from_prefix(self, bucket, prefix, limit=0, threads=8):
+        '''
+        List (bucket, key) of the objects under a prefix, in ascending key order.
+        See iter_fps_from_prefix.
+
+        Returns:
+            list of at most limit (bucket, key) tuples, or all of them if limit is 0
+        '''
+        return list(self.iter_fps_from_prefix(bucket, prefix, limit=limit, threads=threads))
+
+    def iter_fps_from_prefix(self, bucket, prefix, limit=0, threads=8, min_shards=None):
+        '''
+        Yield (bucket, key) of the objects under a prefix in ascending key order,
+        while they are being listed. See iter_objects_from_prefix.
+        '''
+        for obj in self.iter_objects_from_prefix(bucket, prefix, limit=limit, threads=threads, min_shards=min_shards):
+            yield (bucket, obj['Key'])
+
+    def iter_objects_from_prefix(self, bucket, prefix, limit=0, threads=8, min_shards=None):
+        '''
+        Yield the objects under a prefix in ascending key order, while they are
+        being listed, as object dictionaries with Key, ETag, Size and
+        LastModified of each object.
+
+        The first page of keys is yielded right away. If there are more, the rest
+        of the prefix is split into shards on '/' one level at a time (e.g. into
+        the year, month, day and hour folders under a pilot and message type),
+        until there are at least min_shards (default: 4 per thread) or no deeper
+        folders. The shards are then listed concurrently on threads threads.
+
+        Parameters:
+            limit: maximum number of keys yielded, or 0 for all keys
+        '''
+        min_shards = min_shards or 4*threads
+        resp = self.s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+        first_objects = resp.get('Contents', [])
+        if limit > 0:
+            first_objects = first_objects[:limit]
+        for obj in first_objects:
+            yield obj
+        numkeys = len(first_objects)
+        if not resp.get('NextContinuationToken') or (limit > 0 and numkeys >= limit):
+            return
+        start_after = first_objects[-1]['Key']
 
-        bucket_key_tuples = []
+        executor = ThreadPoolExecutor(max_workers=threads)
+        inflight = deque()
+        try:
+            # split into shards, collecting the objects found along the way
+            shards, objects = [prefix], []
+            while len(shards) < min_shards:
+                sub_shards = []
+                for sub_prefixes, sub_objects in executor.map(lambda p: self.list_folder(bucket, p), shards):
+                    sub_shards += sub_prefixes
+                    objects += sub_objects
+                shards = sub_shards
+                if not shards:
+                    break
+
+            # a key sorts against all keys under a shard as it sorts against the shard
+            # prefix, so shards sorting before start_after and not holding it are done
+            entries = sorted([(obj['Key'], obj) for obj in objects if obj['Key'] > start_after] +
+                             [(shard, None) for shard in shards if shard > start_after or start_after.startswith(shard)],
+                             key=lambda entry: entry[0])
+            idx = 0
+            while idx < len(entries) or inflight:
+                # keep up to 2 entries per thread listing ahead of the consumer
+                while idx < len(entries) and len(inflight) < 2*threads:
+                    name, obj = entries[idx]
+                    inflight.append(executor.submit(self.list_objects, bucket, name, start_after) if obj is None else [obj])
+                    idx += 1
+                listed = inflight.popleft()
+                if not isinstance(listed, list):
+                    listed = listed.result()
+                for obj in listed:
+                    yield obj
+                    numkeys += 1
+                    if limit > 0 and numkeys >= limit:
+                        return
+        finally:
+            for listed in inflight:
+                if not isinstance(listed, list):
+                    listed.cancel()
+            executor.shutdown(wait=False)
+
+    def list_folder(self, bucket, prefix):
+        '''
+        List one level under a prefix, with '/' as delimiter.
+
+        Returns:
+            list of sub-folder prefixes, and list of objects directly under the prefix
+        '''
+        s3_source_kwargs = dict(Bucket=bucket, Prefix=prefix, Delimiter='/')
+
+        prefixes, objects = [], []
         while True:
             resp = self.s3_client.list_objects_v2(**s3_source_kwargs)
-            if not resp.get('Contents'):
-                return []
-            bucket_key_tuples += [(bucket, i['Key']) for i in resp['Contents']]
+            prefixes += [i['Prefix'] for i in resp.get('CommonPrefixes', [])]
+            objects += resp.get('Contents', [])
             if not resp.get('NextContinuationToken'):
                 break
             s3_source_kwargs['ContinuationToken'] = resp['NextContinuationToken']
-            if limit > 0 and len(bucket_key_tuples) > limit:
+        return prefixes, objects
+
+    def list_objects(self, bucket, prefix, start_after=None):
+        '''
+        Returns:
+            list of all objects under a prefix, after start_after if supplied
+        '''
+        if start_after and start_after < prefix:
+            start_after = None
+        return self.get_objects_from_prefix(bucket, prefix, start_after)
+
+    def get_objects_from_prefix(self, bucket, prefix, start_after=None):
+        '''
+        List all objects under a prefix, after start_after if supplied.
+
+        Returns:
+            list of object dictionaries as returned by list_objects_v2, with
+            Key, ETag, Size and LastModified of each object
+        '''
+        s3_source_kwargs = dict(Bucket=bucket, Prefix=prefix)
+        if start_after:
+            s3_source_kwargs['StartAfter'] = start_after
+
+        objects = []
+        while True:
+            resp = self.s3_client.list_objects_v2(**s3_source_kwargs)
+            objects += resp.get('Contents', [])
+            if not resp.get('NextContinuationToken'):
                 break
-        return bucket_key_tuples
+            s3_source_kwargs['ContinuationToken'] = resp['NextContinuationToken']
+        return objects
 
     def get_data_stream(self, bucket, key):
+        '''
+        Returns:
+            BlockLineReader of the decompressed lines of the file, as bytes
+        '''
+        obj = self.s3_client.get_object(Bucket=bucket, Key=key)
+        return BlockLineReader(obj['Body'], gzipped=key[-3:] == '.gz')
+
+    def get_raw_data_stream(self, bucket, key):
+        '''
+        Same as get_data_stream: the stream always yields bytes.
+        '''
+        return self.get_data_stream(bucket, key)
+
+    def get_data_bytes_stream(self, bucket, key):
+        '''
+        Download and decompress a whole file into memory.
+
+        Returns:
+            BytesIO stream of the decompressed file content
+        '''
         obj = self.s3_client.get_object(Bucket=bucket, Key=key)
+        data = obj['Body'].read()
         if key[-3:] == '.gz':
-            gzipped = GzipFile(None, 'rb', fileobj=obj['Body'])
-            data = TextIOWrapper(gzipped)
-        else:
-            data = obj['Body']._raw_stream
-        return data
+            data = b''.join(gunzip_blocks([data]))
+        return BytesIO(data)
+
+    def add_err_line(self, line):
+        '''
+        Record an invalid line. Only the first max_err_lines are logged and kept
+        in err_lines, so a corrupt file cannot exhaust memory.
+        '''
+        self.num_err_lines += 1
+        if len(self.err_lines) < self.max_err_lines:
+            self.print_func(traceback.format_exc())
+            self.print_func('Invalid json line. Skipping: {}'.format(line))
+            self.err_lines.append(line)
+        elif self.num_err_lines == self.max_err_lines+1:
+            self.print_func('More than {} invalid json lines. Further invalid lines are counted but not logged.'.format(self.max_err_lines))
 
     def newline_json_rec_generator(self, data_stream):
-        line = data_stream.readline()
-        while line:
-            if type(line) == bytes:
-                line_stripped = line.strip(b'\n')
-            else:
-                line_stripped = line.strip('\n')
-
+        if not isinstance(data_stream, BlockLineReader):
+            data_stream = BlockLineReader(data_stream)
+        for line in data_stream.iter_lines():
+            if not line:
+                continue
+            try:
+                rec = json_codec.loads(line)
+            except:
+                self.add_err_line(line)
+                continue
+            yield rec
+
+    def iter_json_recs_from_offset(self, data_stream, offset=0):
+        '''
+        Like newline_json_rec_generator, but resumable: the first offset
+        non-empty lines are skipped without being parsed.
+
+        Yields:
+            tuple of (offset, rec), where offset is the number of non-empty
+            lines up to and including the line of rec
+        '''
+        if not isinstance(data_stream, BlockLineReader):
+            data_stream = BlockLineReader(data_stream)
+        line_offset = 0
+        for line in data_stream.iter_lines():
+            if not line:
+                continue
+            line_offset += 1
+            if line_offset <= offset:
+                continue
             try:
-                if line_stripped:
-                    yield json.loads(line_stripped)
+                rec = json_codec.loads(line)
             except:
-                self.print_func(traceback.format_exc())
-                self.print_func('Invalid json line. Skipping: {}'.format(line))
-                self.err_lines.append(line)
-            line = data_stream.readline()
+                self.add_err_line(line)
+                continue
+            yield line_offset, rec
+
+    def newline_raw_rec_generator(self, data_stream):
+        '''
+        Yield each non-empty line of a bytes stream, without decoding it.
+        '''
+        if not isinstance(data_stream, BlockLineReader):
+            data_stream = BlockLineReader(data_stream)
+        for line in data_stream.iter_lines():
+            line_stripped = line.strip(b'\r\n')
+            if line_stripped:
+                yield line_stripped
 
     def write_recs(self, recs, bucket, key):
-        outbytes = "\n".join([json.dumps(i) for i in recs if i]).encode('utf-8')
+        outbytes = "\n".join([json_codec.dumps(i) for i in recs if i]).encode('utf-8')
         self.s3_client.put_object(Bucket=bucket, Key=key, Body=outbytes)
 
+    def write_stream(self, stream, numbytes, bucket, key):
+        '''
+        Upload a file object of numbytes bytes, with a multipart upload if it is
+        larger than one part so that only one part is held in memory at a time.
+        '''
+        if numbytes <= self.multipart_chunk_size:
+            self.s3_client.put_object(Bucket=bucket, Key=key, Body=stream.read())
+            return
+
+        upload_id = self.s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        try:
+            parts = []
+            chunk = stream.read(self.multipart_chunk_size)
+            while chunk:
+                part_number = len(parts)+1
+                resp = self.s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                  PartNumber=part_number, Body=chunk)
+                parts.append({'ETag': resp['ETag'], 'PartNumber': part_number})
+                chunk = stream.read(self.multipart_chunk_size)
+            self.s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                     MultipartUpload={'Parts': parts})
+        except:
+            self.s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def write_spool(self, spool, partition, bucket, key):
+        self.write_stream(spool.open(partition), spool.numbytes[partition], bucket, key)
+
     def delete_file(self, bucket, key):
         self.s3_client.delete_object(Bucket=bucket, Key=key)
 
@@ -92,26 +470,46 @@ class S3FileMover(object):
         self.print_func('Triggered by file: {}'.format(source_path))
 
         data_stream = self.get_data_stream(source_bucket, source_key)
-        recs = []
-        for rec in self.newline_json_rec_generator(data_stream):
-            recs.append(rec)
-
-        if recs:
-            target_key = source_key
-            target_path = os.path.join(self.target_bucket, target_key)
-            self.print_func('Writing {} records from {} -> {}'.format(len(recs), source_path, target_path))
-            self.write_recs(recs, self.target_bucket, target_key)
-        else:
-            self.print_func('File is empty: {}'.format(source_path))
+        spool = PartitionSpool(self.spool_memory, self.spool_dir)
+        try:
+            for rec in self.newline_json_rec_generator(data_stream):
+                if rec:
+                    spool.write(None, rec)
+
+            if spool.partitions():
+                target_key = source_key
+                target_path = os.path.join(self.target_bucket, target_key)
+                self.print_func('Writing {} records from {} -> {}'.format(spool.numrecs[None], source_path, target_path))
+                self.write_spool(spool, None, self.target_bucket, target_key)
+            else:
+                self.print_func('File is empty: {}'.format(source_path))
+        finally:
+            spool.close()
 
         self.print_func('Delete file: {}'.format(source_path))
         self.delete_file(source_bucket, source_key)
 
 
 class CvPilotFileMover(S3FileMover):
-
-    def __init__(self, source_bucket_prefix='usdot-its-datahub-', source_key_prefix=None, validation_queue_names=[], *args, **kwargs):
+    # SQS accepts up to 10 messages per send_message_batch call
+    queue_batch_size = 10
+    queue_max_retries = 3
+
+    def __init__(self, source_bucket_prefix='usdot-its-datahub-', source_key_prefix=None, validation_queue_names=[], passthrough=False, deterministic_names=False, *args, **kwargs):
+        '''
+        Parameters:
+            passthrough: if True, move_file writes the original bytes of each
+                record instead of re-encoding it. Each line is still decoded,
+                to check that it is valid json and read its generatedAt
+                timestamp (see get_ymdh_from_line)
+            deterministic_names: if True, output files are named with a uuid5
+                of the source file and hour instead of a random uuid4, so moving
+                the same file again overwrites its earlier output instead of
+                duplicating it
+        '''
         super(CvPilotFileMover, self).__init__(*args, **kwargs)
+        self.passthrough = passthrough
+        self.deterministic_names = deterministic_names
         self.source_bucket_prefix = source_bucket_prefix
         self.source_key_prefix = source_key_prefix or ''
         self.queues = []
@@ -158,9 +556,12 @@ class CvPilotFileMover(S3FileMover):
         def outfp_func(ymdh):
             y,m,d,h = ymdh.split('-')
             ymdhms = '{}-00-00'.format(ymdh)
-            uuid4 = str(uuid.uuid4())
+            if self.deterministic_names:
+                file_uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, 's3://{}/{}#{}'.format(source_bucket, source_key, ymdh)))
+            else:
+                file_uuid = str(uuid.uuid4())
 
-            target_filename = '-'.join([filename_prefix, message_type.lower(), 'public', str(stream_version), ymdhms, uuid4])
+            target_filename = '-'.join([filename_prefix, message_type.lower(), 'public', str(stream_version), ymdhms, file_uuid])
             target_prefix = os.path.join(pilot_name, message_type, y, m, d, h)
             target_key = os.path.join(target_prefix, target_filename)
             return target_key
@@ -170,6 +571,21 @@ class CvPilotFileMover(S3FileMover):
 
         return outfp_func
 
+    def is_restructured_key(self, key):
+        '''
+        Check if a key was written by move_file with deterministic_names, in the
+        folder of its hour. Such a file only holds records of that hour.
+        '''
+        parts = key.split('/')
+        if len(parts) < 6:
+            return False
+        try:
+            file_uuid = uuid.UUID(parts[-1][-36:])
+        except ValueError:
+            return False
+        ymdh = '-'.join(parts[-5:-1])
+        return file_uuid.version == 5 and parts[-1][-56:-37] == '{}-00-00'.format(ymdh)
+
     def get_ymdh(self, rec):
         recordGeneratedAt = rec['metadata'].get('recordGeneratedAt')
         if not recordGeneratedAt:
@@ -184,47 +600,121 @@ class CvPilotFileMover(S3FileMover):
         recordGeneratedAt_ymdh = datetime.strftime(dt, '%Y-%m-%d-%H')
         return recordGeneratedAt_ymdh
 
+    def get_ymdh_from_line(self, line):
+        '''
+        Get the generatedAt ymdh of a raw json line, as get_ymdh does. The line
+        is decoded with json_codec (orjson when it is installed), so that only
+        valid json lines are passed through and the timestamp is read from the
+        metadata object only. Scanning the raw line for the timestamp cannot
+        tell whether the line is valid json, so passthrough saves the
+        re-encoding of each record but not its decoding.
+
+        Returns:
+            ymdh string, or None if the line is not valid json
+        '''
+        try:
+            rec = json_codec.loads(line)
+        except:
+            self.add_err_line(line)
+            return None
+        return self.get_ymdh(rec)
+
+    def send_queue_messages(self, msgs):
+        '''
+        Send messages to every validation queue in batches of up to
+        queue_batch_size, retrying only the entries that failed.
+        '''
+        for queue in self.queues:
+            for idx in range(0, len(msgs), self.queue_batch_size):
+                entries = [{'Id': str(i), 'MessageBody': json.dumps(msg)} for i, msg in enumerate(msgs[idx:idx+self.queue_batch_size])]
+                for attempt in range(self.queue_max_retries+1):
+                    resp = queue.send_message_batch(Entries=entries)
+                    failed = resp.get('Failed', [])
+                    if not failed:
+                        break
+                    # entries failing due to the request itself will fail again
+                    sender_faults = [i for i in failed if i.get('SenderFault')]
+                    if sender_faults or attempt == self.queue_max_retries:
+                        raise RuntimeError('Failed to send {} messages to {}: {}'.format(len(failed), queue.url, failed))
+                    failed_ids = set(i['Id'] for i in failed)
+                    entries = [i for i in entries if i['Id'] in failed_ids]
+                    self.print_func('Retrying {} failed messages to {}'.format(len(entries), queue.url))
+                    time.sleep(0.1*2**attempt)
+
+    def write_partitions(self, spool, outfp_func, source_path):
+        '''
+        Upload every partition of the spool concurrently on upload_threads
+        threads.
+
+        Returns:
+            list of target keys written, and the first upload error or None
+        '''
+        target_keys = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.upload_threads, len(spool.partitions())))) as executor:
+            for ymdh in spool.partitions():
+                target_key = outfp_func(ymdh)
+                target_path = os.path.join(self.target_bucket, target_key)
+                self.print_func('Writing {} records from \n{} -> \n{}'.format(spool.numrecs[ymdh], source_path, target_path))
+                futures.append((target_key, executor.submit(self.write_spool, spool, ymdh, self.target_bucket, target_key)))
+
+        error = None
+        for target_key, future in futures:
+            if future.exception():
+                error = error or future.exception()
+                self.print_func('Failed to write {}: {}'.format(target_key, future.exception()))
+            else:
+                target_keys.append(target_key)
+        self.print_func('{} files written'.format(len(target_keys)))
+        return target_keys, error
+
 
     def move_file(self, source_bucket, source_key):
         # read triggering file
         source_path = os.path.join(source_bucket, source_key)
         self.print_func('Triggered by file: {}'.format(source_path))
 
-        # sort all files by generatedAt timestamp ymdh
-        ymdh_data_dict = {}
-        data_stream = self.get_data_stream(source_bucket, source_key)
-        for rec in self.newline_json_rec_generator(data_stream):
-            recordGeneratedAt_ymdh = self.get_ymdh(rec)
-            if recordGeneratedAt_ymdh not in ymdh_data_dict:
-                ymdh_data_dict[recordGeneratedAt_ymdh] = []
-            ymdh_data_dict[recordGeneratedAt_ymdh].append(rec)
-
-        # generate output path
-        outfp_func = self.generate_outfp(ymdh_data_dict, source_bucket, source_key)
-        if outfp_func is None:
-            return
+        # sort all records by generatedAt timestamp ymdh, spooling them as they are read
+        num_err_lines = self.num_err_lines
+        spool = PartitionSpool(self.spool_memory, self.spool_dir)
+        try:
+            if self.passthrough:
+                data_stream = self.get_raw_data_stream(source_bucket, source_key)
+                for line in self.newline_raw_rec_generator(data_stream):
+                    recordGeneratedAt_ymdh = self.get_ymdh_from_line(line)
+                    if recordGeneratedAt_ymdh:
+                        spool.write_raw(recordGeneratedAt_ymdh, line)
+            else:
+                data_stream = self.get_data_stream(source_bucket, source_key)
+                for rec in self.newline_json_rec_generator(data_stream):
+                    recordGeneratedAt_ymdh = self.get_ymdh(rec)
+                    spool.write(recordGeneratedAt_ymdh, rec)
 
-        for ymdh, recs in ymdh_data_dict.items():
-            target_key = outfp_func(ymdh)
-            target_path = os.path.join(self.target_bucket, target_key)
+            # generate output path
+            outfp_func = self.generate_outfp(spool.buffers, source_bucket, source_key)
+            if outfp_func is None:
+                return
 
             # copy data
-            self.print_func('Writing {} records from \n{} -> \n{}'.format(len(recs), source_path, target_path))
-            self.write_recs(recs, self.target_bucket, target_key)
-            self.print_func('File written')
+            target_keys, error = self.write_partitions(spool, outfp_func, source_path)
+
+            # notify validation queues of the files written, even if others failed
             if self.queues:
-                for queue in self.queues:
-                    msg = {
+                msgs = [{
                     'bucket': self.target_bucket,
                     'key': target_key,
                     'pilot_name': self.pilot_name,
                     'message_type': self.message_type.lower()
-                    }
-                    queue.send_message(MessageBody=json.dumps(msg))
-
-        if len(self.err_lines) > 0:
-            self.print_func('{} lines not read in file. Keep file at: {}'.format(len(self.err_lines), source_path))
+                    } for target_key in target_keys]
+                self.send_queue_messages(msgs)
+            if error:
+                raise error
+        finally:
+            spool.close()
+
+        if self.num_err_lines > num_err_lines:
+            self.print_func('{} lines not read in file. Keep file at: {}'.format(self.num_err_lines-num_err_lines, source_path))
         else:
             self.print_func('Delete file: {}'.format(source_path))
             self.delete_file(source_bucket, source_key)
-        return
+        return target_keys
@@ -0,0 +1,126 @@
+'''
+Local SQLite index of the objects in S3 hour folders, so that repeat exports
+of the same date range do not list S3 again.
+
+'''
+from datetime import datetime, timedelta, timezone
+import re
+import sqlite3
+import threading
+
+
+class S3KeyIndex(object):
+    '''
+    Index of key, size, ETag and last modified time of the objects in each
+    pilot/message type/year/month/day/hour folder.
+
+    Files for an hour keep arriving for a while after the hour ends, and their
+    keys end in a random uuid, so new keys do not sort after the ones already
+    seen. A folder is therefore listed in full until a listing was made at
+    least settle_hours after the end of its hour. From then on it is served
+    from the index without any S3 call, until its listing is older than
+    max_age_hours. Files restructured or backfilled into old hours later are
+    only picked up once the folder is listed again, so supply max_age_hours,
+    or refresh to list every folder again and update the index.
+    '''
+    hour_folder_regex = re.compile(r'(\d{4})/(\d{2})/(\d{2})/(\d{2})/?$')
+
+    def __init__(self, fp, settle_hours=48, max_age_hours=None, refresh=False):
+        '''
+        Parameters:
+            fp: path of the SQLite file
+            settle_hours: hours after the end of an hour folder from which its
+            listing is considered complete
+            max_age_hours: hours after which the listing of a settled folder is
+            no longer used, or None to use it indefinitely
+            refresh: list every folder from S3, ignoring the index
+        '''
+        self.fp = fp
+        self.settle_hours = settle_hours
+        self.max_age_hours = max_age_hours
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fp, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS folders (
+                bucket TEXT, prefix TEXT, listed_at TEXT, numkeys INTEGER,
+                PRIMARY KEY (bucket, prefix));
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT, prefix TEXT, key TEXT, size INTEGER, etag TEXT, last_modified TEXT,
+                PRIMARY KEY (bucket, prefix, key));
+        ''')
+        self.conn.commit()
+        self.stats = {'index_folders': 0, 'listed_folders': 0}
+
+    def get_folder_end(self, prefix):
+        '''
+        Returns:
+            datetime at which the hour of an hour folder prefix ends, or None if
+            the prefix is not an hour folder
+        '''
+        match = self.hour_folder_regex.search(prefix)
+        if not match:
+            return None
+        try:
+            return datetime(*[int(i) for i in match.groups()]) + timedelta(hours=1)
+        except ValueError:
+            return None
+
+    def format_time(self, dt):
+        # UTC time as stored in the index. boto3 returns timezone aware times.
+        if dt.tzinfo:
+            dt = dt.astimezone(timezone.utc)
+        return dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def parse_time(self, time_str):
+        return datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+
+    def is_settled(self, prefix, listed_at):
+        '''
+        Check whether a folder listed at listed_at can be served from the
+        index: the listing was made settle_hours after the end of its hour,
+        and is not older than max_age_hours.
+        '''
+        folder_end = self.get_folder_end(prefix)
+        if folder_end is None or self.refresh:
+            return False
+        listed_at = self.parse_time(listed_at)
+        if self.max_age_hours is not None and datetime.now(timezone.utc) - listed_at > timedelta(hours=self.max_age_hours):
+            return False
+        return listed_at.replace(tzinfo=None) >= folder_end + timedelta(hours=self.settle_hours)
+
+    def get_objects(self, mover, bucket, prefix):
+        '''
+        Get the objects of a folder from the index if it is settled, or list it
+        with mover.get_objects_from_prefix and update the index otherwise.
+
+        Returns:
+            list of object dictionaries with Key, ETag, Size and LastModified
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT listed_at FROM folders WHERE bucket=? AND prefix=?',
+                                    (bucket, prefix)).fetchone()
+            if row and self.is_settled(prefix, row[0]):
+                rows = self.conn.execute('SELECT key, size, etag, last_modified FROM objects WHERE bucket=? AND prefix=? ORDER BY key',
+                                         (bucket, prefix)).fetchall()
+                self.stats['index_folders'] += 1
+                return [{'Key': key, 'Size': size, 'ETag': etag, 'LastModified': self.parse_time(last_modified)}
+                        for key, size, etag, last_modified in rows]
+
+        listed_at = self.format_time(datetime.now(timezone.utc))
+        objects = mover.get_objects_from_prefix(bucket, prefix)
+        with self.lock:
+            self.conn.execute('DELETE FROM objects WHERE bucket=? AND prefix=?', (bucket, prefix))
+            self.conn.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(bucket, prefix, obj['Key'], obj['Size'], obj['ETag'],
+                                    self.format_time(obj['LastModified'])) for obj in objects])
+            self.conn.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)', (bucket, prefix, listed_at, len(objects)))
+            self.conn.commit()
+            self.stats['listed_folders'] += 1
+        return objects
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def close(self):
+        self.conn.close()
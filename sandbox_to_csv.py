@@ -1,8 +1,8 @@
 """
 ITS DataHub Sandbox Exporter
 
-Script for exporting ITS sandbox data from specified date range to merged CSV
-or JSON files
+Script for exporting ITS sandbox data from specified date range to merged CSV,
+JSON, Parquet or Arrow files
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -24,6 +24,48 @@ optional arguments:
                         name. Default: {pilot}_{message_type}_{sdate}_{edate}
   --json                Supply flag if file is to be exported as newline json
                         instead of CSV file. Default: False
+  --format FORMAT       Output file format (options: csv, json, parquet,
+                        arrow). Parquet and arrow files hold typed columns
+                        and require the pyarrow package. Overrides --json if
+                        supplied. Default: csv
+  --row_group_size ROW_GROUP_SIZE
+                        Number of records per Parquet row group or Arrow
+                        record batch. Default: 100000
+  --max_rows_per_file MAX_ROWS_PER_FILE
+                        Maximum number of records per output file. A new
+                        output file is started once this is reached. Default:
+                        no limit. Without --max_rows_per_file and
+                        --max_mb_per_file, csv and json output files are
+                        rolled over at the end of the first hour folder that
+                        takes them past 10000 records
+  --max_mb_per_file MAX_MB_PER_FILE
+                        Approximate maximum size of each output file in MB,
+                        measured on the uncompressed data written. A new
+                        output file is started once this is reached.
+                        Default: no limit
+  --memory_budget_mb MEMORY_BUDGET_MB
+                        Maximum MB of prefetched S3 data waiting to be
+                        flattened and written. Prefetching pauses while the
+                        writer is behind by more than this. Only used with
+                        --prefetch_depth. Default: no limit
+  --resume              Supply flag to resume an interrupted export from the
+                        checkpoint manifest written next to its output files,
+                        skipping the hour folders already exported and warning
+                        about those whose S3 files changed since. Default:
+                        False
+  --key_index KEY_INDEX
+                        Path of a local SQLite index of the keys in each hour
+                        folder. Hour folders listed at least 48 hours after
+                        they ended are read from the index instead of S3, so
+                        repeat exports of the same dates start without
+                        listing. Default: None (no index)
+  --key_index_max_age_hours KEY_INDEX_MAX_AGE_HOURS
+                        Maximum age in hours of the listing of an hour folder
+                        read from --key_index. Hour folders listed longer ago
+                        are listed from S3 again, e.g. to pick up files
+                        backfilled into old hours. Default: None (no limit)
+  --refresh_index       Supply flag to list every hour folder from S3 again
+                        and update --key_index with the result. Default: False
   --aws_profile AWS_PROFILE
                         Supply name of AWS profile if not using default
                         profile. AWS profile must be configured in
@@ -35,45 +77,88 @@ optional arguments:
                         Default: False
   --log                 Supply flag if script progress should be logged and
                         not printed to the console. Default: False
+  --workers WORKERS     Number of worker processes used to download,
+                        decompress and flatten S3 files. Default: 1
+  --max_inflight_keys MAX_INFLIGHT_KEYS
+                        Maximum number of S3 files being processed by the
+                        workers at any time. Default: twice the number of
+                        workers
+  --prefetch_depth PREFETCH_DEPTH
+                        Number of S3 files to download and decompress ahead
+                        of the flattener, while upcoming hour folders are
+                        listed in the background. Not used with --workers.
+                        Default: 0 (no prefetching)
+  --max_pool_connections MAX_POOL_CONNECTIONS
+                        Size of the S3 connection pool, which is also the
+                        number of prefetching threads. Default: 10
 """
 from __future__ import print_function
 from argparse import ArgumentParser
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ProfileNotFound
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from copy import copy
 import dateutil.parser
+import importlib.util
 from datetime import datetime, timedelta
-from functools import reduce
 import json
 import logging
 import os
 import csv
+import pickle
+from queue import Queue
 import threading
 import time
 import traceback
 import zipfile
 
 
-from flattener import load_flattener
+from flattener import load_flattener, timestamp_parser, parse_date
+import json_codec
 from s3_file_mover import CvPilotFileMover
+from s3_key_index import S3KeyIndex
 
 
 class SandboxExporter(object):
+    # number of records written at a time, between checks of the output file size
+    write_batch_size = 1000
+    # without a cap on output files, csv and json files are rolled over at the
+    # end of the first hour folder that takes them past this many records
+    folder_rollover_recs = 10000
 
     def __init__(self, bucket='usdot-its-cvpilot-public-data', pilot='wydot',
                 message_type='bsm', sdate=None, edate=None, csv=True, zip=False, log=False,
                 output_convention='{pilot}_{message_type}_{sdate}_{edate}',
-                aws_profile="default"):
+                aws_profile="default", workers=1, max_inflight_keys=None,
+                prefetch_depth=0, max_pool_connections=10, output_format=None,
+                row_group_size=100000, max_rows_per_file=None, max_mb_per_file=None,
+                memory_budget_mb=None, resume=False, key_index=None, key_index_max_age_hours=None,
+                refresh_index=False):
         # set up
         self.bucket = bucket
         self.pilot = pilot
         self.message_type = message_type
         self.sdate = None
         self.edate = None
-        self.csv = csv
+        self.output_format = output_format or ('csv' if csv else 'json')
+        # records are flattened for every output format except newline json
+        self.csv = self.output_format != 'json'
+        self.row_group_size = row_group_size
+        self.max_rows_per_file = max_rows_per_file or 0
+        self.max_bytes_per_file = max_mb_per_file*1e6 if max_mb_per_file else None
+        self.memory_budget = memory_budget_mb*1e6 if memory_budget_mb else None
         self.zip = zip
+        self.resume = resume
+        self.key_index = S3KeyIndex(key_index, max_age_hours=key_index_max_age_hours,
+                                    refresh=refresh_index) if key_index else None
         self.output_convention = output_convention
         self.aws_profile = aws_profile
+        self.workers = workers
+        self.max_inflight_keys = max_inflight_keys or 2*workers
+        self.prefetch_depth = prefetch_depth
+        self.max_pool_connections = max_pool_connections
         self.print_func = print
         if log:
             logging.basicConfig(filename='sandbox_to_csv.log', format='%(asctime)s %(message)s')
@@ -89,18 +174,37 @@ class SandboxExporter(object):
             self.edate = self.sdate + timedelta(hours=24)
 
         aws_session = self.create_aws_session()
-        s3botoclient = aws_session.client('s3')
+        s3botoclient = aws_session.client('s3', config=Config(max_pool_connections=max_pool_connections))
         self.mover = CvPilotFileMover(target_bucket=bucket,
                                  source_bucket_prefix="",
                                  source_key_prefix="",
-                                 validation_queue_name=None,
+                                 validation_queue_names=None,
                                  log=False,
                                  s3_client=s3botoclient)
 
         flattenerMod = load_flattener('{}/{}'.format(pilot, message_type.upper()))
         self.flattener = flattenerMod()
-        self.current_recs = []
+        self.writer = None
+        # schema shared by the Parquet or Arrow files of the export
+        self.arrow_schema = None
         self.file_names = []
+        self.fp_params = {}
+        self.filenum = 0
+        self.numrecs = 0
+        self.pool = None
+        self.pipeline = None
+        self.worker_timestamp_stats = {}
+        self.flatten_time = 0
+        self.flatten_numrecs = 0
+        self.write_time = 0
+        self.folder_numrecs = 0
+        self.manifest = None
+        self.curr_folder = None
+        self.curr_etags = {}
+        # folders completed by an interrupted export whose files changed since
+        self.changed_folders = []
+        self.pending_folders = []
+        self.skip_numrecs = 0
 
     def create_aws_session(self):
         try:
@@ -117,34 +221,169 @@ class SandboxExporter(object):
         folder = '{}/{}/{}/{}/{}/{}'.format(self.pilot, self.message_type.upper(), y, m, d, h)
         return folder
 
-    def write_json_newline(self, recs, fp):
-        with open(fp, 'w') as outfile:
-            for r in recs:
-                outfile.write(json.dumps(r))
-                outfile.write('\n')
-        self.file_names.append(fp)
+    def get_folder_prefixes(self):
+        folders = []
+        efolder = self.get_folder_prefix(self.edate)
+        curr_dt = copy(self.sdate)
+        curr_folder = self.get_folder_prefix(curr_dt)
+        while curr_folder < efolder:
+            folders.append(curr_folder)
+            curr_dt += timedelta(hours=1)
+            curr_folder = self.get_folder_prefix(curr_dt)
+        return folders
 
-    def write_csv(self, recs, fp):
-        flat_recs = []
-        for r in recs:
-            flat_recs += self.flattener.process_and_split(r)
+    def iter_folders(self, folders):
+        '''
+        Yield (folder, keys, etags, streams) for each hour folder, where etags
+        maps each key to its ETag and streams yields the data stream of each key
+        in order. Uses the prefetch pipeline if set.
+        '''
+        if self.pipeline:
+            for folder_data in self.pipeline:
+                yield folder_data
+            return
 
-        with open(fp, mode='w') as csv_file:
-            field_names = reduce(lambda x, y: set(list(x)+list(y)), flat_recs)
-            writer = csv.DictWriter(csv_file, fieldnames=field_names)
-            writer.writeheader()
-            for flat_rec in flat_recs:
-                writer.writerow(flat_rec)
-        self.file_names.append(fp)
+        for folder in folders:
+            objects = self.get_folder_objects(folder)
+            keys = [(self.bucket, obj['Key']) for obj in objects]
+            etags = {obj['Key']: obj['ETag'] for obj in objects}
+            streams = (self.mover.get_data_stream(sb, sk) for sb, sk in keys)
+            yield folder, keys, etags, streams
 
-    def write(self, recs, fp):
-        if self.csv:
-            ext = '.csv'
-            self.write_csv(recs, fp+ext)
+    def get_folder_objects(self, folder):
+        if self.key_index:
+            return self.key_index.get_objects(self.mover, self.bucket, folder)
+        return self.mover.get_objects_from_prefix(self.bucket, folder)
+
+    def open_writer(self):
+        fp = (self.output_convention+'_{filenum}').format(filenum=self.filenum, **self.fp_params)
+        if self.output_format in ['parquet', 'arrow']:
+            self.writer = ArrowWriter(fp+'.'+self.output_format, self.output_format, self.row_group_size, self.arrow_schema,
+                                      print_func=self.print_func)
+        elif self.csv:
+            self.writer = StreamingCsvWriter(fp+'.csv')
         else:
-            ext = '.txt'
-            self.write_json_newline(recs, fp+ext)
-        self.print_func('Wrote {} recs to {}'.format(len(recs), fp+ext ))
+            self.writer = JsonNewlineWriter(fp+'.txt')
+
+    def close_writer(self):
+        self.writer.close()
+        if self.output_format in ['parquet', 'arrow']:
+            self.arrow_schema = self.writer.schema
+        self.file_names.append(self.writer.fp)
+        self.print_func('Wrote {} recs to {}'.format(self.writer.numrecs, self.writer.fp))
+        self.numrecs += self.writer.numrecs
+        self.filenum += 1
+        self.writer = None
+
+        # every folder finished so far now has all its records in closed files
+        self.manifest.output_files.append(self.file_names[-1])
+        self.manifest.numrecs = self.numrecs
+        self.manifest.complete_folders(self.pending_folders)
+        self.pending_folders = []
+        self.manifest.partial_folder = self.curr_folder
+        self.manifest.partial_numrecs = self.folder_numrecs if self.curr_folder else 0
+        self.manifest.partial_etags = self.curr_etags if self.curr_folder else {}
+        self.manifest.save()
+
+    def complete_folder(self, folder, etags):
+        self.curr_folder = None
+        if self.writer:
+            self.pending_folders.append((folder, etags))
+        else:
+            self.manifest.complete_folders([(folder, etags)])
+            self.manifest.partial_folder = None
+            self.manifest.partial_numrecs = 0
+            self.manifest.partial_etags = {}
+            self.manifest.save()
+
+    def load_manifest(self, folders):
+        '''
+        Load the checkpoint manifest of an interrupted export and restore its
+        progress.
+
+        Returns:
+            list of hour folders still to be exported
+        '''
+        self.manifest.load()
+        self.file_names = list(self.manifest.output_files)
+        self.filenum = len(self.file_names)
+        self.numrecs = self.manifest.numrecs
+        if self.file_names and self.output_format in ['parquet', 'arrow'] and os.path.exists(self.file_names[-1]):
+            self.arrow_schema = read_arrow_schema(self.file_names[-1], self.output_format)
+        completed_folders = set(self.manifest.completed_folders)
+        self.print_func('Resuming export from {}: {} hour folders and {} output files already completed'.format(
+            self.manifest.fp, len(completed_folders), self.filenum))
+        for folder in folders:
+            if folder in completed_folders:
+                self.check_completed_folder(folder)
+        folders = [f for f in folders if f not in completed_folders]
+        return folders
+
+    def check_completed_folder(self, folder):
+        '''
+        Compare the keys of a completed folder with the ETags logged when it
+        was exported, and warn if its files changed since. Changed folders are
+        not exported again.
+
+        Returns:
+            True if the folder changed
+        '''
+        logged_etags = self.manifest.completed_etags.get(folder)
+        if logged_etags is None:
+            return False
+        etags = {obj['Key']: obj['ETag'] for obj in self.get_folder_objects(folder)}
+        added = len(set(etags) - set(logged_etags))
+        removed = len(set(logged_etags) - set(etags))
+        modified = sum(1 for k in etags if k in logged_etags and etags[k] != logged_etags[k])
+        if not (added or removed or modified):
+            return False
+        self.changed_folders.append(folder)
+        self.print_func('Warning: files in {} changed since it was exported ({} added, {} removed, {} modified). It is not exported again.'.format(
+            folder, added, removed, modified))
+        return True
+
+    def roll_at_folder_end(self):
+        '''
+        Whether to close the output file at the end of an hour folder, as
+        csv and json exports do when output files are not capped. Parquet and
+        Arrow files are not rolled over, so that row groups can fill up.
+        '''
+        if self.max_rows_per_file or self.max_bytes_per_file or self.output_format in ['parquet', 'arrow']:
+            return False
+        return self.writer.numrecs > self.folder_rollover_recs
+
+    def writer_is_full(self):
+        if self.max_rows_per_file and self.writer.numrecs >= self.max_rows_per_file:
+            return True
+        if self.max_bytes_per_file and self.writer.numbytes >= self.max_bytes_per_file:
+            return True
+        return False
+
+    def write(self, recs):
+        '''
+        Write records to the current output file, rolling over to a new output
+        file whenever max_rows_per_file or max_bytes_per_file is reached.
+        '''
+        t0 = time.time()
+        idx = 0
+        # skip the records of a resumed folder that are already in output files
+        if self.skip_numrecs:
+            idx = min(self.skip_numrecs, len(recs))
+            self.skip_numrecs -= idx
+            self.folder_numrecs += idx
+        while idx < len(recs):
+            if self.writer is None:
+                self.open_writer()
+            chunk_size = self.write_batch_size
+            if self.max_rows_per_file:
+                chunk_size = min(chunk_size, self.max_rows_per_file-self.writer.numrecs)
+            chunk = recs[idx:idx+chunk_size]
+            self.writer.write(chunk)
+            self.folder_numrecs += len(chunk)
+            idx += chunk_size
+            if self.writer_is_full():
+                self.close_writer()
+        self.write_time += time.time() - t0
 
     def zip_files(self, fp_params):
         outfp = (self.output_convention+'.zip').format(**fp_params)
@@ -155,73 +394,687 @@ class SandboxExporter(object):
         self.print_func('Output zip file containing {} files at:\n{}'.format(len(self.file_names), outfp))
 
 
-    def process(self, key):
-        sb,sk = key
-        stream = self.mover.get_data_stream(sb, sk)
-        recs = []
-        for r in self.mover.newline_json_rec_generator(stream):
-            if self.csv:
-                recs += self.flattener.process_and_split(r)
-            else:
-                recs.append(r)
-        self.current_recs += recs
+    def process_stream(self, stream):
+        t0 = time.time()
+        write_time = self.write_time
+        for recs in iter_rec_batches(self.mover, self.flattener, stream, self.csv, self.write_batch_size):
+            self.flatten_numrecs += len(recs)
+            self.write(recs)
+        self.flatten_time += time.time() - t0 - (self.write_time - write_time)
         return
 
+    def process_parallel(self, keys):
+        '''
+        Process keys in the worker pool, keeping at most max_inflight_keys keys
+        in flight. Records are written in the order of the keys.
+        '''
+        keys = deque(keys)
+        inflight = deque()
+        while keys or inflight:
+            while keys and len(inflight) < self.max_inflight_keys:
+                inflight.append(self.pool.submit(process_key_in_worker, keys.popleft()))
+            recs, pid, timestamp_stats = inflight.popleft().result()
+            self.write(recs)
+            self.worker_timestamp_stats[pid] = timestamp_stats
+        return
+
+    def get_timestamp_stats(self):
+        stats = dict(timestamp_parser.get_stats())
+        for worker_stats in self.worker_timestamp_stats.values():
+            for k, v in worker_stats.items():
+                stats[k] += v
+        return stats
+
     def run(self):
         self.print_func('===========START===========')
         self.print_func('Exporting {} {} data between {} and {}'.format(self.pilot, self.message_type, self.sdate, self.edate))
         t0 = time.time()
-        fp_params = {
+        self.fp_params = {
             'pilot': self.pilot,
             'message_type': self.message_type.lower(),
             'sdate': self.sdate.strftime('%Y%m%d%H'),
             'edate': self.edate.strftime('%Y%m%d%H')
         }
-        fp = lambda filenum: (self.output_convention+'_{filenum}').format(filenum=filenum, **fp_params)
         sfolder = self.get_folder_prefix(self.sdate)
         efolder = self.get_folder_prefix(self.edate)
 
         numkeys = 0
-        filenum = 0
-        numrecs = 0
-        curr_folder = sfolder
-        curr_dt = copy(self.sdate)
-        while curr_folder < efolder:
-            threads = []
-            keys = self.mover.get_fps_from_prefix(self.bucket, curr_folder)
+        folders = self.get_folder_prefixes()
+        self.manifest = ExportManifest((self.output_convention+'_manifest.json').format(**self.fp_params),
+                                       dict(self.fp_params, bucket=self.bucket, output_format=self.output_format))
+        if self.resume and os.path.exists(self.manifest.fp):
+            folders = self.load_manifest(folders)
+        else:
+            if self.resume:
+                self.print_func('No checkpoint manifest found at {}. Starting a new export.'.format(self.manifest.fp))
+            self.manifest.start()
+        if self.workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=init_worker,
+                                            initargs=(self.bucket, self.pilot, self.message_type, self.csv,
+                                                      self.aws_profile, self.max_pool_connections))
+            self.print_func('Processing keys with {} worker processes'.format(self.workers))
+        elif self.prefetch_depth > 0:
+            self.pipeline = S3PrefetchPipeline(self.mover, self.bucket, folders,
+                                               list_func=self.get_folder_objects,
+                                               prefetch_depth=self.prefetch_depth,
+                                               threads=self.max_pool_connections,
+                                               memory_budget=self.memory_budget)
+            self.print_func('Prefetching up to {} keys with {} threads'.format(self.prefetch_depth, self.max_pool_connections))
+        for curr_folder, keys, etags, streams in self.iter_folders(folders):
+            self.curr_folder = curr_folder
+            self.curr_etags = etags
+            self.folder_numrecs = 0
+            if curr_folder == self.manifest.partial_folder:
+                self.skip_numrecs = self.manifest.partial_numrecs
+                if etags != self.manifest.partial_etags:
+                    self.print_func('Warning: files in {} changed since the interrupted export. The first {} records of this folder are not exported again.'.format(curr_folder, self.skip_numrecs))
             if len(keys) > 0:
                 self.print_func('Processing {} keys from {}'.format(len(keys), curr_folder))
-            for key in keys:
-                self.process(key)
+            if self.pool:
+                self.process_parallel(keys)
+            else:
+                for stream in streams:
+                    self.process_stream(stream)
             if len(keys) > 0:
-                self.print_func('{} recs processed from {}'.format(len(self.current_recs), curr_folder))
+                self.print_func('{} recs processed from {}'.format(self.folder_numrecs, curr_folder))
 
             numkeys += len(keys)
-            curr_dt += timedelta(hours=1)
-            curr_folder = self.get_folder_prefix(curr_dt)
+            self.complete_folder(curr_folder, etags)
+            if self.writer and self.roll_at_folder_end():
+                self.close_writer()
 
-            if len(self.current_recs) > 10000:
-                self.write(self.current_recs, fp(filenum))
-                numrecs += len(self.current_recs)
-                self.current_recs = []
-                filenum += 1
-
-        if self.current_recs:
-            self.write(self.current_recs, fp(filenum))
-            numrecs += len(self.current_recs)
-            filenum += 1
+        if self.writer:
+            self.close_writer()
+        self.manifest.finished = True
+        self.manifest.save()
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
         t1 = time.time()
+        stage_stats = []
+        if self.pipeline:
+            stage_stats = self.pipeline.get_stats_report()
+            self.pipeline = None
+        if self.key_index:
+            stage_stats.append('Key index: {index_folders} hour folders read from {fp}, {listed_folders} listed from S3'.format(fp=self.key_index.fp, **self.key_index.get_stats()))
+            self.key_index.close()
+        if self.flatten_numrecs:
+            stage_stats.append('Reading: {} recs in {:.1f} s ({:.0f} recs/s)'.format(self.flatten_numrecs, self.flatten_time, self.flatten_numrecs/max(self.flatten_time, 1e-6)))
+        if self.numrecs:
+            stage_stats.append('Writing: {} recs in {:.1f} s ({:.0f} recs/s)'.format(self.numrecs, self.write_time, self.numrecs/max(self.write_time, 1e-6)))
         self.print_func('===========================')
         self.print_func('{} keys retrieved between s3://{}/{} and s3://{}/{}'.format(numkeys, self.bucket, sfolder, self.bucket, efolder ))
-        self.print_func('{} records read and written to {} files in {} min'.format(numrecs, filenum, (t1-t0)/60))
+        self.print_func('{} records read and written to {} files in {} min'.format(self.numrecs, self.filenum, (t1-t0)/60))
+        for stage_stat in stage_stats:
+            self.print_func(stage_stat)
+        if self.csv:
+            self.print_func('Timestamps parsed: {hits} by fast parser, {fallbacks} by dateutil fallback'.format(**self.get_timestamp_stats()))
         if self.zip and self.file_names:
-            self.zip_files(fp_params)
+            self.zip_files(self.fp_params)
         elif self.file_names:
             self.print_func('Output files:\n{}'.format('\n'.join(self.file_names)))
         self.print_func('============END============')
         return
 
 
+class ExportManifest(object):
+    '''
+    Checkpoint manifest of a SandboxExporter run, saved as json next to the
+    output files. It records:
+    - completed_folders: hour folders whose records are all in closed output files
+    - output_files: output files produced
+    - partial_folder, partial_numrecs, partial_etags: the hour folder being
+    exported when the last output file was closed, how many of its records went
+    into closed files and the ETags of its S3 keys
+
+    The ETags of the keys of completed folders go to an append-only keys log
+    next to the manifest (one json line per folder), so that the manifest
+    rewritten on every save does not grow with the number of keys exported.
+    '''
+
+    def __init__(self, fp, params):
+        self.fp = fp
+        self.keys_fp = os.path.splitext(fp)[0] + '_keys.jsonl'
+        self.params = params
+        self.completed_folders = []
+        # ETags of the keys of each completed folder, read from the keys log
+        self.completed_etags = {}
+        self.output_files = []
+        self.partial_folder = None
+        self.partial_numrecs = 0
+        self.partial_etags = {}
+        self.numrecs = 0
+        self.finished = False
+
+    def load(self):
+        with open(self.fp, 'r') as infile:
+            manifest = json.load(infile)
+        if manifest['params'] != self.params:
+            raise ValueError('Checkpoint manifest {} belongs to a different export: {}'.format(self.fp, manifest['params']))
+        for k in ['completed_folders', 'output_files', 'partial_folder', 'partial_numrecs', 'partial_etags', 'numrecs', 'finished']:
+            setattr(self, k, manifest[k])
+        self.completed_etags = {}
+        if os.path.exists(self.keys_fp):
+            with open(self.keys_fp, 'r') as infile:
+                for line in infile:
+                    # a folder exported again after an interruption is logged again, the last entry wins
+                    entry = json.loads(line)
+                    self.completed_etags[entry['folder']] = entry['etags']
+
+    def start(self):
+        '''
+        Empty the keys log of a previous export, when starting a new one.
+        '''
+        open(self.keys_fp, 'w').close()
+
+    def complete_folders(self, folders):
+        '''
+        Mark folders as completed and append the ETags of their keys to the
+        keys log. The log is written before the manifest is saved, so every
+        completed folder of a saved manifest has its ETags logged.
+
+        Parameters:
+            folders: list of (folder, etags) tuples
+        '''
+        with open(self.keys_fp, 'a') as outfile:
+            for folder, etags in folders:
+                outfile.write(json.dumps({'folder': folder, 'etags': etags}) + '\n')
+                self.completed_etags[folder] = etags
+        self.completed_folders += [folder for folder, _ in folders]
+
+    def save(self):
+        manifest = {k: getattr(self, k) for k in ['params', 'completed_folders', 'output_files', 'partial_folder',
+                                                  'partial_numrecs', 'partial_etags', 'numrecs', 'finished']}
+        # write to a temporary file first, so an interruption never leaves a truncated manifest
+        with open(self.fp+'.tmp', 'w') as outfile:
+            json.dump(manifest, outfile)
+        os.replace(self.fp+'.tmp', self.fp)
+
+
+class StreamingCsvWriter(object):
+    '''
+    Writes flattened records to a CSV file as they arrive, without holding them
+    in memory.
+
+    Rows are spooled to a temporary file with the columns known so far, newly
+    discovered columns being appended to the column list. close() writes the
+    final file with the full header in one pass over the spool, padding rows
+    that were written before later columns appeared.
+    '''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.spool_fp = fp+'.spool'
+        self.spool_file = open(self.spool_fp, 'w', newline='')
+        self.spool_writer = csv.writer(self.spool_file)
+        self.columns = []
+        self.column_set = set()
+        self.numrecs = 0
+        self.numbytes = 0
+
+    def write(self, recs):
+        for rec in recs:
+            for k in rec:
+                if k not in self.column_set:
+                    self.column_set.add(k)
+                    self.columns.append(k)
+            self.spool_writer.writerow([rec.get(k, '') for k in self.columns])
+        self.numrecs += len(recs)
+        self.numbytes = self.spool_file.tell()
+
+    def close(self):
+        self.spool_file.close()
+        numcols = len(self.columns)
+        with open(self.spool_fp, newline='') as spool_file, open(self.fp, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(self.columns)
+            for row in csv.reader(spool_file):
+                if len(row) < numcols:
+                    row += ['']*(numcols-len(row))
+                writer.writerow(row)
+        os.remove(self.spool_fp)
+
+
+class JsonNewlineWriter(object):
+    '''
+    Writes records to a newline json file as they arrive.
+    '''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.outfile = open(fp, 'w')
+        self.numrecs = 0
+        self.numbytes = 0
+
+    def write(self, recs):
+        for r in recs:
+            self.outfile.write(json_codec.dumps(r))
+            self.outfile.write('\n')
+        self.numrecs += len(recs)
+        self.numbytes = self.outfile.tell()
+
+    def close(self):
+        self.outfile.close()
+
+
+def read_arrow_schema(fp, file_format):
+    import pyarrow as pa
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(fp)
+    with pa.OSFile(fp, 'rb') as f:
+        return pa.ipc.open_file(f).schema
+
+
+class ArrowWriter(object):
+    '''
+    Writes flattened records to a Parquet or Arrow IPC file with typed columns.
+
+    Records are spooled to a temporary file in batches of row_group_size while
+    the type of each column is tracked. close() derives the schema and writes
+    one Parquet row group (or Arrow record batch) per spooled batch, so only one
+    batch is held in memory at a time. Column types:
+    - bool values only: bool column
+    - int values only: int64 column
+    - int and float values: float64 column
+    - valid timestamp strings only (e.g. metadata_generatedAt): timestamp
+      column, in UTC. A column holding a string that is not a valid date (e.g.
+      2019-02-30T00:00:00Z) is a string column.
+    - no values: null column
+    - anything else: string column, with lists and dicts dumped as json
+
+    The schema of the files written before is reused, so that all files of an
+    export agree. Only columns without values so far (null) take the type of
+    their values, and int64 columns widen to float64 once they hold floats, so
+    read a whole export with a unified schema, e.g.
+    pyarrow.dataset.dataset(files, schema=pyarrow.unify_schemas(schemas, promote_options='permissive')).
+    '''
+
+    def __init__(self, fp, file_format='parquet', row_group_size=100000, schema=None, print_func=print):
+        '''
+        Parameters:
+            schema: pyarrow schema of the files written before in the same export
+            print_func: function printing the messages of the writer, e.g. the
+                print_func of the exporter
+        '''
+        if importlib.util.find_spec('pyarrow') is None:
+            raise ImportError('pyarrow is required for {} output. Install it with: pip install pyarrow'.format(file_format))
+        self.fp = fp
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.base_schema = schema
+        self.print_func = print_func
+        # schema of this file, set by close
+        self.schema = None
+        self.spool_fp = fp+'.spool'
+        self.spool_file = open(self.spool_fp, 'wb')
+        self.batch = []
+        self.columns = []
+        self.column_types = {}
+        self.timestamp_columns = set()
+        self.numrecs = 0
+        # size of the spooled batches, as the compressed output size is only known at close
+        self.numbytes = 0
+
+    def track_types(self, rec):
+        for k, v in rec.items():
+            if k not in self.column_types:
+                self.columns.append(k)
+                self.column_types[k] = set()
+                self.timestamp_columns.add(k)
+            if v is None:
+                continue
+            self.column_types[k].add(type(v))
+            if k in self.timestamp_columns and not (type(v) == str and self.is_timestamp(v)):
+                self.timestamp_columns.discard(k)
+
+    def is_timestamp(self, v):
+        '''
+        Whether a string is a timestamp parse_utc reads without falling back
+        to dateutil, i.e. in the format of the fast parser and a valid date.
+        '''
+        try:
+            return timestamp_parser.parse_fast(v) is not None
+        except ValueError:
+            return False
+
+    def write(self, recs):
+        for rec in recs:
+            self.track_types(rec)
+            self.batch.append(rec)
+            if len(self.batch) >= self.row_group_size:
+                self.spool_batch()
+        self.numrecs += len(recs)
+
+    def spool_batch(self):
+        if self.batch:
+            pickle.dump(self.batch, self.spool_file, pickle.HIGHEST_PROTOCOL)
+            self.batch = []
+            self.numbytes = self.spool_file.tell()
+
+    def get_column_type(self, col):
+        import pyarrow as pa
+        types = self.column_types.get(col)
+        if not types:
+            return pa.null()
+        if types == {bool}:
+            return pa.bool_()
+        if types == {int}:
+            return pa.int64()
+        if types <= {int, float}:
+            return pa.float64()
+        if types == {str} and col in self.timestamp_columns:
+            return pa.timestamp('ms', tz='UTC')
+        return pa.string()
+
+    def get_schema(self):
+        '''
+        Returns:
+            schema of the base schema's columns followed by the new columns of
+            this file, with the types of the base schema except where it is null
+            or int64 and this file holds floats
+        '''
+        import pyarrow as pa
+        if self.base_schema is None:
+            return pa.schema([(col, self.get_column_type(col)) for col in self.columns])
+
+        base_types = dict(zip(self.base_schema.names, self.base_schema.types))
+        fields = []
+        for col in self.base_schema.names + [col for col in self.columns if col not in base_types]:
+            dtype = self.get_column_type(col)
+            base_dtype = base_types.get(col)
+            if base_dtype == pa.int64() and dtype == pa.float64():
+                # whole numbers so far, floats from this file on
+                base_dtype = dtype
+            if base_dtype is not None and not pa.types.is_null(base_dtype):
+                # whole numbers fit a float64 column of earlier files
+                if not pa.types.is_null(dtype) and dtype != base_dtype and base_dtype != pa.string() and \
+                        not (base_dtype == pa.float64() and dtype == pa.int64()):
+                    self.print_func('Column {} holds {} values in {}, but {} values in earlier files. Writing it as string.'.format(
+                        col, dtype, self.fp, base_dtype))
+                    base_dtype = pa.string()
+                dtype = base_dtype
+            fields.append((col, dtype))
+        return pa.schema(fields)
+
+    def parse_utc(self, date_str):
+        # timestamps without an offset are taken to be in UTC
+        dt = parse_date(date_str)
+        if dt.utcoffset() is not None:
+            dt = dt.replace(tzinfo=None) - dt.utcoffset()
+        return dt
+
+    def get_column_values(self, batch, col, dtype):
+        import pyarrow as pa
+        values = [rec.get(col) for rec in batch]
+        if dtype == pa.float64():
+            return [float(v) if v is not None else None for v in values]
+        if pa.types.is_timestamp(dtype):
+            return [self.parse_utc(v) if v is not None else None for v in values]
+        if dtype == pa.string():
+            return [v if v is None or type(v) == str else json_codec.dumps(v) if type(v) in [list, dict] else str(v)
+                    for v in values]
+        return values
+
+    def iter_batches(self):
+        with open(self.spool_fp, 'rb') as spool_file:
+            while True:
+                try:
+                    yield pickle.load(spool_file)
+                except EOFError:
+                    break
+
+    def close(self):
+        import pyarrow as pa
+        self.spool_batch()
+        self.spool_file.close()
+        schema = self.get_schema()
+        if self.file_format == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(self.fp, schema)
+            write_batch = writer.write_table
+            to_batch = pa.Table.from_arrays
+        else:
+            writer = pa.ipc.new_file(self.fp, schema)
+            write_batch = writer.write_batch
+            to_batch = pa.RecordBatch.from_arrays
+        try:
+            for batch in self.iter_batches():
+                arrays = [pa.array(self.get_column_values(batch, field.name, field.type), type=field.type)
+                          for field in schema]
+                write_batch(to_batch(arrays, schema=schema))
+        finally:
+            writer.close()
+        os.remove(self.spool_fp)
+        self.schema = schema
+
+
+class S3PrefetchPipeline(object):
+    '''
+    Staged reader of the S3 files in a list of hour folders:
+    1) a lister thread lists the upcoming hour folders ahead of time
+    2) a thread pool downloads and decompresses the files of those folders
+    3) the consumer iterates over (folder, keys, etags, streams), with streams
+    yielding the decompressed data of each key in key order.
+
+    Both stage queues are bounded, so at most prefetch_depth downloaded files
+    wait for the consumer at any time. If memory_budget is set, no new download
+    starts while the downloaded files not yet released by the consumer add up to
+    more than memory_budget bytes.
+    '''
+
+    def __init__(self, mover, bucket, folders, prefetch_depth=8, threads=10, list_ahead=2, memory_budget=None, list_func=None):
+        self.mover = mover
+        self.bucket = bucket
+        self.folders = folders
+        # lists the objects of a folder, e.g. from a key index
+        self.list_func = list_func or (lambda folder: mover.get_objects_from_prefix(bucket, folder))
+        self.prefetch_depth = prefetch_depth
+        self.threads = threads
+        self.list_ahead = list_ahead
+        self.memory_budget = memory_budget
+        self.buffered_bytes = 0
+        self.buffer_cond = threading.Condition()
+        self.stats = {
+            'list_folders': 0, 'list_keys': 0, 'list_time': 0,
+            'fetch_files': 0, 'fetch_bytes': 0, 'fetch_time': 0,
+            'wait_time': 0, 'throttle_time': 0
+        }
+        self.stats_lock = threading.Lock()
+
+    def add_stats(self, **kwargs):
+        with self.stats_lock:
+            for k, v in kwargs.items():
+                self.stats[k] += v
+
+    def list_folders(self, folder_queue):
+        try:
+            for folder in self.folders:
+                t0 = time.time()
+                objects = self.list_func(folder)
+                self.add_stats(list_folders=1, list_keys=len(objects), list_time=time.time()-t0)
+                folder_queue.put((folder, objects))
+            folder_queue.put(None)
+        except:
+            folder_queue.put(('error', traceback.format_exc()))
+
+    def fetch(self, key):
+        t0 = time.time()
+        sb,sk = key
+        stream = self.mover.get_data_bytes_stream(sb, sk)
+        numbytes = len(stream.getvalue())
+        with self.buffer_cond:
+            self.buffered_bytes += numbytes
+        self.add_stats(fetch_files=1, fetch_bytes=numbytes, fetch_time=time.time()-t0)
+        return stream
+
+    def wait_for_budget(self):
+        if not self.memory_budget:
+            return
+        t0 = time.time()
+        with self.buffer_cond:
+            while self.buffered_bytes >= self.memory_budget:
+                self.buffer_cond.wait()
+        self.add_stats(throttle_time=time.time()-t0)
+
+    def release(self, stream):
+        with self.buffer_cond:
+            self.buffered_bytes -= len(stream.getvalue())
+            self.buffer_cond.notify_all()
+
+    def schedule_fetches(self, folder_queue, file_queue, executor):
+        try:
+            folder_data = folder_queue.get()
+            while folder_data is not None:
+                if folder_data[0] == 'error':
+                    file_queue.put(folder_data)
+                    return
+                folder, objects = folder_data
+                keys = [(self.bucket, obj['Key']) for obj in objects]
+                etags = {obj['Key']: obj['ETag'] for obj in objects}
+                file_queue.put(('folder', folder, keys, etags))
+                for key in keys:
+                    self.wait_for_budget()
+                    file_queue.put(('file', executor.submit(self.fetch, key)))
+                folder_data = folder_queue.get()
+            file_queue.put(None)
+        except:
+            file_queue.put(('error', traceback.format_exc()))
+
+    def next_item(self, file_queue):
+        t0 = time.time()
+        item = file_queue.get()
+        if item is not None and item[0] == 'error':
+            raise RuntimeError('S3 prefetch failed:\n{}'.format(item[1]))
+        if item is not None and item[0] == 'file':
+            item = item[1].result()
+        self.add_stats(wait_time=time.time()-t0)
+        return item
+
+    def iter_streams(self, file_queue, numkeys):
+        for _ in range(numkeys):
+            stream = self.next_item(file_queue)
+            yield stream
+            self.release(stream)
+
+    def __iter__(self):
+        folder_queue = Queue(maxsize=self.list_ahead)
+        file_queue = Queue(maxsize=self.prefetch_depth)
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        threads = [
+            threading.Thread(target=self.list_folders, args=(folder_queue,)),
+            threading.Thread(target=self.schedule_fetches, args=(folder_queue, file_queue, executor))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            item = self.next_item(file_queue)
+            while item is not None:
+                _, folder, keys, etags = item
+                streams = self.iter_streams(file_queue, len(keys))
+                yield folder, keys, etags, streams
+                # drain streams the consumer did not read
+                for _ in streams:
+                    pass
+                item = self.next_item(file_queue)
+        finally:
+            executor.shutdown(wait=False)
+
+    def get_stats_report(self):
+        stats = self.stats
+        mb = stats['fetch_bytes']/1e6
+        return [
+            'Listing: {} folders, {} keys in {:.1f} s'.format(stats['list_folders'], stats['list_keys'], stats['list_time']),
+            'Prefetching: {} files, {:.1f} MB in {:.1f} s of download time ({:.2f} MB/s per connection)'.format(
+                stats['fetch_files'], mb, stats['fetch_time'], mb/max(stats['fetch_time'], 1e-6)),
+            'Waited {:.1f} s for prefetched files, prefetching paused {:.1f} s for memory budget'.format(
+                stats['wait_time'], stats['throttle_time'])
+        ]
+
+
+def iter_rec_batches(mover, flattener, stream, flatten=True, batch_size=1000):
+    '''
+    Read the records of a single S3 file in batches.
+
+    Parameters:
+        mover: CvPilotFileMover used to read the file
+        flattener: DataFlattener used to flatten the records
+        stream: data stream of the S3 file
+        flatten: whether records should be flattened
+        batch_size: number of raw records read per batch
+
+    Yields:
+        lists of records in the file, flattened if flatten is True
+    '''
+    recs = []
+    numrecs = 0
+    for r in mover.newline_json_rec_generator(stream):
+        if flatten:
+            recs += flattener.process_and_split(r)
+        else:
+            recs.append(r)
+        numrecs += 1
+        if numrecs == batch_size:
+            yield recs
+            recs = []
+            numrecs = 0
+    if recs:
+        yield recs
+
+
+def read_recs(mover, flattener, stream, flatten=True):
+    '''
+    Read all records of a single S3 file. See iter_rec_batches.
+
+    Returns:
+        list of records in the file, flattened if flatten is True
+    '''
+    recs = []
+    for batch in iter_rec_batches(mover, flattener, stream, flatten):
+        recs += batch
+    return recs
+
+
+def process_key(mover, flattener, key, flatten=True):
+    '''
+    Download and decompress a single S3 file and read its records.
+    See read_recs.
+    '''
+    sb,sk = key
+    stream = mover.get_data_stream(sb, sk)
+    return read_recs(mover, flattener, stream, flatten)
+
+
+# per-process state of the SandboxExporter worker pool, set up by init_worker
+worker_context = {}
+
+
+def init_worker(bucket, pilot, message_type, flatten, aws_profile, max_pool_connections=10):
+    session = boto3.session.Session(profile_name=aws_profile)
+    worker_context['mover'] = CvPilotFileMover(target_bucket=bucket,
+                                               source_bucket_prefix="",
+                                               source_key_prefix="",
+                                               validation_queue_names=None,
+                                               log=False,
+                                               s3_client=session.client('s3', config=Config(max_pool_connections=max_pool_connections)))
+    flattenerMod = load_flattener('{}/{}'.format(pilot, message_type.upper()))
+    worker_context['flattener'] = flattenerMod()
+    worker_context['flatten'] = flatten
+
+
+def process_key_in_worker(key):
+    '''
+    Flatten the records of a single S3 file inside a worker process.
+
+    Returns:
+        tuple of (records, worker process id, timestamp parser stats of the worker)
+    '''
+    recs = process_key(worker_context['mover'], worker_context['flattener'], key, worker_context['flatten'])
+    return recs, os.getpid(), timestamp_parser.get_stats()
+
+
 if __name__ == '__main__':
     """
     Sample Usage
@@ -243,9 +1096,22 @@ if __name__ == '__main__':
     parser.add_argument('--edate', default=None, help="Ending generatedAt date of your data, in the format of YYYY-MM-DD. If not supplied, this will be set to 24 hours from the start date.")
     parser.add_argument('--output_convention', default='{pilot}_{message_type}_{sdate}_{edate}', help="Supply string for naming convention of output file. Variables available for use in this string include: pilot, messate_type, sdate, edate. Note that a file number will always be appended to the output file name. Default: {pilot}_{message_type}_{sdate}_{edate}")
     parser.add_argument('--json', default=False, action='store_true', help="Supply flag if file is to be exported as newline json instead of CSV file. Default: False")
+    parser.add_argument('--format', default=None, choices=['csv', 'json', 'parquet', 'arrow'], help="Output file format (options: csv, json, parquet, arrow). Parquet and arrow files hold typed columns and require the pyarrow package. Overrides --json if supplied. Default: csv")
+    parser.add_argument('--row_group_size', type=int, default=100000, help="Number of records per Parquet row group or Arrow record batch. Default: 100000")
+    parser.add_argument('--max_rows_per_file', type=int, default=None, help="Maximum number of records per output file. A new output file is started once this is reached. Default: no limit. Without --max_rows_per_file and --max_mb_per_file, csv and json output files are rolled over at the end of the first hour folder that takes them past 10000 records")
+    parser.add_argument('--max_mb_per_file', type=float, default=None, help="Approximate maximum size of each output file in MB, measured on the uncompressed data written. A new output file is started once this is reached. Default: no limit")
+    parser.add_argument('--memory_budget_mb', type=float, default=None, help="Maximum MB of prefetched S3 data waiting to be flattened and written. Prefetching pauses while the writer is behind by more than this. Only used with --prefetch_depth. Default: no limit")
+    parser.add_argument('--resume', default=False, action='store_true', help="Supply flag to resume an interrupted export from the checkpoint manifest written next to its output files, skipping the hour folders already exported and warning about those whose S3 files changed since. Default: False")
+    parser.add_argument('--key_index', default=None, help="Path of a local SQLite index of the keys in each hour folder. Hour folders listed at least 48 hours after they ended are read from the index instead of S3, so repeat exports of the same dates start without listing. Default: None (no index)")
+    parser.add_argument('--key_index_max_age_hours', type=float, default=None, help="Maximum age in hours of the listing of an hour folder read from --key_index. Hour folders listed longer ago are listed from S3 again, e.g. to pick up files backfilled into old hours. Default: None (no limit)")
+    parser.add_argument('--refresh_index', default=False, action='store_true', help="Supply flag to list every hour folder from S3 again and update --key_index with the result. Default: False")
     parser.add_argument('--aws_profile', default='default', help="Supply name of AWS profile if not using default profile. AWS profile must be configured in ~/.aws/credentials on your machine. See https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html#shared-credentials-file for more information.")
     parser.add_argument('--zip', default=False, action='store_true', help="Supply flag if output files should be zipped together. Default: False")
     parser.add_argument('--log', default=False, action='store_true', help="Supply flag if script progress should be logged and not printed to the console. Default: False")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes used to download, decompress and flatten S3 files. Default: 1")
+    parser.add_argument('--max_inflight_keys', type=int, default=None, help="Maximum number of S3 files being processed by the workers at any time. Default: twice the number of workers")
+    parser.add_argument('--prefetch_depth', type=int, default=0, help="Number of S3 files to download and decompress ahead of the flattener, while upcoming hour folders are listed in the background. Not used with --workers. Default: 0 (no prefetching)")
+    parser.add_argument('--max_pool_connections', type=int, default=10, help="Size of the S3 connection pool, which is also the number of prefetching threads. Default: 10")
     args = parser.parse_args()
 
     exporter = SandboxExporter(
@@ -256,7 +1122,20 @@ if __name__ == '__main__':
         edate=args.edate,
         output_convention=args.output_convention,
         csv=bool(not args.json),
+        output_format=args.format,
+        row_group_size=args.row_group_size,
+        max_rows_per_file=args.max_rows_per_file,
+        max_mb_per_file=args.max_mb_per_file,
+        memory_budget_mb=args.memory_budget_mb,
+        resume=args.resume,
+        key_index=args.key_index,
+        key_index_max_age_hours=args.key_index_max_age_hours,
+        refresh_index=args.refresh_index,
         aws_profile=args.aws_profile,
         zip=args.zip,
-        log=args.log)
+        log=args.log,
+        workers=args.workers,
+        max_inflight_keys=args.max_inflight_keys,
+        prefetch_depth=args.prefetch_depth,
+        max_pool_connections=args.max_pool_connections)
     exporter.run()
@@ -3,41 +3,124 @@ Helper class for loading data to Socrata datasets on data.transportation.gov.
 
 '''
 import boto3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import copy
 import itertools
 import json
 import logging
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from sodapy import Socrata
+import threading
 import time
 
+import json_codec
+
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)  # necessary to make sure aws is logging
 
+# function converting values to each Socrata data type. Values of other types are kept as is.
+dtype_funcs = {'number': float, 'text': str, 'checkbox': bool}
+# mod_dtype drops values that are this empty string object (compared by identity)
+empty_str = ''
+
+# Socrata clients by connection parameters and column metadata by data set, kept
+# at module level so that warm Lambda invocations reuse them
+socrata_clients = {}
+col_dtype_cache = {}
+cache_lock = threading.Lock()
+
 
 class SocrataDataset(object):
-    def __init__(self, dataset_id, socrata_client=None, socrata_params={}, float_fields=[]):
+    # bounds of the adaptive upsert chunk size, in bytes of json
+    min_chunk_bytes = 64*1024
+    max_chunk_bytes = 16*1024*1024
+    # upsert requests slower than this shrink the chunk size
+    upsert_target_seconds = 5
+    upsert_max_retries = 3
+    # seconds to wait before the first retry of a chunk, doubled for each further retry
+    retry_delay = 1
+    # responses worth retrying: request timeout, throttling and server errors
+    retry_status_codes = (408, 429, 500, 502, 503, 504)
+    # responses meaning the request took too long, e.g. because the chunk was too large
+    timeout_status_codes = (408, 504)
+    # seconds for which the column metadata of a data set is reused
+    metadata_ttl = 15*60
+    # keep-alive connections pooled by the session of a Socrata client
+    pool_maxsize = 16
+    # publication API responses meaning the draft is still being prepared
+    draft_pending_status_codes = (202, 409)
+    # publication API requests are only repeated after these responses, since they were not processed:
+    # a server error may come after a draft was created or published, so the request is not sent again
+    draft_retry_status_codes = draft_pending_status_codes + (429,)
+    # seconds to wait before polling a draft again, doubled up to draft_poll_max_delay
+    draft_poll_delay = 0.5
+    draft_poll_max_delay = 8
+    draft_poll_timeout = 120
+
+    def __init__(self, dataset_id, socrata_client=None, socrata_params={}, float_fields=[],
+                 upsert_threads=4, upsert_chunk_mb=1, base_url=None, col_dtype_dict=None):
+        '''
+    	Parameters:
+    		col_dtype_dict: data dictionary of the data set, retrieved from Socrata if not supplied
+    		upsert_threads: maximum number of upsert requests in flight
+    		upsert_chunk_mb: initial size of the json payload of each upsert request,
+    		adapted as requests complete
+    		base_url: url that upsert and publication requests are sent to,
+    		instead of https://<socrata domain> (e.g. a local stand-in for Socrata)
+        '''
         self.dataset_id = dataset_id
         self.client = socrata_client
         if not socrata_client and socrata_params:
-            self.client = Socrata(**socrata_params)
+            self.client = self.get_client(socrata_params)
         self.socrata_params = socrata_params
-        self.col_dtype_dict = self.get_col_dtype_dict()
+        self.col_dtype_dict = col_dtype_dict or self.get_col_dtype_dict()
         self.float_fields = float_fields
+        self.schema = self.compile_schema(self.col_dtype_dict, self.float_fields)
+        self.upsert_threads = upsert_threads
+        self.chunk_bytes = int(upsert_chunk_mb*1024*1024)
+        # size of the smallest chunk that timed out, which the chunk size does not grow back to
+        self.failed_chunk_bytes = None
+        self.base_url = base_url or 'https://{}'.format(self.client.domain)
+
+    def get_client(self, socrata_params):
+        '''
+        Return the Socrata client for a set of connection parameters, creating
+        it on first use. Its session keeps up to pool_maxsize connections alive
+        for later requests, including those of later Lambda invocations.
+        '''
+        client_key = tuple(sorted(socrata_params.items()))
+        with cache_lock:
+            client = socrata_clients.get(client_key)
+            if client is None:
+                adapter = HTTPAdapter(pool_connections=self.pool_maxsize, pool_maxsize=self.pool_maxsize)
+                client = Socrata(session_adapter={'prefix': 'https://', 'adapter': adapter}, **socrata_params)
+                socrata_clients[client_key] = client
+        return client
 
     def get_col_dtype_dict(self):
         '''
         Retrieve data dictionary of a Socrata data set in the form of a dictionary,
-        with the key being the column name and the value being the column data type
+        with the key being the column name and the value being the column data type.
+        The metadata is cached for metadata_ttl seconds.
 
     	Returns:
     		data dictionary of a Socrata data set in the form of a dictionary,
             with the key being the column name and the value being the column data type
         '''
+        cache_key = (self.client.domain, self.dataset_id)
+        with cache_lock:
+            cached = col_dtype_cache.get(cache_key)
+        if cached and time.time() - cached[0] < self.metadata_ttl:
+            return dict(cached[1])
+
         dataset_col_meta = self.client.get_metadata(self.dataset_id)['columns']
         col_dtype_dict = {col['name']: col['dataTypeName'] for col in dataset_col_meta}
+        with cache_lock:
+            col_dtype_cache[cache_key] = (time.time(), dict(col_dtype_dict))
         return col_dtype_dict
 
     def mod_dtype(self, rec, col_dtype_dict=None, float_fields=None):
@@ -55,45 +138,306 @@ class SocrataDataset(object):
     		dictionary object of the data record, with number, string, and boolean fields
             modified to align with the data type of the corresponding Socrata data set
         '''
-        col_dtype_dict = col_dtype_dict or self.col_dtype_dict
-        float_fields = float_fields or self.float_fields
+        return self.mod_dtypes([rec], col_dtype_dict, float_fields)[0]
 
-        identity = lambda x: x
-        dtype_func = {'number': float, 'text': str, 'checkbox': bool}
-        out = {}
-        for k,v in rec.items():
-            if k in float_fields and k in col_dtype_dict:
-                out[k] = float(v)
-            elif k in col_dtype_dict:
-                if v is not None and v is not '':
-                    out[k] = dtype_func.get(col_dtype_dict.get(k, 'nonexistentKey'), identity)(v)
-        out = {k:v for k,v in out.items() if k in col_dtype_dict}
-        return out
+    def compile_schema(self, col_dtype_dict, float_fields):
+        '''
+        Compile the data dictionary of a Socrata data set into the coercion of
+        each column, as applied by mod_dtypes.
+
+    	Returns:
+    		dictionary of column name to the function converting its values, or
+    		None to keep them as is, for all columns except the float fields;
+    		and set of float fields that are columns of the data set
+        '''
+        col_funcs = {k: dtype_funcs.get(dtype) for k, dtype in col_dtype_dict.items() if k not in float_fields}
+        float_cols = set(k for k in float_fields if k in col_dtype_dict)
+        return col_funcs, float_cols
+
+    def mod_dtypes(self, recs, col_dtype_dict=None, float_fields=None):
+        '''
+        Apply mod_dtype to a list of data records in one pass, with the coercion
+        of each column compiled once per data set.
+
+    	Parameters:
+    		recs: list of dictionary objects of the data records
+            col_dtype_dict, float_fields: see mod_dtype
+
+    	Returns:
+    		list of dictionary objects of the data records, as returned by mod_dtype
+        '''
+        if col_dtype_dict or float_fields:
+            col_funcs, float_cols = self.compile_schema(col_dtype_dict or self.col_dtype_dict, float_fields or self.float_fields)
+        else:
+            col_funcs, float_cols = self.schema
+
+        get_func = col_funcs.get
+        missing = object()
+        out_recs = []
+        for rec in recs:
+            out = {}
+            for k, v in rec.items():
+                func = get_func(k, missing)
+                if func is missing:
+                    # float fields are converted even if None or empty
+                    if k in float_cols:
+                        out[k] = float(v)
+                elif v is not None and v is not empty_str:
+                    # converting a value to its own type returns it unchanged
+                    out[k] = v if func is None or type(v) is func else func(v)
+            out_recs.append(out)
+        return out_recs
+
+    def poll_draft_request(self, method, path, **kwargs):
+        '''
+        Send a request to the publication API with the pooled session of the
+        client. While Socrata answers that the draft is still being prepared,
+        or that requests are throttled, the request is repeated with backoff
+        for up to draft_poll_timeout seconds. Any other response, including a
+        server error, is returned as is.
+
+    	Returns:
+    		last response received
+        '''
+        delay = self.draft_poll_delay
+        deadline = time.time() + self.draft_poll_timeout
+        while True:
+            response = self.client.session.request(method, self.base_url + path,
+                                                   auth=(self.socrata_params['username'], self.socrata_params['password']),
+                                                   timeout=self.client.timeout, **kwargs)
+            status_code = response.status_code
+            if status_code not in self.draft_retry_status_codes or time.time() + delay > deadline:
+                return response
+            logger.info('Draft not ready ({} {}: {}). Polling again in {} s'.format(method, path, status_code, delay))
+            time.sleep(delay)
+            delay = min(delay*2, self.draft_poll_max_delay)
 
     def create_new_draft(self):
-        draftDataset = requests.post('https://{}/api/views/{}/publication.json'.format(self.client.domain, self.dataset_id),
-                                  auth=(self.socrata_params['username'], self.socrata_params['password']),
-                                  params={'method': 'copySchema'})
+        draftDataset = self.poll_draft_request('POST', '/api/views/{}/publication.json'.format(self.dataset_id),
+                                               params={'method': 'copySchema'})
         logger.info(draftDataset.json())
         draftId = draftDataset.json()['id']
         return draftId
 
     def publish_draft(self, draftId):
-        time.sleep(5)
-        publishResponse = requests.post('https://{}/api/views/{}/publication.json'.format(self.client.domain, draftId),
-                                        auth=(self.socrata_params['username'], self.socrata_params['password']))
+        publishResponse = self.poll_draft_request('POST', '/api/views/{}/publication.json'.format(draftId))
         logger.info(publishResponse.json())
         return publishResponse
 
     def delete_draft(self, draftId):
-        time.sleep(5)
-        deleteResponse = self.client.delete(draftId)
+        deleteResponse = self.poll_draft_request('DELETE', '/api/views/{}.json'.format(draftId))
         if deleteResponse.status_code == 200:
             logger.info('Empty draft {} has been discarded.'.format(draftId))
         return deleteResponse
 
     def clean_and_upsert(self, recs, dataset_id=None):
         dataset_id = dataset_id or self.dataset_id
-        out_recs = [self.mod_dtype(r) for r in recs]
-        uploadResponse = self.client.upsert(dataset_id, out_recs)
+        out_recs = self.mod_dtypes(recs)
+        uploadResponse = self.upsert(out_recs, dataset_id)
         return uploadResponse
+
+    def upsert(self, recs, dataset_id=None):
+        '''
+        Upsert records to a Socrata data set in chunks of about chunk_bytes of
+        json, with up to upsert_threads requests in flight.
+
+        The chunk size adapts as requests complete: it grows while full chunks
+        take less than half of upsert_target_seconds, and shrinks when they take
+        longer or time out. Chunks failing with a timeout, throttling or server
+        error are split to the current chunk size and retried with backoff, up
+        to upsert_max_retries times. Chunks in flight at the same time may be
+        applied in any order, so use upsert_threads=1 if records in different
+        chunks update the same row.
+
+    	Returns:
+    		upsert result returned by Socrata, with counts summed over all chunks
+        '''
+        dataset_id = dataset_id or self.dataset_id
+        parts = deque(json_codec.dumps_compact(rec) for rec in recs)
+        # at most an even share of the records per thread, so that every thread gets a chunk
+        max_chunk_bytes = max(self.min_chunk_bytes, sum(len(part)+1 for part in parts)/float(self.upsert_threads))
+        retries = deque()
+        inflight = {}
+        result = {}
+        stats = {'requests': 0, 'retries': 0, 'bytes': 0}
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=self.upsert_threads) as executor:
+            while parts or retries or inflight:
+                while (parts or retries) and len(inflight) < self.upsert_threads:
+                    chunk, attempt = retries.popleft() if retries else (self.next_chunk(parts, max_chunk_bytes), 0)
+                    # back off before a retry, on the worker thread
+                    delay = self.retry_delay*2**(attempt-1) if attempt else 0
+                    inflight[executor.submit(self.post_chunk, chunk, dataset_id, delay)] = (chunk, attempt)
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk, attempt = inflight.pop(future)
+                    stats['requests'] += 1
+                    try:
+                        chunk_result, elapsed = future.result()
+                    except Exception as e:
+                        if not self.is_retryable(e) or attempt >= self.upsert_max_retries:
+                            raise
+                        if self.is_timeout(e):
+                            self.adapt_chunk_bytes(chunk, None, timed_out=True)
+                        logger.info('Retrying upsert of {} records after error: {}. Chunk size now {} KB'.format(len(chunk), e, self.chunk_bytes//1024))
+                        stats['retries'] += 1
+                        retry_parts = deque(chunk)
+                        while retry_parts:
+                            retries.append((self.next_chunk(retry_parts, max_chunk_bytes), attempt+1))
+                        continue
+                    self.adapt_chunk_bytes(chunk, elapsed)
+                    stats['bytes'] += sum(len(part)+1 for part in chunk)
+                    for k, v in chunk_result.items():
+                        if isinstance(v, (int, float)) and not isinstance(v, bool):
+                            result[k] = result.get(k, 0) + v
+        logger.info('Upserted {} records to {} in {} requests ({} retried), {:.1f} MB in {:.1f} s. Chunk size now {} KB'.format(
+            len(recs), dataset_id, stats['requests'], stats['retries'], stats['bytes']/1e6, time.time()-t0, self.chunk_bytes//1024))
+        return result
+
+    def next_chunk(self, parts, max_chunk_bytes=None):
+        '''
+        Take serialized records from the left of the parts deque, up to
+        chunk_bytes (or max_chunk_bytes if smaller) of json and at least one
+        record.
+        '''
+        chunk_bytes = min(self.chunk_bytes, max_chunk_bytes or self.chunk_bytes)
+        chunk = [parts.popleft()]
+        numbytes = len(chunk[0])+2
+        while parts and numbytes+len(parts[0])+1 <= chunk_bytes:
+            numbytes += len(parts[0])+1
+            chunk.append(parts.popleft())
+        return chunk
+
+    def post_chunk(self, chunk, dataset_id, delay=0):
+        '''
+        Send one upsert request with a chunk of serialized records.
+
+    	Returns:
+    		upsert result returned by Socrata, and seconds taken by the request
+        '''
+        time.sleep(delay)
+        t0 = time.time()
+        response = self.client.session.post('{}/resource/{}.json'.format(self.base_url, dataset_id),
+                                            data=b'['+b','.join(chunk)+b']',
+                                            headers={'Content-Type': 'application/json'},
+                                            timeout=self.client.timeout)
+        if not response.ok:
+            logger.error(response.text)
+            response.raise_for_status()
+        return response.json(), time.time()-t0
+
+    def is_timeout(self, error):
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is not None and error.response.status_code in self.timeout_status_codes
+        return isinstance(error, requests.exceptions.Timeout)
+
+    def is_retryable(self, error):
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is not None and error.response.status_code in self.retry_status_codes
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    def adapt_chunk_bytes(self, chunk, elapsed, timed_out=False):
+        '''
+        Halve the chunk size after a request timed out, shrink it in proportion
+        after a slow one, and grow it by half, staying below the size of the
+        smallest chunk that timed out, after a full chunk finished in less than half of
+        upsert_target_seconds.
+        '''
+        numbytes = sum(len(part)+1 for part in chunk)
+        if timed_out:
+            chunk_bytes = self.chunk_bytes/2
+            self.failed_chunk_bytes = min(self.failed_chunk_bytes or numbytes, numbytes)
+        elif elapsed > self.upsert_target_seconds:
+            chunk_bytes = self.chunk_bytes*max(0.5, self.upsert_target_seconds/elapsed)
+        elif elapsed < self.upsert_target_seconds/2 and numbytes >= self.chunk_bytes/2:
+            # only a chunk close to the current size says the size can grow
+            chunk_bytes = self.chunk_bytes*1.5
+            if self.failed_chunk_bytes:
+                chunk_bytes = max(self.chunk_bytes, min(chunk_bytes, self.failed_chunk_bytes*0.8))
+        else:
+            return
+        self.chunk_bytes = int(min(self.max_chunk_bytes, max(self.min_chunk_bytes, chunk_bytes)))
+
+
+if __name__ == '__main__':
+    """
+    Benchmark of mod_dtypes against coercing records one field at a time as
+    mod_dtype used to, over 100k flattened WYDOT BSM records:
+    python socrata_util.py
+    """
+    import random
+    import timeit
+
+    rnd = random.Random(0)
+    col_dtype_dict = {
+        'metadata_recordType': 'text', 'metadata_securityResultCode': 'text', 'metadata_rmd_latitude': 'number',
+        'metadata_rmd_longitude': 'number', 'metadata_rmd_elevation': 'number', 'metadata_rmd_speed': 'number',
+        'metadata_rmd_heading': 'number', 'metadata_rmd_rxSource': 'text', 'metadata_payloadType': 'text',
+        'metadata_serialId_streamId': 'text', 'metadata_serialId_bundleSize': 'number', 'metadata_serialId_bundleId': 'number',
+        'metadata_serialId_recordId': 'number', 'metadata_serialId_serialNumber': 'number', 'metadata_schemaVersion': 'number',
+        'metadata_sanitized': 'checkbox', 'coreData_msgCnt': 'number', 'coreData_id': 'text', 'coreData_secMark': 'number',
+        'coreData_accelset_accelLat': 'number', 'coreData_accelset_accelLong': 'number', 'coreData_accelset_accelVert': 'number',
+        'coreData_accelset_accelYaw': 'number', 'coreData_accuracy_semiMajor': 'number', 'coreData_accuracy_semiMinor': 'number',
+        'coreData_accuracy_orientation': 'number', 'coreData_transmission': 'text', 'coreData_speed': 'number',
+        'coreData_heading': 'number', 'coreData_brakes_wheelBrakes_leftFront': 'checkbox',
+        'coreData_brakes_wheelBrakes_rightFront': 'checkbox', 'coreData_brakes_wheelBrakes_unavailable': 'checkbox',
+        'coreData_brakes_wheelBrakes_leftRear': 'checkbox', 'coreData_brakes_wheelBrakes_rightRear': 'checkbox',
+        'coreData_brakes_traction': 'text', 'coreData_brakes_abs': 'text', 'coreData_brakes_scs': 'text',
+        'coreData_brakes_brakeBoost': 'text', 'coreData_brakes_auxBrakes': 'text', 'coreData_size': 'text',
+        'metadata_generatedAt': 'calendar_date', 'metadata_generatedBy': 'text', 'metadata_receivedAt': 'calendar_date',
+        'dataType': 'text', 'coreData_position_long': 'number', 'coreData_position_lat': 'number', 'coreData_elevation': 'number',
+        'randomNum': 'number', 'metadata_generatedAt_timeOfDay': 'number', 'part2_vse_pp_confidence': 'number',
+        'part2_vse_events': 'text', 'part2_vse_ph_crumbdata': 'text', 'part2_vse_pp_radiusofcurve': 'number',
+        'part2_suve_cd_keyType': 'number', 'part2_suve_cd_role': 'text', 'part2_suve_cd_hpmsType': 'text',
+        'vehicleData_height': 'number', 'vehicleData_mass': 'number', 'coreData_position': 'point'}
+    float_fields = ['randomNum', 'metadata_generatedAt_timeOfDay']
+
+    def flattened_bsm(i):
+        lat, lon = 41+rnd.random(), -105+rnd.random()
+        rec = {
+            'metadata_logFileName': 'rxMsg_1568592011_2605:e000:1d06:2d00.csv', 'metadata_recordType': 'rxMsg',
+            'metadata_securityResultCode': 'success', 'metadata_rmd_latitude': str(lat), 'metadata_rmd_longitude': str(lon),
+            'metadata_rmd_elevation': '1800', 'metadata_rmd_speed': '20', 'metadata_rmd_heading': '90',
+            'metadata_rmd_rxSource': 'RV', 'metadata_payloadType': 'us.dot.its.jpo.ode.model.OdeBsmPayload',
+            'metadata_serialId_streamId': 'abc', 'metadata_serialId_bundleSize': 1, 'metadata_serialId_bundleId': 0,
+            'metadata_serialId_recordId': i, 'metadata_serialId_serialNumber': 0, 'metadata_schemaVersion': 6,
+            'metadata_sanitized': False, 'coreData_msgCnt': i % 128, 'coreData_id': '' if i % 7 == 0 else 'ABCD',
+            'coreData_secMark': rnd.randint(0, 59999), 'coreData_accelset_accelLat': 0, 'coreData_accelset_accelLong': 0.1,
+            'coreData_accelset_accelVert': 0, 'coreData_accelset_accelYaw': 0, 'coreData_accuracy_semiMajor': 2,
+            'coreData_accuracy_semiMinor': 2, 'coreData_accuracy_orientation': 0,
+            'coreData_transmission': None if i % 11 == 0 else 'NEUTRAL', 'coreData_speed': rnd.random()*30,
+            'coreData_heading': rnd.randint(0, 359), 'coreData_brakes_wheelBrakes_leftFront': False,
+            'coreData_brakes_wheelBrakes_rightFront': False, 'coreData_brakes_wheelBrakes_unavailable': True,
+            'coreData_brakes_wheelBrakes_leftRear': False, 'coreData_brakes_wheelBrakes_rightRear': False,
+            'coreData_brakes_traction': 'unavailable', 'coreData_brakes_abs': 'unavailable', 'coreData_brakes_scs': 'unavailable',
+            'coreData_brakes_brakeBoost': 'unavailable', 'coreData_brakes_auxBrakes': 'unavailable',
+            'coreData_size': '{"width": 200, "length": 500}', 'metadata_generatedAt': '2019-09-16T12:48:56.430',
+            'metadata_generatedBy': 'OBU', 'metadata_receivedAt': '2019-09-16T12:48:56.430',
+            'dataType': 'us.dot.its.jpo.ode.plugin.j2735.J2735Bsm', 'coreData_position_long': lon, 'coreData_position_lat': lat,
+            'coreData_elevation': 1800.1, 'randomNum': rnd.random(), 'metadata_generatedAt_timeOfDay': rnd.random()*24,
+            'vehicleData_height': 1.9, 'vehicleData_mass': 3000, 'coreData_position': 'POINT ({} {})'.format(lon, lat)}
+        if i % 3:
+            rec.update({'part2_vse_pp_confidence': 0, 'part2_vse_events': '{"eventAirBagDeployment": false}',
+                        'part2_vse_ph_crumbdata': [{'elevationOffset': 1, 'latOffset': 2, 'lonOffset': 3}],
+                        'part2_vse_pp_radiusofcurve': 0, 'part2_suve_cd_keyType': 0, 'part2_suve_cd_role': 'basicVehicle',
+                        'part2_suve_cd_hpmsType': 'none'})
+        return rec
+
+    def mod_dtype_per_field(rec):
+        identity = lambda x: x
+        out = {}
+        for k,v in rec.items():
+            if k in float_fields and k in col_dtype_dict:
+                out[k] = float(v)
+            elif k in col_dtype_dict:
+                if v is not None and v is not empty_str:
+                    out[k] = dtype_funcs.get(col_dtype_dict.get(k, 'nonexistentKey'), identity)(v)
+        out = {k:v for k,v in out.items() if k in col_dtype_dict}
+        return out
+
+    recs = [flattened_bsm(i) for i in range(100000)]
+    dataset = SocrataDataset('abcd-1234', float_fields=float_fields, col_dtype_dict=col_dtype_dict, base_url='http://localhost')
+    print('Coercing {} flattened BSM records ({} fields per record on average):'.format(len(recs), sum(len(rec) for rec in recs)//len(recs)))
+    for name, func in [('per field (previous mod_dtype)', lambda: [mod_dtype_per_field(rec) for rec in recs]),
+                       ('mod_dtypes', lambda: dataset.mod_dtypes(recs))]:
+        print('  {:<32} {:.2f} s'.format(name, min(timeit.repeat(func, number=1, repeat=3))))
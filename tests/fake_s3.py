@@ -0,0 +1,89 @@
+from datetime import datetime, timezone
+import hashlib
+import io
+
+
+class FakeS3Client(object):
+    '''
+    In-memory S3 client holding objects as {(bucket, key): bytes}.
+    list_objects_v2 returns pages of page_size entries, rolling keys up to
+    common prefixes when a delimiter is supplied, and resumes after the last
+    entry of the previous page as S3 does. The ETag of an object is the md5 of
+    its content, so it changes when the object is overwritten.
+    '''
+    def __init__(self, objects=None, page_size=1000):
+        self.objects = dict(objects or {})
+        self.page_size = page_size
+        self.calls = {}
+        self.uploads = {}
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def etag(self, bucket, key):
+        return '"{}"'.format(hashlib.md5(self.objects[(bucket, key)]).hexdigest())
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, StartAfter=None, ContinuationToken=None):
+        self.count('list_objects_v2')
+        names = []
+        for bucket, key in sorted(self.objects):
+            if bucket != Bucket or not key.startswith(Prefix) or (StartAfter and key <= StartAfter):
+                continue
+            rest = key[len(Prefix):]
+            name = Prefix + rest.split(Delimiter)[0] + Delimiter if Delimiter and Delimiter in rest else key
+            if not names or names[-1] != name:
+                names.append(name)
+        if ContinuationToken:
+            names = [name for name in names if name > ContinuationToken]
+        page = names[:self.page_size]
+        resp = {'Contents': [{'Key': name, 'Size': len(self.objects[(Bucket, name)]), 'ETag': self.etag(Bucket, name),
+                              'LastModified': datetime(2019, 9, 16, tzinfo=timezone.utc)}
+                             for name in page if (Bucket, name) in self.objects],
+                'CommonPrefixes': [{'Prefix': name} for name in page if (Bucket, name) not in self.objects]}
+        if len(names) > self.page_size:
+            resp['NextContinuationToken'] = page[-1]
+        return resp
+
+    def get_object(self, Bucket, Key):
+        self.count('get_object')
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.count('put_object')
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+        return {'ETag': self.etag(Bucket, Key)}
+
+    def delete_object(self, Bucket, Key):
+        self.count('delete_object')
+        self.objects.pop((Bucket, Key), None)
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.count('create_multipart_upload')
+        upload_id = 'upload{}'.format(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.count('upload_part')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"{}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.count('complete_multipart_upload')
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.count('abort_multipart_upload')
+        self.uploads.pop(UploadId, None)
+
+
+class FakeSession(object):
+    '''
+    Stands in for a boto3 session, returning the same fake client for every service.
+    '''
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def client(self, service_name, **kwargs):
+        return self.s3_client
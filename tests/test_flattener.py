@@ -0,0 +1,336 @@
+import copy
+import json
+import random
+import re
+
+import dateutil.parser
+import pytest
+
+from flattener import CvDataFlattener, DataFlattener, TimestampParser
+from flattener_thea import TheaBSMFlattener, TheaSPATFlattener, TheaTIMFlattener
+from flattener_wydot import WydotBSMFlattener, WydotTIMFlattener
+
+
+class RecursiveFlattener(object):
+    '''
+    Frozen copy of the recursive DataFlattener.flatten_dict and transform that
+    FlattenPlan and the iterative flatten_dict replaced. The output of the
+    current code must match it key for key, in the same order.
+    '''
+    def flatten_dict(self, d, json_string_fields=[]):
+        def expand(key, value):
+            if isinstance(value, dict):
+                # get key as value
+                if len(value.items()) == 1 and list(value.values())[0] == None:
+                    return [ (key, list(value.keys())[0])]
+                # dump as json string instead of expanding further
+                elif key in json_string_fields:
+                    return [(key, json.dumps(value))]
+                # expand dict
+                else:
+                    return [ (key + '_' + k, v) for k, v in self.flatten_dict(value, json_string_fields).items() ]
+            else:
+                return [ (key, value) ]
+
+        items = [ item for k, v in d.items() for item in expand(k, v) ]
+        return dict(items)
+
+    def transform(self, raw_rec, rename_prefix_fields=[], rename_fields=[],
+                int_fields=[], json_string_fields=[]):
+        out = self.flatten_dict(raw_rec, json_string_fields)
+
+        for old_prefix, new_prefix in rename_prefix_fields:
+            out = {k.replace(old_prefix, new_prefix) if old_prefix in k else k: v
+                   for k,v in out.items()}
+
+        for old_f, new_f in rename_fields:
+            if old_f in out:
+                out[new_f] = copy.deepcopy(out[old_f])
+                del out[old_f]
+
+        out = {k: int(v) if k in int_fields else v for k,v in out.items()}
+        return out
+
+
+# key names taken from the renaming rules, plus short ones that collide once joined with '_'
+KEYS = ['a', 'b', 'a_b', 'b_a', 'size', 'events', 'value', 'payload', 'data', 'coreData',
+        'metadata', 'position', 'latitude', 'longitude', 'elevation', 'accelSet', 'psid',
+        'schemaVersion', 'dataType', 'recordGeneratedAt', 'odeReceivedAt',
+        'receivedMessageDetails', 'locationData', 'MessageFrame', 'TravelerInformation',
+        'dataFrames', 'TravelerDataFrame', 'msgId', 'roadSignID', '_SEQUENCE', 'partII']
+
+SYNTHETIC_RULES = {
+    'rename_prefix_fields': [('a_', 'b_'), ('b_a', 'a'), ('payload_data_', '')],
+    'rename_fields': [('a', 'b'), ('b', 'a_b'), ('data', 'a')],
+    'int_fields': ['psid', 'b_b'],
+    'json_string_fields': ['size', 'a_b', 'events'],
+}
+
+
+def random_value(rnd, depth):
+    kind = rnd.random()
+    if depth > 0 and kind < 0.45:
+        return random_dict(rnd, depth - 1)
+    if kind < 0.55:
+        # enum
+        return {rnd.choice(KEYS): None}
+    if kind < 0.6:
+        return {}
+    if kind < 0.65:
+        return [random_dict(rnd, 0) for _ in range(rnd.randint(0, 2))]
+    if kind < 0.7:
+        return None
+    if kind < 0.8:
+        return rnd.choice(['x', '', 'POINT (1 2)', '2019-09-16T00:00:00.000Z'])
+    if kind < 0.9:
+        return rnd.uniform(-1e3, 1e3)
+    return rnd.randint(-10**6, 10**6)
+
+
+def random_dict(rnd, depth):
+    return {rnd.choice(KEYS): random_value(rnd, depth) for _ in range(rnd.randint(0, 5))}
+
+
+def random_records(seed, n=300):
+    rnd = random.Random(seed)
+    return [random_dict(rnd, rnd.randint(0, 5)) for _ in range(n)]
+
+
+def rule_sets():
+    out = [('synthetic', SYNTHETIC_RULES)]
+    for cls in [DataFlattener, CvDataFlattener, WydotBSMFlattener, WydotTIMFlattener,
+                TheaBSMFlattener, TheaTIMFlattener, TheaSPATFlattener]:
+        flattener = cls()
+        out.append((cls.__name__, {
+            'rename_prefix_fields': flattener.rename_prefix_fields,
+            'rename_fields': flattener.rename_fields,
+            'int_fields': flattener.int_fields,
+            'json_string_fields': flattener.json_string_fields,
+        }))
+    wydot_bsm = WydotBSMFlattener()
+    out.append(('WydotBSMFlattener.partII', {
+        'rename_prefix_fields': wydot_bsm.part2_rename_prefix_fields,
+        'rename_fields': wydot_bsm.part2_rename_fields,
+        'int_fields': [],
+        'json_string_fields': wydot_bsm.part2_json_string_fields,
+    }))
+    return out
+
+
+RULE_SETS = rule_sets()
+
+
+def run(func, *args, **kwargs):
+    '''
+    Returns:
+        the ordered items of the output of func, or the type of the exception
+        it raises (e.g. int fields whose value is not a number)
+    '''
+    try:
+        return list(func(*args, **kwargs).items())
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_flatten_dict_matches_recursive(seed):
+    old = RecursiveFlattener()
+    new = DataFlattener()
+    for json_string_fields in [[], SYNTHETIC_RULES['json_string_fields']]:
+        for rec in random_records(seed):
+            expected = list(old.flatten_dict(rec, json_string_fields).items())
+            assert list(new.flatten_dict(rec, json_string_fields).items()) == expected
+
+
+@pytest.mark.parametrize('name,rules', RULE_SETS, ids=[name for name, _ in RULE_SETS])
+def test_transform_matches_recursive(name, rules):
+    old = RecursiveFlattener()
+    new = DataFlattener()
+    for rec in random_records(name):
+        expected = run(old.transform, rec, **rules)
+        # twice, so that the second pass goes through the cached shapes
+        assert run(new.transform, rec, **rules) == expected
+        assert run(new.transform, rec, **rules) == expected
+
+
+@pytest.mark.parametrize('name,rules', RULE_SETS, ids=[name for name, _ in RULE_SETS])
+def test_transform_with_columns_keeps_columns(name, rules):
+    old = RecursiveFlattener()
+    new = DataFlattener()
+    rnd = random.Random(name)
+    for rec in random_records(name, n=100):
+        expected = run(old.transform, rec, **rules)
+        if not isinstance(expected, list):
+            continue
+        expected = dict(expected)
+        columns = set(rnd.sample(sorted(expected), len(expected)//2)) | {'coreData_speed', 'b_b'}
+        new.set_columns(columns)
+        out = new.transform(rec, **rules)
+        for col in columns:
+            assert out.get(col, 'missing') == expected.get(col, 'missing')
+
+
+def test_enum_empty_dict_and_collisions():
+    old = RecursiveFlattener()
+    new = DataFlattener()
+    rec = {
+        'a': {'b': 1, 'c': {'x': None}, 'd': {}, 'size': {'b': 2}},
+        'a_b': 3,
+        'b': {'a': 4},
+        'b_a': 5,
+    }
+    expected = list(old.transform(rec, **SYNTHETIC_RULES).items())
+    assert list(new.transform(rec, **SYNTHETIC_RULES).items()) == expected
+    flat = new.flatten_dict(rec, SYNTHETIC_RULES['json_string_fields'])
+    assert flat['a_c'] == 'x' and 'a_d' not in flat
+    assert flat['a_size'] == '{"b": 2}' and flat['a_b'] == 3
+
+
+def wydot_tim(dataframes_as_list):
+    def path(idx):
+        return {'anchor': {'lat': 411234567 + idx, 'long': -1048765432, 'elevation': 1800},
+                'name': 'Path {}'.format(idx),
+                'directionality': {'both': None},
+                'description': {'path': {'scale': 0, 'offset': {'xy': {'nodes': {'NodeXY': [
+                    {'delta': {'node-LatLon': {'lon': -1048765432 + idx*10 + k, 'lat': 411234567}}} for k in range(3)]}}}}}}
+
+    frame = {'frameType': {'advisory': None},
+             'msgId': {'roadSignID': {'position': {'lat': 411234567, 'long': -1048765432}, 'mutcdCode': {'warning': None}}},
+             'startYear': 2019,
+             'regions': {'GeographicalPath': [path(0), path(1)]},
+             'content': {'advisory': {'SEQUENCE': [{'item': {'itis': 777}}]}}}
+    return {
+        'metadata': {'schemaVersion': 6, 'recordGeneratedAt': '2019-09-16T12:00:11.123Z[UTC]',
+                     'odeReceivedAt': '2019-09-16T12:34:56.789Z', 'recordType': 'timMsg',
+                     'receivedMessageDetails': {'locationData': {'latitude': ''}, 'rxSource': 'NA'}},
+        'payload': {'dataType': 'TravelerInformation',
+                    'data': {'MessageFrame': {'messageId': 31, 'value': {'TravelerInformation': {
+                        'msgCnt': 1,
+                        'dataFrames': [{'TravelerDataFrame': frame}] if dataframes_as_list else {'TravelerDataFrame': frame}}}}}}}
+
+
+def without_random(rec):
+    return {k: v for k, v in rec.items() if k != 'randomNum'}
+
+
+@pytest.mark.parametrize('dataframes_as_list', [True, False])
+def test_two_path_tim_frame_splits_into_independent_records(dataframes_as_list):
+    flattener = WydotTIMFlattener()
+    raw_rec = wydot_tim(dataframes_as_list)
+    raw_copy = copy.deepcopy(raw_rec)
+    out_recs = flattener.process_and_split(raw_rec)
+
+    assert raw_rec == raw_copy
+    assert len(out_recs) == 2
+    frame = raw_rec['payload']['data']['MessageFrame']['value']['TravelerInformation']['dataFrames']
+    frame = (frame[0] if dataframes_as_list else frame)['TravelerDataFrame']
+    for out, path in zip(out_recs, frame['regions']['GeographicalPath']):
+        # each split matches the record holding only its own path, as a single frame
+        single_path_rec = copy.deepcopy(raw_rec)
+        single_path_frame = dict(copy.deepcopy(frame), regions={'GeographicalPath': path})
+        single_path_rec['payload']['data']['MessageFrame']['value']['TravelerInformation']['dataFrames'] = {'TravelerDataFrame': single_path_frame}
+        assert without_random(out) == without_random(flattener.process(single_path_rec))
+        assert out['travelerdataframe_name'] == path['name']
+        assert out['travelerdataframe_anchor_lat'] == path['anchor']['lat']
+    assert out_recs[0]['travelerdataframe_desc_nodes'] != out_recs[1]['travelerdataframe_desc_nodes']
+
+    # changing one record leaves the other and the raw record alone
+    out_recs[0]['metadata_recordType'] = 'changed'
+    out_recs[0]['travelerdataframe_desc_nodes'].append('changed')
+    assert out_recs[1]['metadata_recordType'] == 'timMsg'
+    assert 'changed' not in out_recs[1]['travelerdataframe_desc_nodes']
+    assert raw_rec == raw_copy
+
+
+def test_flatten_split_records_do_not_share_fields():
+    flattener = DataFlattener()
+    rec = {'a': 1, 'b': {'c': {'d': 'x'}, 'e': 2}, 'f': 3}
+    out_recs = flattener.flatten_split(rec, ['b', 'c'], [{'d': 'y'}, {'d': 'z', 'g': 4}])
+    assert out_recs == [
+        {'a': 1, 'b_c_d': 'y', 'b_e': 2, 'f': 3},
+        {'a': 1, 'b_c_d': 'z', 'b_c_g': 4, 'b_e': 2, 'f': 3},
+    ]
+    # in the order of flatten_dict
+    assert [list(out) for out in out_recs] == [list(flattener.flatten_dict({'a': 1, 'b': {'c': value, 'e': 2}, 'f': 3}))
+                                               for value in [{'d': 'y'}, {'d': 'z', 'g': 4}]]
+    out_recs[0]['a'] = 'changed'
+    assert out_recs[1]['a'] == 1
+    assert rec == {'a': 1, 'b': {'c': {'d': 'x'}, 'e': 2}, 'f': 3}
+
+
+def parse_with_dateutil(date_str):
+    return dateutil.parser.parse(re.sub(r'\[[a-zA-Z]*\]', '', date_str))
+
+
+def assert_same_datetime(dt, expected):
+    assert dt.replace(tzinfo=None) == expected.replace(tzinfo=None)
+    assert dt.utcoffset() == expected.utcoffset()
+
+
+FAST_TIMESTAMPS = [
+    '2019-09-16T00:00:00Z',
+    '2019-09-16T00:00:00.123Z[UTC]',
+    '2019-09-16T00:00:00.12+00:00',
+    '2019-09-16T00:00:00.123456',
+    '2019-09-16T00:00:00.1234567Z',
+    '2019-09-16 23:59:59.9',
+    '2019-09-16T12:30:00+05:30',
+    '2019-09-16T12:30:00.5-0700',
+    '2020-02-29T00:00:00.000001-01:00',
+]
+
+FALLBACK_TIMESTAMPS = [
+    '2019-09-16',
+    '2019-09-16T00:00Z',
+    'Sep 16 2019 12:00:00',
+    '2019-09-16T00:00:00 UTC',
+]
+
+
+@pytest.mark.parametrize('date_str', FAST_TIMESTAMPS)
+def test_timestamp_parser_fast_path_matches_dateutil(date_str):
+    parser = TimestampParser()
+    assert_same_datetime(parser.parse(date_str), parse_with_dateutil(date_str))
+    assert parser.get_stats() == {'hits': 1, 'fallbacks': 0}
+
+
+@pytest.mark.parametrize('date_str', FALLBACK_TIMESTAMPS)
+def test_timestamp_parser_falls_back_to_dateutil(date_str):
+    parser = TimestampParser()
+    assert_same_datetime(parser.parse(date_str), parse_with_dateutil(date_str))
+    assert parser.get_stats() == {'hits': 0, 'fallbacks': 1}
+
+
+def test_timestamp_parser_invalid_date_raises_as_dateutil_does():
+    parser = TimestampParser()
+    # matches the fast path format, but is not a valid date
+    with pytest.raises(ValueError):
+        parser.parse('2019-02-30T00:00:00Z')
+    with pytest.raises(ValueError):
+        parse_with_dateutil('2019-02-30T00:00:00Z')
+    assert parser.get_stats() == {'hits': 0, 'fallbacks': 1}
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_timestamp_parser_matches_dateutil_on_random_timestamps(seed):
+    rnd = random.Random(seed)
+    parser = TimestampParser(cache_size=8)
+    for _ in range(500):
+        date_str = '{:04d}-{:02d}-{:02d}{}{:02d}:{:02d}:{:02d}'.format(
+            rnd.randint(1970, 2030), rnd.randint(1, 12), rnd.randint(1, 28), rnd.choice('T '),
+            rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+        date_str += rnd.choice(['', '.' + str(rnd.randint(0, 10**9)).zfill(rnd.randint(1, 9))])
+        date_str += rnd.choice(['', 'Z', 'Z[UTC]', '+00:00', '{}{:02d}:{:02d}'.format(rnd.choice('+-'), rnd.randint(0, 14), rnd.choice([0, 30, 45]))])
+        assert_same_datetime(parser.parse(date_str), parse_with_dateutil(date_str))
+    assert parser.get_stats() == {'hits': 500, 'fallbacks': 0}
+
+
+def test_timestamp_parser_keeps_recent_prefixes():
+    parser = TimestampParser(cache_size=2)
+    for date_str in ['2019-09-16T00:00:00.1Z', '2019-09-16T00:00:01Z', '2019-09-16T00:00:00.2Z', '2019-09-16T00:00:02Z']:
+        parser.parse(date_str)
+    # the least recently used prefix was dropped
+    assert list(parser.prefix_cache) == ['2019-09-16T00:00:00', '2019-09-16T00:00:02']
+    assert_same_datetime(parser.parse('2019-09-16T00:00:00.3+01:00'), parse_with_dateutil('2019-09-16T00:00:00.3+01:00'))
+    assert list(parser.prefix_cache) == ['2019-09-16T00:00:02', '2019-09-16T00:00:00']
+    assert parser.get_stats() == {'hits': 5, 'fallbacks': 0}
@@ -0,0 +1,193 @@
+import json
+import random
+import time
+
+import pytest
+
+from fake_s3 import FakeS3Client
+import lambda__lake_to_socrata as lake_to_socrata
+from s3_file_mover import CvPilotFileMover
+from socrata_util import SocrataDataset
+from time_budget import TimeBudgetScheduler
+
+
+class FakeDataset(SocrataDataset):
+    def __init__(self, col_dtype_dict):
+        super(FakeDataset, self).__init__('abcd-1234', col_dtype_dict=col_dtype_dict, base_url='http://localhost')
+        self.upserted = []
+        self.published = []
+        self.deleted = []
+
+    def upsert(self, recs, dataset_id=None):
+        self.upserted += [(dataset_id, rec) for rec in recs]
+        return {'Rows Created': len(recs)}
+
+    def publish_draft(self, draftId):
+        self.published.append(draftId)
+
+    def delete_draft(self, draftId):
+        self.deleted.append(draftId)
+
+
+class FakeContext(object):
+    function_name = 'lake_to_socrata'
+
+    def __init__(self, seconds=900):
+        self.deadline = time.time() + seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time())*1000)
+
+
+def bsm(i):
+    return {'metadata': {'odeReceivedAt': '2019-09-16T00:00:00.000Z',
+                         'recordGeneratedAt': '2019-09-16T00:00:{:02d}Z'.format(i)},
+            'payload': {'dataType': 'us.dot.its.jpo.ode.plugin.j2735.J2735Bsm',
+                        'data': {'coreData': {'id': 'bsm{}'.format(i), 'speed': i}}}}
+
+
+def test_bad_record_is_skipped_and_draft_published():
+    key = 'wydot/BSM/2019/09/16/00/file'
+    # the record without metadata fails in the flattener
+    lines = [json.dumps(bsm(0)), json.dumps({'payload': {}}), json.dumps(bsm(1))]
+    mover = CvPilotFileMover(s3_client=FakeS3Client({('src', key): '\n'.join(lines).encode('utf-8')}))
+    so_ingestor = FakeDataset({'coreData_id': 'text', 'coreData_speed': 'number'})
+    state = {'workingId': 'draf-0001', 'overwrite': True, 'count': 0, 'invocation': 0,
+             'tasks': [TimeBudgetScheduler.make_task('src', key, 100)]}
+
+    lake_to_socrata.process_state(state, mover, so_ingestor, {}, FakeContext())
+
+    assert [(w, rec['coreData_id']) for w, rec in so_ingestor.upserted] == [('draf-0001', 'bsm0'), ('draf-0001', 'bsm1')]
+    assert so_ingestor.published == ['draf-0001']
+    assert so_ingestor.deleted == []
+
+
+def test_failed_handoff_leaves_draft_unpublished(monkeypatch):
+    key = 'wydot/BSM/2019/09/16/00/file'
+    mover = CvPilotFileMover(s3_client=FakeS3Client({('src', key): json.dumps(bsm(0)).encode('utf-8')}))
+    so_ingestor = FakeDataset({'coreData_id': 'text', 'coreData_speed': 'number'})
+    handed_over = []
+
+    def send_continuation(state, mover, context):
+        handed_over.append(state)
+        return False
+    monkeypatch.setattr(lake_to_socrata, 'send_continuation', send_continuation)
+    state = {'workingId': 'draf-0001', 'overwrite': True, 'count': 0, 'invocation': 0,
+             'tasks': [TimeBudgetScheduler.make_task('src', key, 100)]}
+
+    # no time left for the file beyond the margin kept for handing over
+    lake_to_socrata.process_state(state, mover, so_ingestor, {}, FakeContext(seconds=lake_to_socrata.skip_time_ms/1000.0))
+
+    assert [task['key'] for task in handed_over[0]['tasks']] == [key]
+    assert so_ingestor.published == []
+    assert so_ingestor.deleted == []
+
+
+def shard_cost(shard):
+    file_overhead_bytes = TimeBudgetScheduler.file_overhead_seconds*TimeBudgetScheduler.default_bytes_per_second
+    return sum(task['size'] + file_overhead_bytes for task in shard)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_split_shards_balances_cost(seed):
+    rnd = random.Random(seed)
+    num_tasks = rnd.randint(1, 200)
+    num_shards = rnd.randint(1, 12)
+    tasks = [TimeBudgetScheduler.make_task('src', 'key{:03d}'.format(i), int(rnd.paretovariate(1.5)*1e5))
+             for i in range(num_tasks)]
+    shards = lake_to_socrata.split_shards(tasks, num_shards)
+
+    assert len(shards) == min(num_shards, num_tasks)
+    assert all(shards)
+    # every task in exactly one shard, in order within each shard
+    assert sorted(task['key'] for shard in shards for task in shard) == [task['key'] for task in tasks]
+    assert all([task['key'] for task in shard] == sorted(task['key'] for task in shard) for shard in shards)
+    # largest first onto the least loaded shard: no shard exceeds the others by more than one file
+    costs = [shard_cost(shard) for shard in shards]
+    largest_file = max(shard_cost([task]) for task in tasks)
+    assert max(costs) - min(costs) <= largest_file
+    assert max(costs) <= shard_cost(tasks)/len(shards) + largest_file
+
+
+def test_split_shards_keeps_large_file_alone():
+    tasks = [TimeBudgetScheduler.make_task('src', 'key{}'.format(i), size) for i, size in enumerate([100, 10**9, 200, 300])]
+    shards = lake_to_socrata.split_shards(tasks, 2)
+    assert [[task['key'] for task in shard] for shard in shards] == [['key1'], ['key0', 'key2', 'key3']]
+
+
+class FanOut(object):
+    '''
+    Coordinator and workers of a fanned out overwrite, sharing one in-memory S3
+    client. Continuations are kept in sent instead of being sent.
+    '''
+    def __init__(self, monkeypatch, num_files=7, num_shards=3):
+        monkeypatch.setattr(lake_to_socrata, 'CONTINUATION_S3_URI', 's3://state/continuations/')
+        monkeypatch.setattr(lake_to_socrata, 'FANOUT_WORKERS', num_shards)
+        monkeypatch.setattr(lake_to_socrata, 'send_continuation', lambda state, mover, context: self.sent.append(state) or True)
+        monkeypatch.setattr(lake_to_socrata.time, 'sleep', lambda seconds: None)
+        self.sent = []
+        self.s3_client = FakeS3Client()
+        self.tasks = []
+        for i in range(num_files):
+            key = 'wydot/BSM/2019/09/16/00/file{}'.format(i)
+            self.s3_client.objects[('src', key)] = json.dumps(bsm(i)).encode('utf-8')
+            self.tasks.append(TimeBudgetScheduler.make_task('src', key, 100*(i+1)))
+        self.mover = CvPilotFileMover(s3_client=self.s3_client)
+        self.so_ingestor = FakeDataset({'coreData_id': 'text', 'coreData_speed': 'number'})
+
+    def process(self, state, seconds=900):
+        self.sent = []
+        lake_to_socrata.process_state(state, self.mover, self.so_ingestor, {}, FakeContext(seconds))
+        return self.sent
+
+    def markers(self):
+        return sorted(key for bucket, key in self.s3_client.objects if key.startswith('continuations/draf-0001/shards/'))
+
+
+def test_coordinator_publishes_after_every_shard_is_done(monkeypatch):
+    fan = FanOut(monkeypatch)
+    coordinator = lake_to_socrata.fan_out('draf-0001', fan.tasks, fan.mover, FakeContext())
+    shards = fan.sent
+    assert coordinator['num_shards'] == len(shards) == 3
+    assert sorted(task['key'] for shard in shards for task in shard['tasks']) == [task['key'] for task in fan.tasks]
+    assert all(not shard['overwrite'] and shard['workingId'] == 'draf-0001' for shard in shards)
+
+    for shard in shards[:2]:
+        assert fan.process(shard) == []
+        # too little time left to wait for the other shards: waiting is handed over
+        handed_over = fan.process(coordinator, seconds=lake_to_socrata.skip_time_ms/1000.0 + 1)
+        assert [state['num_shards'] for state in handed_over] == [3]
+        assert fan.so_ingestor.published == []
+        coordinator = handed_over[0]
+    assert fan.markers() == ['continuations/draf-0001/shards/0.json', 'continuations/draf-0001/shards/1.json']
+
+    fan.process(shards[2])
+    assert fan.so_ingestor.published == []
+    assert fan.process(coordinator) == []
+    assert fan.so_ingestor.published == ['draf-0001']
+    assert fan.so_ingestor.deleted == []
+    assert sorted(rec['coreData_id'] for _, rec in fan.so_ingestor.upserted) == sorted('bsm{}'.format(i) for i in range(7))
+    # the done markers are removed once counted
+    assert fan.markers() == []
+
+
+def test_coordinator_gives_up_after_fanout_timeout(monkeypatch):
+    fan = FanOut(monkeypatch)
+    coordinator = lake_to_socrata.fan_out('draf-0001', fan.tasks, fan.mover, FakeContext())
+    shards = fan.sent
+    fan.process(shards[0])
+    coordinator['started_at'] -= lake_to_socrata.FANOUT_TIMEOUT_MINUTES*60 + 1
+    assert fan.process(coordinator) == []
+    assert fan.so_ingestor.published == [] and fan.so_ingestor.deleted == []
+
+
+def test_coordinator_deletes_draft_when_shards_upserted_nothing(monkeypatch):
+    fan = FanOut(monkeypatch, num_files=2, num_shards=2)
+    for task in fan.tasks:
+        fan.s3_client.objects[('src', task['key'])] = b''
+    coordinator = lake_to_socrata.fan_out('draf-0001', fan.tasks, fan.mover, FakeContext())
+    for shard in fan.sent:
+        fan.process(shard)
+    fan.process(coordinator)
+    assert fan.so_ingestor.published == []
+    assert fan.so_ingestor.deleted == ['draf-0001']
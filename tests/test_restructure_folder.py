@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from restructure_folder import FolderRestructurer
+
+
+class GatedLister(object):
+    '''
+    Lists keys, pausing after the first few until the gate is opened.
+    '''
+    def __init__(self, keys, pause_after):
+        self.keys = keys
+        self.pause_after = pause_after
+        self.gate = threading.Event()
+
+    def iter_fps_from_prefix(self, bucket, prefix):
+        for idx, key in enumerate(self.keys):
+            if idx == self.pause_after:
+                self.gate.wait(5)
+            yield bucket, key
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_progress_estimates_keys_left_while_listing(capsys):
+    restructurer = FolderRestructurer('bkt', folder='wydot/BSM/2019/', startKey='wydot/BSM/2019/k1')
+    lister = GatedLister(['wydot/BSM/2019/k{}'.format(i) for i in range(10)], pause_after=4)
+    restructurer.mover = lister
+    keys = restructurer.iter_keys_from_s3()
+    assert next(keys) == ('bkt', 'wydot/BSM/2019/k1')
+    restructurer.stats['moved'] = 1
+
+    # keys before the start key are not counted
+    wait_for(lambda: restructurer.numkeys_listed == 3)
+    restructurer.report_progress(time.time() - 60)
+    out = capsys.readouterr().out
+    assert 'at least 2 left, ETA over 2.0 min (folder still being listed)' in out
+
+    lister.gate.set()
+    assert list(keys) == [('bkt', 'wydot/BSM/2019/k{}'.format(i)) for i in range(2, 10)]
+    restructurer.report_progress(time.time() - 60)
+    out = capsys.readouterr().out
+    assert '10 keys retrieved from s3://bkt/wydot/BSM/2019/' in out
+    assert '8 left, ETA 8.0 min\n' in out
+
+
+def test_listing_error_is_raised():
+    restructurer = FolderRestructurer('bkt', folder='wydot/BSM/2019/')
+
+    class FailingLister(object):
+        def iter_fps_from_prefix(self, bucket, prefix):
+            yield bucket, 'wydot/BSM/2019/k0'
+            raise IOError('listing failed')
+    restructurer.mover = FailingLister()
+    keys = restructurer.iter_keys_from_s3()
+    assert next(keys) == ('bkt', 'wydot/BSM/2019/k0')
+    with pytest.raises(IOError, match='listing failed'):
+        next(keys)
@@ -0,0 +1,260 @@
+import gzip
+import io
+import json
+import random
+
+import pytest
+
+from fake_s3 import FakeS3Client
+import s3_file_mover
+from s3_file_mover import BlockLineReader, CvPilotFileMover, PartitionSpool, S3FileMover, gunzip_blocks
+
+
+def make_mover():
+    mover = CvPilotFileMover(s3_client=object(), log=False)
+    mover.print_func = lambda *args: None
+    return mover
+
+
+def test_get_ymdh_from_line_rejects_invalid_json():
+    mover = make_mover()
+    line = b'{"metadata": {"recordGeneratedAt": "2019-09-16T12:00:00Z", "x": GARBAGE}, "payload": {}}'
+    assert mover.get_ymdh_from_line(line) is None
+    assert mover.num_err_lines == 1
+
+
+def test_get_ymdh_from_line_reads_metadata_only():
+    mover = make_mover()
+    line = (b'{"metadata": {"odeReceivedAt": "2019-05-05T05:00:00Z"}, '
+            b'"payload": {"data": {"timeStamp": "2019-05-05T05:00:00Z", "x": {"recordGeneratedAt": "2018-02-02T02:00:00Z"}}}}')
+    assert mover.get_ymdh_from_line(line) == '2019-05-05-05'
+    assert mover.num_err_lines == 0
+
+
+def make_lines(rnd):
+    # empty lines, a line ending with \r, long compressible lines and one longer than every block size
+    lines = [b'{"a": %d, "b": "%s"}' % (i, b'x'*rnd.randint(0, 50)) for i in range(200)]
+    lines += [b'', b'{"c": 1}\r', b'0'*5000, bytes(rnd.getrandbits(8) for _ in range(3000)).replace(b'\n', b'n')]
+    rnd.shuffle(lines)
+    # an empty last line cannot be told apart from a trailing newline
+    return lines + [b'{"last": 1}']
+
+
+def encode(lines, encoding, trailing_newline):
+    data = b'\n'.join(lines) + (b'\n' if trailing_newline else b'')
+    if encoding == 'plain':
+        return data
+    if encoding == 'gzip':
+        return gzip.compress(data)
+    # several gzip members, cut in the middle of lines, with null padding after the last one
+    cuts = sorted({0, len(data)} | {len(data)*i//7 for i in range(1, 7)})
+    members = b''.join(gzip.compress(data[start:end]) for start, end in zip(cuts, cuts[1:]))
+    if encoding == 'padded gzip':
+        members += b'\x00'*10
+    return members
+
+
+@pytest.mark.parametrize('encoding', ['plain', 'gzip', 'multi-member gzip', 'padded gzip'])
+@pytest.mark.parametrize('block_size', [1, 7, 100, 1024*1024])
+@pytest.mark.parametrize('trailing_newline', [True, False])
+def test_block_line_reader_matches_splitlines(encoding, block_size, trailing_newline):
+    rnd = random.Random(block_size)
+    lines = make_lines(rnd)
+    data = encode(lines, encoding, trailing_newline)
+    reader = BlockLineReader(io.BytesIO(data), gzipped=encoding != 'plain', block_size=block_size)
+    assert list(reader.iter_lines()) == lines
+    assert reader.bytes_read == len(data)
+
+    reader = BlockLineReader(io.BytesIO(data), gzipped=encoding != 'plain', block_size=block_size)
+    readlines = list(iter(reader.readline, b''))
+    expected = io.BytesIO(b'\n'.join(lines) + b'\n').readlines()
+    assert readlines == expected
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'multi-member gzip', 'padded gzip'])
+@pytest.mark.parametrize('max_block_size', [1, 1000, 1024*1024])
+@pytest.mark.parametrize('input_block_size', [1, 4096])
+def test_gunzip_blocks_matches_gzip_module(encoding, max_block_size, input_block_size):
+    # highly compressible data, so that a few input bytes decompress to many output blocks
+    lines = [b'0'*100000, b'1'*10] + make_lines(random.Random(max_block_size))
+    data = encode(lines, encoding, True)
+    input_blocks = [data[i:i+input_block_size] for i in range(0, len(data), input_block_size)]
+    blocks = list(gunzip_blocks(input_blocks, max_block_size))
+    assert all(0 < len(block) <= max_block_size for block in blocks)
+    assert b''.join(blocks) == gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def random_keys(rnd, n):
+    # names sorting just before and after '/' and folders holding keys next to sub-folders
+    parts = ['wydot', 'BSM', 'TIM', '2019', '09', '16', '00', '01', 'a-b', 'a.b', 'a0', 'a', 'file']
+    keys = set()
+    while len(keys) < n:
+        keys.add('/'.join(rnd.choice(parts) for _ in range(rnd.randint(1, 5))))
+    return keys
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_iter_objects_from_prefix_matches_sorted_listing(seed):
+    rnd = random.Random(seed)
+    keys = random_keys(rnd, rnd.randint(0, 300))
+    s3_client = FakeS3Client({('bkt', key): b'x' for key in keys}, page_size=rnd.randint(1, 20))
+    s3_client.objects[('other', 'wydot/BSM/x')] = b'x'
+    mover = S3FileMover(s3_client=s3_client, log=False)
+    for prefix in ['', 'wydot', 'wydot/', 'wydot/BSM', 'wydot/BSM/', 'a', 'a/', 'missing/']:
+        for limit in [0, 1, 5, 50]:
+            expected = sorted(key for key in keys if key.startswith(prefix))
+            if limit:
+                expected = expected[:limit]
+            threads = rnd.randint(1, 4)
+            listed = mover.iter_objects_from_prefix('bkt', prefix, limit=limit, threads=threads,
+                                                    min_shards=rnd.choice([None, 1, 3, 50]))
+            assert [obj['Key'] for obj in listed] == expected, (prefix, limit)
+
+
+def test_partition_spool_spills_largest_partitions(tmp_path):
+    rnd = random.Random(0)
+    spool = PartitionSpool(max_memory=2000, spool_dir=str(tmp_path))
+    written = {}
+    for i in range(300):
+        # partition 0 grows fastest
+        partition = min(rnd.randint(0, 4), rnd.randint(0, 4))
+        rec = {'idx': i, 'note': 'x'*rnd.randint(0, 20)}
+        spool.write(partition, rec)
+        written.setdefault(partition, []).append(rec)
+        assert spool.memory <= spool.max_memory
+        assert spool.memory == sum(spool.numbytes[p] for p in spool.partitions() if p not in spool.spilled)
+    assert 0 in spool.spilled and spool.spilled != set(spool.partitions())
+    for partition in spool.partitions():
+        # spilled buffers are on disk, the others in memory
+        assert spool.buffers[partition]._rolled == (partition in spool.spilled)
+        data = spool.open(partition).read()
+        assert len(data) == spool.numbytes[partition]
+        assert [json.loads(line) for line in data.split(b'\n')] == written[partition]
+        assert spool.numrecs[partition] == len(written[partition])
+    spool.close()
+    assert spool.partitions() == [] and spool.memory == 0
+
+
+@pytest.mark.parametrize('numbytes,part_sizes', [
+    (0, []),
+    (1000, []),
+    (1001, [1000, 1]),
+    (3000, [1000, 1000, 1000]),
+    (3500, [1000, 1000, 1000, 500]),
+])
+def test_write_stream_uploads_parts_of_multipart_chunk_size(numbytes, part_sizes):
+    s3_client = FakeS3Client()
+    mover = S3FileMover(s3_client=s3_client, log=False)
+    mover.multipart_chunk_size = 1000
+    data = bytes(random.Random(numbytes).getrandbits(8) for _ in range(numbytes))
+    mover.write_stream(io.BytesIO(data), numbytes, 'bkt', 'out')
+    assert s3_client.objects[('bkt', 'out')] == data
+    if part_sizes:
+        assert s3_client.calls.get('put_object') is None
+        assert s3_client.calls['upload_part'] == len(part_sizes)
+        assert s3_client.calls['complete_multipart_upload'] == 1
+    else:
+        assert s3_client.calls == {'put_object': 1}
+
+
+def test_write_stream_aborts_failed_multipart_upload():
+    s3_client = FakeS3Client()
+
+    def upload_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise IOError('upload failed')
+        return FakeS3Client.upload_part(s3_client, **kwargs)
+    s3_client.upload_part = upload_part
+    mover = S3FileMover(s3_client=s3_client, log=False)
+    mover.multipart_chunk_size = 1000
+    with pytest.raises(IOError, match='upload failed'):
+        mover.write_stream(io.BytesIO(b'x'*2500), 2500, 'bkt', 'out')
+    assert s3_client.calls['abort_multipart_upload'] == 1
+    assert s3_client.uploads == {} and ('bkt', 'out') not in s3_client.objects
+
+
+def test_part_size_is_at_least_5_mb():
+    assert S3FileMover(s3_client=object(), log=False, multipart_chunk_mb=1).multipart_chunk_size == 5*1024*1024
+
+
+class FakeQueue(object):
+    '''
+    SQS queue whose send_message_batch fails the entries listed for each call.
+    '''
+    url = 'https://sqs.example.com/validation'
+
+    def __init__(self, failures=None, sender_fault=False):
+        self.failures = list(failures or [])
+        self.sender_fault = sender_fault
+        self.batches = []
+        self.received = []
+
+    def send_message_batch(self, Entries):
+        self.batches.append([entry['Id'] for entry in Entries])
+        failed_ids = set(self.failures.pop(0)) if self.failures else set()
+        failed = [{'Id': entry['Id'], 'SenderFault': self.sender_fault, 'Code': 'InternalError'}
+                  for entry in Entries if entry['Id'] in failed_ids]
+        self.received += [json.loads(entry['MessageBody']) for entry in Entries if entry['Id'] not in failed_ids]
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries if entry['Id'] not in failed_ids],
+                'Failed': failed} if failed else {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+
+def make_queue_mover(monkeypatch, queue):
+    monkeypatch.setattr(s3_file_mover.time, 'sleep', lambda seconds: None)
+    mover = make_mover()
+    mover.queues = [queue]
+    return mover
+
+
+def test_send_queue_messages_retries_only_failed_entries(monkeypatch):
+    queue = FakeQueue(failures=[['1', '7'], ['7']])
+    mover = make_queue_mover(monkeypatch, queue)
+    msgs = [{'key': 'k{}'.format(i)} for i in range(23)]
+    mover.send_queue_messages(msgs)
+    assert queue.batches == [[str(i) for i in range(10)], ['1', '7'], ['7'],
+                             [str(i) for i in range(10)], [str(i) for i in range(3)]]
+    assert sorted(queue.received, key=lambda msg: int(msg['key'][1:])) == msgs
+
+
+def test_send_queue_messages_raises_after_max_retries(monkeypatch):
+    queue = FakeQueue(failures=[['3']]*10)
+    mover = make_queue_mover(monkeypatch, queue)
+    with pytest.raises(RuntimeError, match='Failed to send 1 messages to https://sqs.example.com/validation'):
+        mover.send_queue_messages([{'key': 'k{}'.format(i)} for i in range(5)])
+    assert queue.batches == [[str(i) for i in range(5)]] + [['3']]*mover.queue_max_retries
+
+
+def test_send_queue_messages_does_not_retry_sender_faults(monkeypatch):
+    queue = FakeQueue(failures=[['0']], sender_fault=True)
+    mover = make_queue_mover(monkeypatch, queue)
+    with pytest.raises(RuntimeError):
+        mover.send_queue_messages([{'key': 'k0'}, {'key': 'k1'}])
+    assert len(queue.batches) == 1
+
+
+def test_move_file_spills_and_uploads_hours_in_parts(monkeypatch):
+    source_key = 'BSM/2019/09/16/00/wydot-filtered-bsm-public-1-2019-09-16-00-00-00'
+    s3_client = FakeS3Client()
+    rnd = random.Random(1)
+    recs = [{'metadata': {'recordGeneratedAt': '2019-09-16T{:02d}:00:00.000Z'.format(rnd.randint(0, 3))},
+             'payload': {'idx': i, 'note': 'x'*rnd.randint(0, 50)}} for i in range(2000)]
+    s3_client.objects[('usdot-its-datahub-wydot-ingest', source_key)] = '\n'.join(json.dumps(rec) for rec in recs).encode('utf-8')
+    queue = FakeQueue(failures=[['0']])
+    mover = CvPilotFileMover(target_bucket='usdot-its-cvpilot-public-data', s3_client=s3_client,
+                             log=False, spool_memory_mb=0.05, upload_threads=2)
+    mover.print_func = lambda *args: None
+    mover.multipart_chunk_size = 20000
+    mover.queues = [queue]
+    monkeypatch.setattr(s3_file_mover.time, 'sleep', lambda seconds: None)
+    target_keys = mover.move_file('usdot-its-datahub-wydot-ingest', source_key)
+
+    assert len(target_keys) == 4
+    assert s3_client.calls['upload_part'] > 4
+    assert ('usdot-its-datahub-wydot-ingest', source_key) not in s3_client.objects
+    for target_key in target_keys:
+        hour = target_key.split('/')[5]
+        assert target_key.startswith('wydot/BSM/2019/09/16/{}/'.format(hour))
+        expected = [rec for rec in recs if rec['metadata']['recordGeneratedAt'][11:13] == hour]
+        data = s3_client.objects[('usdot-its-cvpilot-public-data', target_key)]
+        assert [json.loads(line) for line in data.split(b'\n')] == expected
+    assert sorted(msg['key'] for msg in queue.received) == sorted(target_keys)
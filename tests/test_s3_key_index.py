@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta, timezone
+
+from s3_key_index import S3KeyIndex
+
+PREFIX = 'wydot/BSM/2019/09/16/00/'
+
+
+class FakeMover(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.listings = 0
+
+    def get_objects_from_prefix(self, bucket, prefix):
+        self.listings += 1
+        return [{'Key': prefix + key, 'Size': 10, 'ETag': '"{}"'.format(key),
+                 'LastModified': datetime(2019, 9, 16, 1, tzinfo=timezone.utc)} for key in self.keys]
+
+
+def age_listing(index, hours):
+    listed_at = index.format_time(datetime.now(timezone.utc) - timedelta(hours=hours))
+    index.conn.execute('UPDATE folders SET listed_at=?', (listed_at,))
+    index.conn.commit()
+
+
+def test_settled_folder_is_read_from_index(tmp_path):
+    index = S3KeyIndex(str(tmp_path / 'keys.sqlite'))
+    mover = FakeMover(['a', 'b'])
+    assert [obj['Key'] for obj in index.get_objects(mover, 'bkt', PREFIX)] == [PREFIX + 'a', PREFIX + 'b']
+    mover.keys.append('c')
+    assert len(index.get_objects(mover, 'bkt', PREFIX)) == 2
+    assert mover.listings == 1
+    assert index.get_stats() == {'index_folders': 1, 'listed_folders': 1}
+
+
+def test_folder_listed_before_it_settled_is_listed_again(tmp_path):
+    index = S3KeyIndex(str(tmp_path / 'keys.sqlite'))
+    mover = FakeMover(['a'])
+    index.get_objects(mover, 'bkt', PREFIX)
+    index.conn.execute('UPDATE folders SET listed_at=?', ('2019-09-16T02:00:00',))
+    mover.keys.append('b')
+    assert len(index.get_objects(mover, 'bkt', PREFIX)) == 2
+    assert mover.listings == 2
+
+
+def test_max_age_hours_lists_old_listings_again(tmp_path):
+    fp = str(tmp_path / 'keys.sqlite')
+    mover = FakeMover(['a'])
+    S3KeyIndex(fp).get_objects(mover, 'bkt', PREFIX)
+    index = S3KeyIndex(fp, max_age_hours=24)
+    age_listing(index, 12)
+    mover.keys.append('b')
+    assert len(index.get_objects(mover, 'bkt', PREFIX)) == 1
+    age_listing(index, 36)
+    assert len(index.get_objects(mover, 'bkt', PREFIX)) == 2
+    assert mover.listings == 2
+    # the new listing is fresh again
+    assert len(index.get_objects(mover, 'bkt', PREFIX)) == 2
+    assert mover.listings == 2
+
+
+def test_refresh_lists_every_folder_and_updates_index(tmp_path):
+    fp = str(tmp_path / 'keys.sqlite')
+    mover = FakeMover(['a'])
+    S3KeyIndex(fp).get_objects(mover, 'bkt', PREFIX)
+    mover.keys.append('b')
+    assert len(S3KeyIndex(fp, refresh=True).get_objects(mover, 'bkt', PREFIX)) == 2
+    assert mover.listings == 2
+    assert len(S3KeyIndex(fp).get_objects(mover, 'bkt', PREFIX)) == 2
+    assert mover.listings == 2
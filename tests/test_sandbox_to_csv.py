@@ -0,0 +1,226 @@
+import json
+
+import pytest
+
+from fake_s3 import FakeS3Client, FakeSession
+from sandbox_to_csv import ArrowWriter, SandboxExporter
+
+
+def write_arrow_files(tmp_path, file_format, files, print_func=print):
+    schema = None
+    fps = []
+    for idx, recs in enumerate(files):
+        writer = ArrowWriter(str(tmp_path / '{}.{}'.format(idx, file_format)), file_format, schema=schema, print_func=print_func)
+        writer.write(recs)
+        writer.close()
+        schema = writer.schema
+        fps.append(writer.fp)
+    return fps
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'arrow'])
+def test_rolled_files_share_schema(tmp_path, file_format):
+    pa = pytest.importorskip('pyarrow')
+    ds = pytest.importorskip('pyarrow.dataset')
+    files = [
+        [{'coreData_speed': 12, 'metadata_generatedAt': '2019-09-16T00:00:00.000Z', 'note': None, 'msgCnt': 1}],
+        [{'coreData_speed': 12.5, 'metadata_generatedAt': '2019-09-16T01:00:00.000Z', 'note': 1.5, 'msgCnt': 2}],
+        [{'coreData_speed': None, 'metadata_generatedAt': None, 'note': 2, 'extra': 'x', 'msgCnt': 3}],
+        [{'coreData_speed': 13, 'metadata_generatedAt': '2019-09-16T03:00:00.000Z', 'note': None, 'msgCnt': 2**40}],
+    ]
+    printed = []
+    fps = write_arrow_files(tmp_path, file_format, files, printed.append)
+
+    dataset = ds.dataset(fps, format='parquet' if file_format == 'parquet' else 'ipc')
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    # whole numbers are int64 until the column holds floats, then float64 from that file on
+    assert [s.field('coreData_speed').type for s in schemas] == [pa.int64()] + [pa.float64()]*3
+    assert [s.field('msgCnt').type for s in schemas] == [pa.int64()]*4
+    assert [s.field('metadata_generatedAt').type for s in schemas] == [pa.timestamp('ms', tz='UTC')]*4
+    assert schemas[0].field('note').type == pa.null()
+    assert schemas[1].field('note').type == pa.float64()
+    assert schemas[2].field('note').type == pa.float64()
+    assert printed == []
+
+    unified = pa.unify_schemas(schemas, promote_options='permissive')
+    table = ds.dataset(fps, format=dataset.format, schema=unified).to_table()
+    assert table.column('coreData_speed').to_pylist() == [12.0, 12.5, None, 13.0]
+    assert table.column('msgCnt').to_pylist() == [1, 2, 3, 2**40]
+    assert table.column('note').to_pylist() == [None, 1.5, 2.0, None]
+    assert table.column('extra').to_pylist() == [None, None, 'x', None]
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'arrow'])
+def test_invalid_dates_are_written_as_strings(tmp_path, file_format, capsys):
+    pa = pytest.importorskip('pyarrow')
+    ds = pytest.importorskip('pyarrow.dataset')
+    files = [
+        [{'metadata_generatedAt': '2019-09-16T00:00:00.000Z', 'metadata_receivedAt': '2019-02-30T00:00:00Z'}],
+        [{'metadata_generatedAt': '2019-02-29T00:00:00Z', 'metadata_receivedAt': '2019-09-16T00:00:00Z'}],
+    ]
+    printed = []
+    fps = write_arrow_files(tmp_path, file_format, files, printed.append)
+
+    schemas = [fragment.physical_schema for fragment in ds.dataset(fps, format='parquet' if file_format == 'parquet' else 'ipc').get_fragments()]
+    assert schemas[0].field('metadata_generatedAt').type == pa.timestamp('ms', tz='UTC')
+    assert schemas[0].field('metadata_receivedAt').type == pa.string()
+    # a column that held timestamps in earlier files is written as string in the file with an invalid date
+    assert schemas[1].field('metadata_generatedAt').type == pa.string()
+    assert schemas[1].field('metadata_receivedAt').type == pa.string()
+    assert printed == ['Column metadata_generatedAt holds string values in {}, but timestamp[ms, tz=UTC] values in earlier files. Writing it as string.'.format(fps[1])]
+    assert capsys.readouterr().out == ''
+
+
+FOLDERS = ['wydot/BSM/2019/09/16/{:02d}'.format(hour) for hour in range(4)]
+
+
+def make_s3(keys_per_folder=2, recs_per_key=7):
+    s3_client = FakeS3Client()
+    for folder in FOLDERS:
+        for k in range(keys_per_folder):
+            add_key(s3_client, '{}/key{}'.format(folder, k), recs_per_key)
+    return s3_client
+
+
+def add_key(s3_client, key, numrecs, note=''):
+    recs = [{'key': key, 'idx': idx, 'note': note,
+             'metadata': {'recordGeneratedAt': '2019-09-16T00:00:00.000Z', 'odeReceivedAt': '2019-09-16T00:00:01.000Z'}}
+            for idx in range(numrecs)]
+    s3_client.objects[('bkt', key)] = '\n'.join(json.dumps(rec) for rec in recs).encode('utf-8')
+
+
+def make_exporter(s3_client, monkeypatch, **kwargs):
+    monkeypatch.setattr(SandboxExporter, 'create_aws_session', lambda self: FakeSession(s3_client))
+    params = dict(output_format='json', max_rows_per_file=10)
+    params.update(kwargs)
+    exporter = SandboxExporter(bucket='bkt', sdate='2019-09-16 00:00', edate='2019-09-16 04:00', **params)
+    exporter.print_func = lambda *args: None
+    return exporter
+
+
+def interrupt_on_write(monkeypatch, numcalls):
+    '''
+    Interrupt the export when SandboxExporter.write is called for the numcalls-th time.
+    '''
+    write = SandboxExporter.write
+    calls = []
+
+    def interrupted_write(self, recs):
+        calls.append(len(recs))
+        if len(calls) == numcalls:
+            raise KeyboardInterrupt()
+        return write(self, recs)
+    monkeypatch.setattr(SandboxExporter, 'write', interrupted_write)
+
+
+def read_output(file_names):
+    recs = []
+    for fp in file_names:
+        with open(fp) as infile:
+            recs += [json.loads(line) for line in infile if line.strip()]
+    return recs
+
+
+def export_interrupted(s3_client, monkeypatch, **kwargs):
+    # 4 folders of 2 keys of 7 records, one write per key, 10 records per file:
+    # the 8th write (second key of folder 03) is interrupted after file 3 was
+    # closed in the middle of folder 02, and folder 02 completed with file 4 open
+    with monkeypatch.context() as m:
+        interrupt_on_write(m, 8)
+        with pytest.raises(KeyboardInterrupt):
+            make_exporter(s3_client, monkeypatch, **kwargs).run()
+
+
+@pytest.mark.parametrize('prefetch_depth', [0, 3])
+def test_resume_after_interruption_matches_uninterrupted_export(tmp_path, monkeypatch, prefetch_depth):
+    s3_client = make_s3()
+    (tmp_path / 'full').mkdir()
+    monkeypatch.chdir(tmp_path / 'full')
+    full = make_exporter(s3_client, monkeypatch, prefetch_depth=prefetch_depth)
+    full.run()
+    expected = read_output(full.file_names)
+    assert len(expected) == 56
+
+    (tmp_path / 'resumed').mkdir()
+    monkeypatch.chdir(tmp_path / 'resumed')
+    export_interrupted(s3_client, monkeypatch, prefetch_depth=prefetch_depth)
+    manifest_fp = 'wydot_bsm_2019091600_2019091604_manifest.json'
+    with open(manifest_fp) as infile:
+        manifest = json.load(infile)
+    assert manifest['completed_folders'] == FOLDERS[:2]
+    assert manifest['partial_folder'] == FOLDERS[2]
+    assert manifest['partial_numrecs'] == 12
+    assert manifest['output_files'] == ['wydot_bsm_2019091600_2019091604_{}.txt'.format(i) for i in range(4)]
+    assert not manifest['finished']
+    with open('wydot_bsm_2019091600_2019091604_manifest_keys.jsonl') as infile:
+        logged = [json.loads(line) for line in infile]
+    assert [entry['folder'] for entry in logged] == FOLDERS[:2]
+    assert logged[0]['etags'] == {'{}/key{}'.format(FOLDERS[0], k): s3_client.etag('bkt', '{}/key{}'.format(FOLDERS[0], k))
+                                  for k in range(2)}
+
+    s3_client.calls = {}
+    resumed = make_exporter(s3_client, monkeypatch, prefetch_depth=prefetch_depth, resume=True)
+    resumed.run()
+    # only the folders not completed are read again, numbering goes on after the last closed file
+    assert s3_client.calls['get_object'] == 4
+    assert resumed.file_names == full.file_names
+    assert read_output(resumed.file_names) == expected
+    assert resumed.changed_folders == []
+    with open(manifest_fp) as infile:
+        manifest = json.load(infile)
+    assert manifest['finished'] and manifest['numrecs'] == 56
+    assert manifest['completed_folders'] == FOLDERS
+
+
+def test_resume_warns_about_changed_completed_folders(tmp_path, monkeypatch):
+    s3_client = make_s3()
+    monkeypatch.chdir(tmp_path)
+    export_interrupted(s3_client, monkeypatch)
+    expected = read_output(['wydot_bsm_2019091600_2019091604_{}.txt'.format(i) for i in range(4)])
+
+    add_key(s3_client, '{}/key0'.format(FOLDERS[0]), 7, note='changed')
+    add_key(s3_client, '{}/key2'.format(FOLDERS[1]), 3)
+    del s3_client.objects[('bkt', '{}/key1'.format(FOLDERS[1]))]
+    resumed = make_exporter(s3_client, monkeypatch, resume=True)
+    printed = []
+    resumed.print_func = printed.append
+    resumed.run()
+
+    assert resumed.changed_folders == FOLDERS[:2]
+    assert 'Warning: files in {} changed since it was exported (0 added, 0 removed, 1 modified). It is not exported again.'.format(FOLDERS[0]) in printed
+    assert 'Warning: files in {} changed since it was exported (1 added, 1 removed, 0 modified). It is not exported again.'.format(FOLDERS[1]) in printed
+    # the completed folders are kept as exported
+    assert read_output(resumed.file_names)[:40] == expected
+
+
+def test_new_export_empties_keys_log(tmp_path, monkeypatch):
+    s3_client = make_s3()
+    monkeypatch.chdir(tmp_path)
+    export_interrupted(s3_client, monkeypatch)
+    make_exporter(s3_client, monkeypatch).run()
+    with open('wydot_bsm_2019091600_2019091604_manifest_keys.jsonl') as infile:
+        logged = [json.loads(line) for line in infile]
+    assert [entry['folder'] for entry in logged] == FOLDERS
+
+
+@pytest.mark.parametrize('output_format,file_sizes', [
+    # rolled over at the end of the first folder past the limit, as before files could be capped
+    ('json', [28, 28]),
+    ('csv', [28, 28]),
+    ('parquet', [56]),
+])
+def test_default_run_rolls_files_at_folder_ends(tmp_path, monkeypatch, output_format, file_sizes):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    monkeypatch.setattr(SandboxExporter, 'folder_rollover_recs', 20)
+    monkeypatch.chdir(tmp_path)
+    exporter = make_exporter(make_s3(), monkeypatch, output_format=output_format, max_rows_per_file=None)
+    printed = []
+    exporter.print_func = printed.append
+    exporter.run()
+
+    assert exporter.max_rows_per_file == 0
+    assert [int(line.split()[1]) for line in printed if line.startswith('Wrote ')] == file_sizes
+    if output_format == 'json':
+        # files hold whole folders
+        assert [sorted(set(rec['key'][:-5] for rec in read_output([fp]))) for fp in exporter.file_names] == [FOLDERS[:2], FOLDERS[2:]]
@@ -0,0 +1,242 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+
+import pytest
+import requests
+
+import socrata_util
+from socrata_util import SocrataDataset
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSession(object):
+    def __init__(self, status_codes):
+        self.status_codes = list(status_codes)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return FakeResponse(self.status_codes.pop(0))
+
+
+class FakeClient(object):
+    domain = 'data.example.com'
+    timeout = 10
+
+    def __init__(self, status_codes):
+        self.session = FakeSession(status_codes)
+
+
+def mod_dtype_per_field(rec, col_dtype_dict, float_fields):
+    '''
+    Frozen copy of the per field mod_dtype that mod_dtypes replaced. The output
+    of mod_dtypes must match it key for key, with the same value types.
+    '''
+    identity = lambda x: x
+    out = {}
+    for k,v in rec.items():
+        if k in float_fields and k in col_dtype_dict:
+            out[k] = float(v)
+        elif k in col_dtype_dict:
+            if v is not None and v is not socrata_util.empty_str:
+                out[k] = socrata_util.dtype_funcs.get(col_dtype_dict.get(k, 'nonexistentKey'), identity)(v)
+    out = {k:v for k,v in out.items() if k in col_dtype_dict}
+    return out
+
+
+COL_DTYPE_DICT = {'n{}'.format(i): 'number' for i in range(4)}
+COL_DTYPE_DICT.update({'t{}'.format(i): 'text' for i in range(4)})
+COL_DTYPE_DICT.update({'c{}'.format(i): 'checkbox' for i in range(2)})
+COL_DTYPE_DICT.update({'point': 'point', 'generatedAt': 'calendar_date', 'randomNum': 'number', 'timeOfDay': 'number'})
+FLOAT_FIELDS = ['randomNum', 'timeOfDay', 'notAColumn']
+
+
+def random_rec(rnd):
+    values = [None, '', 0, 1, 12, 2.5, -1e-3, '7', '3.25', 'x', True, False, [1, 2], {'a': 1}]
+    rec = {}
+    for col in rnd.sample(sorted(COL_DTYPE_DICT) + ['extra', 'notAColumn'], rnd.randint(0, 16)):
+        if col in FLOAT_FIELDS:
+            # float fields always hold numbers
+            rec[col] = rnd.choice([0, 0.5, 3, '4.5'])
+        elif col[0] == 'n':
+            rec[col] = rnd.choice([None, '', 0, 1, 12, 2.5, '7', '3.25', True])
+        else:
+            rec[col] = rnd.choice(values)
+    return rec
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_mod_dtypes_matches_per_field_mod_dtype(seed):
+    rnd = random.Random(seed)
+    recs = [random_rec(rnd) for _ in range(2000)]
+    dataset = SocrataDataset('abcd-1234', float_fields=FLOAT_FIELDS, col_dtype_dict=COL_DTYPE_DICT, base_url='http://localhost')
+    expected = [mod_dtype_per_field(rec, COL_DTYPE_DICT, FLOAT_FIELDS) for rec in recs]
+    for result in [dataset.mod_dtypes(recs),
+                   dataset.mod_dtypes(recs, COL_DTYPE_DICT, FLOAT_FIELDS),
+                   [dataset.mod_dtype(rec) for rec in recs]]:
+        assert [list(out.items()) for out in result] == [list(out.items()) for out in expected]
+        assert [[type(v) for v in out.values()] for out in result] == [[type(v) for v in out.values()] for out in expected]
+
+
+def make_dataset(status_codes, monkeypatch):
+    monkeypatch.setattr(socrata_util.time, 'sleep', lambda seconds: None)
+    return SocrataDataset('abcd-1234', socrata_client=FakeClient(status_codes),
+                          socrata_params={'username': 'u', 'password': 'p'},
+                          col_dtype_dict={'coreData_id': 'text'})
+
+
+def test_poll_draft_request_repeats_until_draft_is_ready(monkeypatch):
+    dataset = make_dataset([202, 409, 429, 200], monkeypatch)
+    response = dataset.poll_draft_request('POST', '/api/views/draf-0001/publication.json')
+    assert response.status_code == 200
+    assert len(dataset.client.session.requests) == 4
+
+
+def test_poll_draft_request_does_not_repost_after_server_error(monkeypatch):
+    dataset = make_dataset([502, 200], monkeypatch)
+    response = dataset.poll_draft_request('POST', '/api/views/abcd-1234/publication.json')
+    assert response.status_code == 502
+    assert dataset.client.session.requests == [('POST', 'https://data.example.com/api/views/abcd-1234/publication.json')]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''
+    Local stand-in for the Socrata upsert endpoint. The server decides the
+    status of each request with its respond function, and keeps the body of
+    every request and the rows it accepted.
+    '''
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        recs = json.loads(body)
+        with self.server.lock:
+            self.server.bodies.append(body)
+            status = self.server.respond(body, recs)
+            if status == 200:
+                for rec in recs:
+                    self.server.rows[rec['id']] = self.server.rows.get(rec['id'], 0) + 1
+        out = json.dumps({'Rows Created': len(recs), 'Rows Updated': 0, 'Errors': 0} if status == 200 else {'error': True}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+@pytest.fixture
+def standin():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.bodies = []
+    server.rows = {}
+    server.respond = lambda body, recs: 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class StandInClient(object):
+    timeout = 10
+
+    def __init__(self):
+        self.session = requests.Session()
+
+
+def make_upsert_dataset(standin, chunk_bytes, upsert_threads=1):
+    dataset = SocrataDataset('abcd-1234', socrata_client=StandInClient(),
+                             col_dtype_dict={'id': 'text', 'note': 'text'},
+                             upsert_threads=upsert_threads,
+                             base_url='http://127.0.0.1:{}'.format(standin.server_address[1]))
+    dataset.chunk_bytes = chunk_bytes
+    dataset.retry_delay = 0
+    return dataset
+
+
+def make_recs(n):
+    # 100 bytes of json per record
+    return [{'id': 'r{:05d}'.format(i), 'note': 'x'*75} for i in range(n)]
+
+
+def test_upsert_sends_chunks_of_chunk_bytes(standin):
+    dataset = make_upsert_dataset(standin, 2000)
+    # keep the chunk size fixed
+    dataset.min_chunk_bytes = dataset.max_chunk_bytes = 2000
+    recs = make_recs(100)
+    result = dataset.upsert(recs)
+
+    assert result == {'Rows Created': 100, 'Rows Updated': 0, 'Errors': 0}
+    assert standin.rows == {rec['id']: 1 for rec in recs}
+    # 19 records of 100 bytes plus commas and brackets fit in 2000 bytes
+    assert [len(json.loads(body)) for body in standin.bodies] == [19]*5 + [5]
+    assert all(len(body) <= 2000 for body in standin.bodies)
+
+
+def test_upsert_retries_only_failed_chunk(standin):
+    failed = []
+
+    def respond(body, recs):
+        if not failed and any(rec['id'] == 'r00042' for rec in recs):
+            failed.append([rec['id'] for rec in recs])
+            return 503
+        return 200
+    standin.respond = respond
+    dataset = make_upsert_dataset(standin, 2000, upsert_threads=3)
+    dataset.min_chunk_bytes = dataset.max_chunk_bytes = 2000
+    recs = make_recs(100)
+    result = dataset.upsert(recs)
+
+    # the failed chunk is not counted, its retry is
+    assert result['Rows Created'] == 100
+    assert standin.rows == {rec['id']: 1 for rec in recs}
+    posted = [rec['id'] for body in standin.bodies for rec in json.loads(body)]
+    assert sorted(posted) == sorted([rec['id'] for rec in recs] + failed[0])
+
+
+def test_upsert_gives_up_after_max_retries(standin):
+    standin.respond = lambda body, recs: 503
+    dataset = make_upsert_dataset(standin, 2000)
+    with pytest.raises(requests.exceptions.HTTPError):
+        dataset.upsert(make_recs(10))
+    assert len(standin.bodies) == dataset.upsert_max_retries + 1
+
+
+def test_upsert_adapts_chunk_bytes_to_timeouts(standin):
+    # requests of more than 5000 bytes time out at the gateway
+    standin.respond = lambda body, recs: 504 if len(body) > 5000 else 200
+    dataset = make_upsert_dataset(standin, 16000)
+    dataset.min_chunk_bytes = 1000
+    recs = make_recs(400)
+    result = dataset.upsert(recs)
+
+    assert result['Rows Created'] == 400
+    assert standin.rows == {rec['id']: 1 for rec in recs}
+    # the smallest chunk that timed out caps the size the chunks grow back to
+    assert 5000 < dataset.failed_chunk_bytes <= 8000
+    assert dataset.chunk_bytes <= dataset.failed_chunk_bytes*0.8
+    # each timeout lowers the ceiling, so only a few chunks time out
+    sizes = [len(body) for body in standin.bodies]
+    assert sizes[0] > 15000
+    assert sum(size > 5000 for size in sizes) <= 5
+
+
+def test_upsert_shrinks_chunk_bytes_after_slow_requests(standin):
+    dataset = make_upsert_dataset(standin, 8000)
+    dataset.min_chunk_bytes = 1000
+    # every request is slower than the target
+    dataset.upsert_target_seconds = 1e-9
+    result = dataset.upsert(make_recs(400))
+
+    assert result['Rows Created'] == 400
+    sizes = [len(body) for body in standin.bodies]
+    assert sizes[0] > sizes[1] > sizes[2] > sizes[3]
+    assert dataset.chunk_bytes == 1000
@@ -0,0 +1,100 @@
+'''
+Scheduling of file processing within the time limit of a Lambda invocation.
+
+'''
+from collections import deque
+
+
+class TimeBudgetScheduler(object):
+    '''
+    Picks the files that can be processed within the remaining time of an
+    invocation, based on their size and the throughput measured so far.
+
+    Each task is a dictionary with the bucket, key and size of a file, the
+    offset (number of non-empty lines) up to which it has already been
+    processed and the bytes of it that were read to get there. The tasks that
+    are left over, including a file paused at its exact offset, are handed to
+    the next invocation with get_state.
+    '''
+    # throughput assumed before any file has been timed, in bytes of S3 objects per second
+    default_bytes_per_second = 1024*1024
+    # fixed cost of each file (e.g. the S3 request), in seconds
+    file_overhead_seconds = 0.2
+    # margin applied to every estimate
+    safety_factor = 1.25
+    # weight of the latest file in the measured throughput
+    smoothing = 0.3
+
+    def __init__(self, tasks, bytes_per_second=None):
+        '''
+        Parameters:
+            tasks: list of task dictionaries, see make_task
+            bytes_per_second: throughput measured by a previous invocation
+        '''
+        self.pending = deque(tasks)
+        self.bytes_per_second = bytes_per_second or self.default_bytes_per_second
+        self.num_started = 0
+        self.stats = {'files_done': 0, 'files_paused': 0, 'bytes_done': 0}
+
+    @staticmethod
+    def make_task(bucket, key, size=0, offset=0, bytes_done=0):
+        return {'bucket': bucket, 'key': key, 'size': size, 'offset': offset, 'bytes_done': bytes_done}
+
+    def estimate_seconds(self, task):
+        remaining_bytes = max(task['size'] - task.get('bytes_done', 0), 0)
+        return self.safety_factor*(self.file_overhead_seconds + remaining_bytes/float(self.bytes_per_second))
+
+    def next_task(self, budget_seconds):
+        '''
+        Take the first pending task expected to finish within budget_seconds,
+        skipping over the ones that are too large for now. If none fits and no
+        task has been started yet, the first one is taken anyway, so that every
+        invocation makes progress even on a file larger than its time limit.
+
+        Returns:
+            task dictionary, or None if no task should be started
+        '''
+        if not self.pending or budget_seconds <= 0:
+            return None
+        for idx, task in enumerate(self.pending):
+            if self.estimate_seconds(task) <= budget_seconds:
+                del self.pending[idx]
+                break
+        else:
+            if self.num_started:
+                return None
+            task = self.pending.popleft()
+        self.num_started += 1
+        return task
+
+    def record(self, numbytes, seconds):
+        '''
+        Update the throughput with the bytes of a file processed in seconds,
+        including its share of the upserts.
+        '''
+        self.stats['bytes_done'] += numbytes
+        seconds = max(seconds - self.file_overhead_seconds, 0.001)
+        if numbytes > 0:
+            self.bytes_per_second = (1-self.smoothing)*self.bytes_per_second + self.smoothing*numbytes/seconds
+
+    def finish(self, task):
+        self.stats['files_done'] += 1
+
+    def pause(self, task, offset, bytes_done):
+        '''
+        Put a partially processed task back in front of the pending ones, to be
+        resumed after its first offset lines.
+        '''
+        task = dict(task, offset=offset, bytes_done=bytes_done)
+        self.pending.appendleft(task)
+        self.stats['files_paused'] += 1
+
+    def get_state(self):
+        '''
+        Returns:
+            dictionary of the pending tasks and the measured throughput
+        '''
+        return {'tasks': list(self.pending), 'bytes_per_second': self.bytes_per_second}
+
+    def get_stats(self):
+        return dict(self.stats, pending=len(self.pending), bytes_per_second=int(self.bytes_per_second))